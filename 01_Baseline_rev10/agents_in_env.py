@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class RED:
     def __init__(self, agent_type, config):
         self.color = 'red'
@@ -53,6 +56,130 @@ class BLOCK:
         self.pos = None
 
 
+def team_property(name, cast):
+    """ Property of AgentView, which reads/writes the row of AgentTeam.<name> """
+
+    def fget(self):
+        return cast(getattr(self.team, name)[self.idx])
+
+    def fset(self, value):
+        getattr(self.team, name)[self.idx] = value
+
+    return property(fget, fset)
+
+
+class AgentView:
+    """
+    Thin view of one agent in AgentTeam.
+    Keeps the attribute API of RED / BLUE (red.pos, red.force, red.alive, ...),
+    while the values live in the arrays of the team.
+    """
+    __slots__ = ('team', 'idx')
+
+    def __init__(self, team, idx):
+        self.team = team
+        self.idx = idx  # row in the team arrays
+
+    @property
+    def color(self):
+        return self.team.color
+
+    @property
+    def id(self):
+        return self.team.ids[self.idx]
+
+    type = team_property('type', str)
+    threshold = team_property('threshold', float)
+    efficiency = team_property('efficiency', float)
+
+    # Initial value
+    initial_force = team_property('initial_force', float)
+    initial_ef = team_property('initial_ef', float)
+
+    initial_effective_force = team_property('initial_effective_force', float)
+    initial_effective_ef = team_property('initial_effective_ef', float)
+
+    # Current value
+    # pos is a new list [x,y] of each read, a copy of the row of AgentTeam.pos.
+    # In-place edits of it (red.pos[0] -= 1) are lost, assign the whole pos (red.pos = [x,y]).
+    pos = team_property('pos', lambda x: x.tolist())  # [x,y], list of int
+    force = team_property('force', float)
+    ef = team_property('ef', float)
+    alive = team_property('alive', bool)
+
+    effective_force = team_property('effective_force', float)
+    effective_ef = team_property('effective_ef', float)
+
+    def to_dict(self):
+        """ Same keys as RED.__dict__ / BLUE.__dict__, json serializable """
+        return {'color': self.color,
+                'type': self.type,
+                'threshold': self.threshold,
+                'id': self.id,
+                'efficiency': self.efficiency,
+                'initial_force': self.initial_force,
+                'initial_ef': self.initial_ef,
+                'initial_effective_force': self.initial_effective_force,
+                'initial_effective_ef': self.initial_effective_ef,
+                'pos': self.pos,
+                'force': self.force,
+                'ef': self.ef,
+                'alive': self.alive,
+                'effective_force': self.effective_force,
+                'effective_ef': self.effective_ef}
+
+
+class AgentTeam:
+    """
+    Struct-of-arrays store of a team (env.reds / env.blues).
+        pos: (num_agents,2), int
+        force, ef, effective_force, effective_ef, efficiency, threshold, initial_*:
+            (num_agents,), float64
+        alive: (num_agents,), bool
+        type: (num_agents,), str
+        ids: [agent.id,...], len=num_agents
+
+    The team is iterable/indexable like the former list of RED / BLUE objects,
+    each item is an AgentView of the row.
+    """
+    float_fields = ('threshold', 'efficiency',
+                    'initial_force', 'initial_ef',
+                    'initial_effective_force', 'initial_effective_ef',
+                    'force', 'ef', 'effective_force', 'effective_ef')
+
+    def __init__(self, agents):
+        """
+        :param agents: [RED,...] or [BLUE,...] generated by generate_red_team / generate_blue_team
+        """
+        agents = list(agents)
+
+        self.color = agents[0].color if agents else None
+        self.ids = [agent.id for agent in agents]
+
+        self.type = np.array([agent.type for agent in agents], dtype='<U7')
+        self.pos = np.array([agent.pos for agent in agents], dtype=np.int64).reshape(-1, 2)
+        self.alive = np.array([agent.alive for agent in agents], dtype=bool)
+
+        for name in self.float_fields:
+            setattr(self, name,
+                    np.array([getattr(agent, name) for agent in agents], dtype=np.float64))
+
+        self.views = [AgentView(self, idx) for idx in range(len(agents))]
+
+    def __len__(self):
+        return len(self.views)
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __getitem__(self, idx):
+        return self.views[idx]
+
+    def __add__(self, agents):
+        """ team + [RED,...], e.g., add reds during the episode """
+        return AgentTeam(self.views + list(agents))
+
+
 def main():
     config = Config()
     red = RED('platoon', config=config)
@@ -0,0 +1,216 @@
+import json
+import os
+import random
+import re
+from collections import defaultdict
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+import ray
+
+from models import MarlTransformerModel
+from sequential_test import make_sequential_test
+from test_config import Config
+from utils_transformer import make_mask, make_padded_obs
+from vec_evaluator import VecEvaluator
+
+
+def find_checkpoints(models_dir):
+    """
+    Checkpoints saved by Learner, models_dir/model_N/ (or models_dir/model_N/model_N)
+    :return: [(N, checkpoint prefix to load_weights),...], sorted by N
+    """
+    checkpoints = []
+
+    for checkpoint_dir in Path(models_dir).glob('model_*'):
+        match = re.fullmatch(r'model_(\d+)', checkpoint_dir.name)
+        if (match is None) or (not checkpoint_dir.is_dir()):
+            continue
+
+        index_files = sorted(checkpoint_dir.glob('*.index'))
+        if len(index_files) == 0:
+            continue
+
+        prefix = str(index_files[0])[:-len('.index')]
+        checkpoints.append((int(match.group(1)), prefix))
+
+    return sorted(checkpoints)
+
+
+@ray.remote(num_cpus=1)
+class SweepWorker:
+    """
+    Evaluates checkpoints by VecEvaluator. The weights of a checkpoint are loaded once, and all
+    the scenarios are evaluated with them.
+    """
+
+    def __init__(self):
+        self.config = Config()
+
+        self.policy = MarlTransformerModel(config=self.config)
+
+        # Build model
+        alive_agents_ids = [0, 2]
+        obs_shape = (self.config.grid_size,
+                     self.config.grid_size,
+                     self.config.observation_channels * self.config.n_frames)
+        raw_obs = [np.random.rand(*obs_shape) for _ in alive_agents_ids]
+
+        padded_obs = make_padded_obs(self.config.max_num_red_agents, obs_shape, raw_obs)
+        mask = make_mask(alive_agents_ids, self.config.max_num_red_agents)
+
+        self.policy(padded_obs, mask)
+
+        self.evaluator = VecEvaluator(policy=self.policy, num_envs=self.config.num_eval_envs)
+
+    def evaluate_checkpoint(self, model_count, checkpoint, scenario_ids, seeds, epsilon):
+        """
+        seeds: seed of each scenario, same for all the checkpoints (common random numbers)
+        :return: [row,...], scalar fields of the result of each scenario
+        """
+        self.policy.load_weights(checkpoint)
+
+        rows = []
+        for scenario_id, seed in zip(scenario_ids, seeds):
+            np.random.seed(seed)
+            random.seed(int(seed))
+
+            result = self.evaluator.evaluate(
+                scenario_id=scenario_id,
+                num_episodes=self.config.max_episodes_test_play,
+                epsilon=epsilon,
+                sequential_test=make_sequential_test(self.config,
+                                                     wave_size=self.evaluator.num_envs))
+
+            row = {'model_count': model_count, 'scenario_id': scenario_id}
+            for key, value in result.items():
+                if not isinstance(value, (list, dict)):
+                    row[key] = value
+
+            rows.append(row)
+
+        return rows
+
+
+def make_sweep_table(rows):
+    """ :return: columnar table {field: [value,...]}, sorted by model_count and scenario_id """
+    rows = sorted(rows, key=lambda row: (row['model_count'], row['scenario_id']))
+
+    table = defaultdict(list)
+    for row in rows:
+        for key, value in row.items():
+            table[key].append(value)
+
+    return dict(table)
+
+
+def make_sweep_graphs(table, scenario_ids, savedir):
+    model_counts = np.array(table['model_count'])
+    scenario_column = np.array(table['scenario_id'])
+    num_episodes = np.array(table['num_test_episodes'])
+
+    for scenario_id in scenario_ids:
+        rows = scenario_column == scenario_id
+        x = model_counts[rows]
+
+        plt.plot(x, np.array(table['num_red_win'])[rows] / num_episodes[rows],
+                 color='r', marker='o', label='red win')
+        plt.plot(x, np.array(table['num_blue_win'])[rows] / num_episodes[rows],
+                 color='b', marker='o', label='blue win')
+        plt.plot(x, np.array(table['no_contest'])[rows] / num_episodes[rows],
+                 color='g', marker='s', label='no contest')
+        plt.title('Red win / Blue win / No contest ratio, scenario ' + str(scenario_id))
+        plt.xlabel('learner update cycles (model_N)')
+        plt.ylabel('win ratio')
+        plt.ylim(-0.05, 1.05)
+        plt.minorticks_on()
+        plt.legend()
+        plt.grid()
+
+        savename = 'win_ratio_of_scenario_' + str(scenario_id)
+        plt.savefig(str(savedir) + '/' + savename + '.png', dpi=300)
+        plt.close()
+
+        plt.plot(x, np.array(table['episode_rewards'])[rows], color='r', marker='o',
+                 label='episode rewards')
+        plt.plot(x, np.array(table['episode_team_reward'])[rows], color='b', marker='o',
+                 label='team reward')
+        plt.title('Mean episode rewards, scenario ' + str(scenario_id))
+        plt.xlabel('learner update cycles (model_N)')
+        plt.ylabel('mean rewards')
+        plt.minorticks_on()
+        plt.legend()
+        plt.grid()
+
+        savename = 'rewards_of_scenario_' + str(scenario_id)
+        plt.savefig(str(savedir) + '/' + savename + '.png', dpi=300)
+        plt.close()
+
+
+def main(num_workers=None, seed=0):
+    """
+    Evaluate all the checkpoints models/model_N of a training run in parallel by num_workers
+    SweepWorkers (default is the number of cores), with the same seeds of the scenarios.
+    results.json (columnar table) and graphs are saved in ./checkpoint_sweep/.
+    Specify the models dir and the scenarios. Episodes are config.max_episodes_test_play.
+    """
+    epsilon = 0.
+
+    scenario_ids = [0, 1, 2, 3, 4]
+    models_dir = Path(__file__).parent / 'models'
+
+    checkpoints = find_checkpoints(models_dir)
+    if len(checkpoints) == 0:
+        raise ValueError()
+
+    seeds = np.random.SeedSequence(seed).generate_state(len(scenario_ids))
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(checkpoints))
+
+    ray.init(ignore_reinit_error=True)
+
+    workers = [SweepWorker.remote() for _ in range(num_workers)]
+
+    # One checkpoint in flight per worker, the next one to the first finished worker
+    pending = list(checkpoints)
+    wip_refs = {}
+    rows = []
+
+    for worker in workers:
+        model_count, checkpoint = pending.pop(0)
+        wip_refs[worker.evaluate_checkpoint.remote(
+            model_count, checkpoint, scenario_ids, seeds, epsilon)] = worker
+
+    while len(wip_refs) > 0:
+        finished, _ = ray.wait(list(wip_refs), num_returns=1)
+        worker = wip_refs.pop(finished[0])
+
+        finished_rows = ray.get(finished[0])
+        rows += finished_rows
+        print(f"model_{finished_rows[0]['model_count']}: num_red_win = "
+              f"{[row['num_red_win'] for row in finished_rows]}")
+
+        if len(pending) > 0:
+            model_count, checkpoint = pending.pop(0)
+            wip_refs[worker.evaluate_checkpoint.remote(
+                model_count, checkpoint, scenario_ids, seeds, epsilon)] = worker
+
+    ray.shutdown()
+
+    table = make_sweep_table(rows)
+
+    savedir = './checkpoint_sweep'
+    if not os.path.exists(savedir):
+        os.makedirs(savedir)
+
+    with open(savedir + '/results.json', 'w') as f:
+        json.dump(table, f, indent=5)
+
+    make_sweep_graphs(table, scenario_ids, savedir)
+
+
+if __name__ == '__main__':
+    main()
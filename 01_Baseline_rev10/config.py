@@ -19,6 +19,16 @@ class Config:
         self.show_each_episode_result = True  # mainly for debug
         self.draw_win_distributions = False  # mainly for debug
         self.max_episodes_test_play = 1  # default=50 for training
+        self.num_testers = 1  # >1: test episodes fan out to num_testers Tester actors
+
+        # Sequential early stopping of the test episodes by the red win rate
+        self.sequential_test = None  # None: full max_episodes_test_play, 'wilson' or 'sprt'
+        self.sequential_test_threshold = 0.5  # win rate tested against, before the best model
+        # Error rate of the early stopping. wilson: two-sided, spent over the checks of each wave,
+        # sprt: alpha=beta at threshold -/+ indifference
+        self.sequential_test_alpha = 0.05
+        self.sequential_test_indifference = 0.05  # sprt: half width of the indifference region
+        self.sequential_test_min_episodes = 10
 
         # Animation setting
         self.make_animation = True  # Use self.max_episodes_test_play=1
@@ -26,6 +36,9 @@ class Config:
         # Time plot of a test setting
         self.make_time_plot = True  # Use self.max_episodes_test_play=1
 
+        # Trace of each test episode, rendered by render_traces.py
+        self.trace_episodes = False  # Compact binary trace, cheap for all the test episodes
+
         # Define environment parameters
         self.grid_size = 15  # default=20
         self.offset = 0  # blue-team offset from edges
@@ -48,23 +61,38 @@ class Config:
 
         # Buffer
         self.capacity = 2500  # default=100000 -> 2500
-        self.compress = True
         self.prioritized_replay = True
+        self.num_replay_shards = 1  # ReplayServer shards, capacity/shards each, 0: Replay in main
 
         # Neural nets parameters
         self.hidden_dim = 256
         self.key_dim = 128
         self.num_heads = 2
+        # True: CNN of the alive agents only, False: of all the padded agents.
+        # Off until models.check_ragged_cnn() is run with TF and the checkpoints in use
+        self.ragged_cnn = False
 
         self.dropout_rate = 0.2  # default=0.2
 
         # Training parameters
         self.actor_rollout_steps = 100  # default=100
+        self.num_envs_per_actor = 1  # >1: M envs in lockstep with batched inference, default=1
+
+        # Centralized batched inference of the actors (InferenceServer)
+        self.use_inference_server = False  # default=False, each actor has own policy
+        self.inference_max_batch_size = 64  # sum of batch dims of the requests
+        self.inference_timeout = 0.005  # sec, wait for more requests before forward pass
         self.num_update_cycles = 1000000
         self.actor_rollouts_before_train = 20  # default=50 -> 20
         self.batch_size = 32  # Default=32
         self.num_minibatchs = 30  # bach_sizeのminibatchの数/1 update_cycle of learner, default=30
+        self.prefetch_depth = 2  # Learner cycles of minibatchs prefetched from ReplayServers
+        self.samples_per_insert = 0.0  # Replay ratio, sampled/inserted transitions, 0: no limit
+        self.samples_per_insert_tolerance = 2.0  # Allowed deviation, in learner cycles of samples
+        self.telemetry_interval = 10  # Learner cycles between throughput metrics to TensorBoard
         self.tau = 0.01  # Soft update of target network
+        self.target_update_interval = 0  # 0: soft update by tau, K: hard update every K cycles
+        self.weights_broadcast_interval = 1  # learner cycles between weights broadcasts to actors
         self.gamma = 0.96
         self.max_steps = 150  # Default = 150 for training, 200 for test
 
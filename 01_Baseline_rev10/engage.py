@@ -1,7 +1,7 @@
 import numpy as np
 
-from utils import compute_engage_mask, compute_current_total_ef_and_force
-from rewards import get_rewards_before_engagement, get_rewards_after_engagement
+from utils import compute_engage_mask
+from rewards import get_cells_rewards_before_engagement
 
 
 def set_info_red(env, red, infos):
@@ -44,145 +44,202 @@ def add_info_next_ef_and_force(infos, agent):
     return infos
 
 
+def get_engage_cells(env, agents, x1, y1):
+    """
+    Gather alive agents to the engagement cells (x1,y1)
+    :param agents: env.reds / env.blues (AgentTeam)
+    :return: agents_cell: index of the engagement cell of each agent, -1 if not engaged,
+                          (num_agents,), int
+    """
+    grid_size = env.config.grid_size
+
+    cell_index = np.full(grid_size * grid_size, -1, dtype=np.int64)
+    cell_index[np.asarray(x1) * grid_size + np.asarray(y1)] = np.arange(len(x1))
+
+    agents_cell = cell_index[agents.pos[:, 0] * grid_size + agents.pos[:, 1]]  # (num_agents,)
+    agents_cell[~agents.alive] = -1
+
+    return agents_cell
+
+
+def compute_cells_ef_and_force(agents, agents_cell, num_cells):
+    """
+    compute_current_total_ef_and_force of all engagement cells in a single pass
+    (sum in the agent order, same as the loop over env.reds / env.blues)
+    :return: cells_ef, cells_force, cells_num_agents, (num_cells,)
+    """
+    engaged = agents_cell >= 0
+    cells = agents_cell[engaged]
+
+    cells_ef = np.bincount(cells, weights=agents.ef[engaged], minlength=num_cells)
+    cells_force = np.bincount(cells, weights=agents.force[engaged], minlength=num_cells)
+
+    cells_effective_ef = \
+        np.bincount(cells, weights=agents.effective_ef[engaged], minlength=num_cells)
+    cells_effective_force = \
+        np.bincount(cells, weights=agents.effective_force[engaged], minlength=num_cells)
+
+    cells_num_agents = np.bincount(cells, minlength=num_cells)
+
+    if np.any(cells_ef < 0) or np.any(cells_force < 0):
+        raise ValueError()
+
+    if np.any(cells_effective_ef < 0) or np.any(cells_effective_force < 0):
+        raise ValueError()
+
+    return cells_ef, cells_force, cells_num_agents
+
+
+def group_by_cell(agents_cell, num_cells):
+    """
+    Engaged agents sorted by cell, keeping the agent order in the cell
+    :return: order: agent indices, bounds: agents of cell k are order[bounds[k]:bounds[k+1]]
+    """
+    order = np.argsort(agents_cell, kind='stable')
+    order = order[agents_cell[order] >= 0]
+
+    bounds = np.searchsorted(agents_cell[order], np.arange(num_cells + 1))
+
+    return order, bounds
+
+
+def update_ef_and_force(agents, idx, next_force):
+    """ Update force, ef, effective_force, effective_ef of agents[idx] """
+    agents.force[idx] = next_force
+    agents.ef[idx] = agents.force[idx] * agents.efficiency[idx]
+
+    agents.effective_force[idx] = agents.force[idx] - agents.threshold[idx]
+    agents.effective_ef[idx] = agents.ef[idx] - agents.threshold[idx] * agents.efficiency[idx]
+
+
 def engage_and_get_rewards(env, x1, y1, rewards, infos):
     """
     Call from step()
     (x1,y1) ~ locations of engagement
     After one-step Lanchester simulation, red.ef, red.force, red.effective_ef, red.effective_force,
     blue.ef, blue.force, blue.effective_ef, blue.effective_force are updated.
+
+    Scatter/gather kernel: alive agents are gathered to their engagement cells, the ef and force of
+    the cells are summed in a single pass, and the Lanchester update is applied to all engaged
+    agents at once.
     """
+    reds = env.reds
+    blues = env.blues
+    num_cells = len(x1)
+
+    reds_cell = get_engage_cells(env, reds, x1, y1)  # (num_reds,)
+    blues_cell = get_engage_cells(env, blues, x1, y1)  # (num_blues,)
+
+    reds_order, reds_bounds = group_by_cell(reds_cell, num_cells)
+    blues_order, blues_bounds = group_by_cell(blues_cell, num_cells)
+
+    """ before engage """
+    for k in range(num_cells):
+        for i in reds_order[reds_bounds[k]:reds_bounds[k + 1]]:
+            infos = set_info_red(env, reds[i], infos)
+
+        for j in blues_order[blues_bounds[k]:blues_bounds[k + 1]]:
+            infos = set_info_blue(env, blues[j], infos)
+
+    # Compute rR and R of the cells before engage (for Lanchester simulations)
+    reds_cells_ef, reds_cells_force, reds_cells_num = \
+        compute_cells_ef_and_force(reds, reds_cell, num_cells)
 
-    for x, y in zip(x1, y1):
-        """ before engage """
-        # collect reds and blues in the cell
-        reds_in_cell = []
-        blues_in_cell = []
-
-        for red in env.reds:
-            if red.alive and red.pos == [x, y]:
-                reds_in_cell.append(red)
-
-                infos = set_info_red(env, red, infos)
-
-        for blue in env.blues:
-            if blue.alive and blue.pos == [x, y]:
-                blues_in_cell.append(blue)
-
-                infos = set_info_blue(env, blue, infos)
-
-        if len(reds_in_cell) == 0 or len(blues_in_cell) == 0:
-            raise ValueError()
-
-        # Compute rR and R in the cell before engage (for Lanchester simulations)
-        (reds_in_cell_ef, reds_in_cell_force, reds_in_cell_effective_ef,
-         reds_in_cell_effective_force) = compute_current_total_ef_and_force(reds_in_cell)
-
-        # Compute bB and b in the cell before engage (for Lanchester simulations)
-        (blues_in_cell_ef, blues_in_cell_force, blues_in_cell_effective_ef,
-         blues_in_cell_effective_force) = compute_current_total_ef_and_force(blues_in_cell)
-
-        """
-        Reward for consolidation of force 
-        - Compute rewards of cell(x,y) based on before-engagement reds & blues status 
-        """
-        rewards, infos = \
-            get_rewards_before_engagement(reds_in_cell, blues_in_cell,
-                                          reds_in_cell_ef, reds_in_cell_force,
-                                          blues_in_cell_ef, blues_in_cell_force,
-                                          env, rewards, infos)
-
-        """ engage (1 step of Lanchester simulation """
-        # Update force of reds & blues in the cell
-        # R_i' = R_i * (1 - bB / R * dt)
-        next_red_force = []
-        for red in reds_in_cell:
-            next_red_force.append(
-                max(red.force * (1 - blues_in_cell_ef / reds_in_cell_force * env.config.dt),
-                    env.config.threshold))
-
-        # B_i' = B_i * (1 - rR / B * dt)
-        next_blue_force = []
-        for blue in blues_in_cell:
-            next_blue_force.append(
-                max(blue.force * (1 - reds_in_cell_ef / blues_in_cell_force * env.config.dt),
-                    env.config.threshold))
-
-        """ after engage """
-        # Update force, ef of reds & blues in the cell
-        for i, red in enumerate(reds_in_cell):
-            red.force = next_red_force[i]
-            red.ef = red.force * red.efficiency
-
-            red.effective_force = red.force - red.threshold
-            red.effective_ef = red.ef - red.threshold * red.efficiency
-
-            infos = add_info_next_ef_and_force(infos, red)
-
-        for j, blue in enumerate(blues_in_cell):
-            blue.force = next_blue_force[j]
-            blue.ef = blue.force * blue.efficiency
-
-            blue.effective_force = blue.force - blue.threshold
-            blue.effective_ef = blue.ef - blue.threshold * blue.efficiency
-
-            infos = add_info_next_ef_and_force(infos, blue)
-
-        """
-        Rewards after engagement
-        - Compute rewards of cell(x,y) based on after-engagement reds & blues status
-        """
-        # rewards, infos = \
-        #     get_rewards_after_engagement(reds_in_cell, blues_in_cell, env, rewards, infos)
+    # Compute bB and B of the cells before engage (for Lanchester simulations)
+    blues_cells_ef, blues_cells_force, blues_cells_num = \
+        compute_cells_ef_and_force(blues, blues_cell, num_cells)
+
+    if np.any(reds_cells_num == 0) or np.any(blues_cells_num == 0):
+        raise ValueError()
+
+    """
+    Reward for consolidation of force 
+    - Compute rewards of cells based on before-engagement reds & blues status 
+    """
+    cells_rewards = \
+        get_cells_rewards_before_engagement(reds_cells_ef, reds_cells_force,
+                                            blues_cells_ef, blues_cells_force)  # (num_cells,)
+
+    for i in reds_order:
+        red = reds[i]
+        rewards[red.id] += cells_rewards[reds_cell[i]]
+
+        infos[str(red.pos) + ' ' + red.id]['raw_reward'] = np.round(rewards[red.id], 1)
+        infos[str(red.pos) + ' ' + red.id]['reward'] = np.round(rewards[red.id], 1)
+
+    """ engage (1 step of Lanchester simulation) """
+    # Update force of reds & blues in the cells
+    # R_i' = R_i * (1 - bB / R * dt)
+    cells = reds_cell[reds_order]
+    next_red_force = np.maximum(
+        reds.force[reds_order] *
+        (1 - blues_cells_ef[cells] / reds_cells_force[cells] * env.config.dt),
+        env.config.threshold)
+
+    # B_i' = B_i * (1 - rR / B * dt)
+    cells = blues_cell[blues_order]
+    next_blue_force = np.maximum(
+        blues.force[blues_order] *
+        (1 - reds_cells_ef[cells] / blues_cells_force[cells] * env.config.dt),
+        env.config.threshold)
+
+    """ after engage """
+    # Update force, ef of reds & blues in the cells
+    update_ef_and_force(reds, reds_order, next_red_force)
+    update_ef_and_force(blues, blues_order, next_blue_force)
+
+    for i in reds_order:
+        infos = add_info_next_ef_and_force(infos, reds[i])
+
+    for j in blues_order:
+        infos = add_info_next_ef_and_force(infos, blues[j])
 
     return rewards, infos
 
 
 def get_dones(env, x1, y1, dones, infos):
-    """ update agent alive and done of cell(x,y) after engagement """
-    for x, y in zip(x1, y1):
-        reds_in_cell = []  # alive agents list before engagement
-        blues_in_cell = []
-
-        for red in env.reds:
-            if red.alive and red.pos == [x, y]:
-                reds_in_cell.append(red)
+    """ update agent alive and done of engagement cells after engagement """
+    reds_cell = get_engage_cells(env, env.reds, x1, y1)  # alive agents before engagement
+    blues_cell = get_engage_cells(env, env.blues, x1, y1)
 
-        for blue in env.blues:
-            if blue.alive and blue.pos == [x, y]:
-                blues_in_cell.append(blue)
+    engaged_reds = np.nonzero(reds_cell >= 0)[0]
+    engaged_blues = np.nonzero(blues_cell >= 0)[0]
 
-        dones, infos = get_dones_of_cell(env, reds_in_cell, blues_in_cell, dones, infos)
+    dones, infos = get_dones_of_cells(env, engaged_reds, engaged_blues, dones, infos)
 
     return dones, infos
 
 
-def get_dones_of_cell(env, reds_in_cell, blues_in_cell, dones, infos):
-    """ evaluate done & alive of each agent """
-    threshold = env.config.threshold * 1.001
+def kill_agents(agents, idx):
+    """ agents[idx] are not alive anymore """
+    agents.alive[idx] = False
 
-    for red in reds_in_cell:
-        if red.force <= threshold:
-            dones[red.id] = True
-            red.alive = False
+    agents.force[idx] = agents.threshold[idx]
+    agents.ef[idx] = agents.threshold[idx] * agents.efficiency[idx]
 
-            red.force = red.threshold
-            red.ef = red.threshold * red.efficiency
+    agents.effective_ef[idx] = 0
+    agents.effective_force[idx] = 0
 
-            red.effective_ef = 0
-            red.effective_force = 0
 
-        infos[str(red.pos) + ' ' + red.id]['alive'] = red.alive
+def get_dones_of_cells(env, engaged_reds, engaged_blues, dones, infos):
+    """ evaluate done & alive of all engaged agents at once """
+    threshold = env.config.threshold * 1.001
 
-    for blue in blues_in_cell:
-        if blue.force <= threshold:
-            blue.alive = False
+    dead_reds = engaged_reds[env.reds.force[engaged_reds] <= threshold]
+    kill_agents(env.reds, dead_reds)
 
-            blue.force = blue.threshold
-            blue.ef = blue.threshold * blue.efficiency
+    for i in dead_reds:
+        dones[env.reds.ids[i]] = True
 
-            blue.effective_ef = 0
-            blue.effective_force = 0
+    dead_blues = engaged_blues[env.blues.force[engaged_blues] <= threshold]
+    kill_agents(env.blues, dead_blues)
+
+    for i in engaged_reds:
+        red = env.reds[i]
+        infos[str(red.pos) + ' ' + red.id]['alive'] = red.alive
 
+    for j in engaged_blues:
+        blue = env.blues[j]
         infos[str(blue.pos) + ' ' + blue.id]['alive'] = blue.alive
 
     return dones, infos
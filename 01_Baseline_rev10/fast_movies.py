@@ -0,0 +1,333 @@
+import os
+import string
+import subprocess
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+def ffmpeg_command(filename, width, height, interval):
+    """
+    ffmpeg reading rgb24 raw frames from stdin, interval [ms] of frames
+    For mp4, need 'sudo apt install ffmpeg' @ terminal
+    """
+    return ['ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', str(width) + 'x' + str(height), '-r', '1000/' + str(interval),
+            '-i', '-',
+            '-an', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', filename]
+
+
+class FrameWriter:
+    """
+    Streams RGB frames (height,width,3) uint8 to an encoder process through a pipe as they are
+    produced, so that no frame is held in memory.
+    encoder: (filename, width, height, interval) -> command of the encoder reading raw frames
+             from stdin
+    """
+
+    def __init__(self, filename, width, height, interval, encoder=ffmpeg_command):
+        self.filename = filename
+
+        self.process = subprocess.Popen(encoder(filename, width, height, interval),
+                                        stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.data)
+
+    def close(self):
+        self.process.stdin.close()
+
+        if self.process.wait() != 0:
+            raise RuntimeError(self.filename)
+
+
+def to_uint8(image):
+    """ RGB float image in [0,1] (imshow RGB convention) -> uint8 """
+    return (np.clip(image, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+class TextRasterizer:
+    """
+    Pre-rasterised text overlays.
+    Glyphs of the printable characters are rendered once to alpha masks (glyph atlas), and a text
+    is composed by the masks of its characters. Composed texts are cached, since most of the texts
+    (number of alive agents, titles) repeat over the frames.
+    """
+
+    def __init__(self, fontsize=16, max_cache=4096):
+        try:
+            font = ImageFont.load_default(size=fontsize)
+        except TypeError:
+            font = ImageFont.load_default()  # bitmap font, Pillow<10.1
+
+        self.line_height = font.getbbox('Ag|')[3] + 4
+        self.max_cache = max_cache
+
+        self.glyphs = {}  # {char: alpha mask (line_height,advance)}
+        for char in string.printable:
+            if char in string.whitespace and char != ' ':
+                continue
+
+            advance = max(int(round(font.getlength(char))), 1)
+            width = max(advance, font.getbbox(char)[2])
+
+            img = Image.new('L', (width, self.line_height))
+            ImageDraw.Draw(img).text((0, 0), char, fill=255, font=font)
+
+            self.glyphs[char] = (np.asarray(img, dtype=np.float32) / 255, advance)
+
+        self.cache = {}
+
+    def render(self, text):
+        """ :return: alpha mask of text, (line_height,width) float32 """
+        mask = self.cache.get(text)
+        if mask is not None:
+            return mask
+
+        glyphs = [self.glyphs.get(char, self.glyphs['?']) for char in text]
+
+        width = sum([advance for _, advance in glyphs])
+        if len(glyphs) > 0:
+            width += glyphs[-1][0].shape[1] - glyphs[-1][1]
+
+        mask = np.zeros((self.line_height, max(width, 1)), dtype=np.float32)
+
+        x = 0
+        for glyph, advance in glyphs:
+            region = mask[:, x:x + glyph.shape[1]]
+            np.maximum(region, glyph[:, :region.shape[1]], out=region)
+            x += advance
+
+        if len(self.cache) >= self.max_cache:
+            self.cache.clear()
+        self.cache[text] = mask
+
+        return mask
+
+    def draw(self, frame, text, y, x, color=(0, 0, 0)):
+        """ Alpha blend text on frame (H,W,3) uint8 at the top-left (y,x), in place """
+        mask = self.render(text)
+
+        h = min(mask.shape[0], frame.shape[0] - y)
+        w = min(mask.shape[1], frame.shape[1] - x)
+        if (h <= 0) or (w <= 0):
+            return
+
+        alpha = mask[:h, :w, np.newaxis]
+        region = frame[y:y + h, x:x + w]
+
+        region[...] = (region * (1 - alpha) + np.array(color) * alpha + 0.5).astype(np.uint8)
+
+
+class PanelCanvas:
+    """
+    Frame layout of a movie: panels of maps in a row, each with a title and text lines above.
+    The titles are drawn once to the background, and each frame is the background overwritten by
+    the upscaled maps and the texts of the step.
+    """
+
+    def __init__(self, text, num_panels, grid_size, scale, num_text_lines, text_width=0,
+                 margin=16):
+        """ text_width: width reserved for the text lines of the last panel """
+        self.text = text
+        self.scale = scale
+        self.panel_size = grid_size * scale
+
+        line_height = text.line_height
+
+        self.panel_x = [margin + i * (self.panel_size + margin) for i in range(num_panels)]
+        self.title_y = margin
+        self.text_y = [margin + (1 + i) * line_height + margin // 2
+                       for i in range(num_text_lines)]
+        self.panel_y = margin + (1 + num_text_lines) * line_height + margin
+
+        # yuv420p needs even width and height
+        self.width = self.panel_x[-1] + max(self.panel_size, text_width) + margin
+        self.width += self.width % 2
+        self.height = self.panel_y + self.panel_size + margin
+        self.height += self.height % 2
+
+        self.background = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        self.frame = np.empty_like(self.background)
+
+    def set_titles(self, titles):
+        for x, title in zip(self.panel_x, titles):
+            self.text.draw(self.background, title, self.title_y, x)
+
+    def new_frame(self):
+        np.copyto(self.frame, self.background)
+        return self.frame
+
+    def put_panel(self, i, image):
+        """ Nearest-neighbour upscaling of image (g,g,3) float [0,1] into i-th panel """
+        g = image.shape[0]
+        x = self.panel_x[i]
+
+        panel = self.frame[self.panel_y:self.panel_y + self.panel_size, x:x + self.panel_size]
+        panel.reshape(g, self.scale, g, self.scale, 3)[...] = \
+            to_uint8(image)[:, np.newaxis, :, np.newaxis, :]
+
+    def put_text(self, i, line, text):
+        self.text.draw(self.frame, text, self.text_y[line], self.panel_x[i])
+
+
+class EngagementMovieRenderer:
+    """
+    Renders the four movies of MakeAnimation.generate_movies in one pass over the frames:
+    each step is composed as RGB arrays of the four movies, and streamed to four encoders.
+    """
+
+    contents = {
+        'efficiency': ('efficiency', 'efficiency'),
+        'force': ('norm(force)', 'effective_force'),
+        'efficiency_obs': ('efficiency', 'agent_obs_effective_ef'),
+        'force_obs': ('norm_obs(force)', 'agent_obs_effective_force'),
+    }  # content: (title, filename)
+
+    def __init__(self, make_animation, dt, scale=32, interval=300, encoder=ffmpeg_command):
+        self.anim = make_animation
+        self.dt = dt
+        self.scale = scale
+        self.interval = interval
+        self.encoder = encoder  # For FrameWriter
+
+        self.text = TextRasterizer()
+
+    def get_features(self, content):
+        if content == 'efficiency':
+            return self.anim.rgb_channel_efficiencies, self.anim.rgb_channel_engage_forces
+        elif content == 'force':
+            return self.anim.rgb_channel_forces, self.anim.rgb_channel_engage_forces
+        elif content == 'efficiency_obs':
+            return self.anim.rgb_channel_efficiencies_obs, self.anim.rgb_channel_engage_forces_obs
+        elif content == 'force_obs':
+            return self.anim.rgb_channel_forces_obs, self.anim.rgb_channel_engage_forces_obs
+        else:
+            raise NotImplementedError()
+
+    def get_summary_text(self, content, step):
+        if (content == 'efficiency') or (content == 'efficiency_obs'):
+            efficiency_reds = np.round(self.anim.total_efficiency_reds[step], 2)
+            efficiency_blues = np.round(self.anim.total_efficiency_blues[step], 2)
+            return 'efficiency_reds:' + str(efficiency_reds) + \
+                ',  efficiency_blues:' + str(efficiency_blues)
+
+        else:
+            force_reds = np.round(self.anim.total_force_reds[step], 2)
+            force_blues = np.round(self.anim.total_force_blues[step], 2)
+            return 'remaining: effective_force_reds:' + str(force_reds) + \
+                ',  effective_force_blues:' + str(force_blues)
+
+    def render(self, dir_save='./test_engagement'):
+        if not os.path.exists(dir_save):
+            os.mkdir(dir_save)
+
+        canvases = {}
+        writers = {}
+        num_frames = {}
+
+        grid_size = self.anim.battlefield.shape[0]
+
+        # Longest text line of the engagement panel
+        text_width = self.text.render('remaining: effective_force_reds:00000.00,  '
+                                      'effective_force_blues:00000.00').shape[1]
+
+        for content, (title, filename) in self.contents.items():
+            canvas = PanelCanvas(self.text, num_panels=2, grid_size=grid_size,
+                                 scale=self.scale, num_text_lines=4, text_width=text_width)
+            canvas.set_titles([title, 'engagement'])
+            canvases[content] = canvas
+
+            features_1, features_2 = self.get_features(content)
+            num_frames[content] = min(len(features_1), len(features_2))
+
+            writers[content] = FrameWriter(dir_save + '/' + filename + '.mp4',
+                                           canvas.width, canvas.height, self.interval,
+                                           encoder=self.encoder)
+
+        try:
+            for step in range(max(num_frames.values())):
+                time_text = 'time:' + str(np.round(step * self.dt, 2)) + ' sec'
+
+                alive_texts = [
+                    'num_alive:: reds:' + str(self.anim.num_alive_reds[step]) +
+                    ',  blues:' + str(self.anim.num_alive_blues[step]),
+                    '   num_alive_reds:: platoons:' +
+                    str(self.anim.num_alive_reds_platoons[step]) +
+                    ',  companies:' + str(self.anim.num_alive_reds_companies[step]),
+                    '   num_alive_blues:: platoons:' +
+                    str(self.anim.num_alive_blues_platoons[step]) +
+                    ',  companies:' + str(self.anim.num_alive_blues_companies[step])]
+
+                for content, canvas in canvases.items():
+                    if step >= num_frames[content]:
+                        continue
+
+                    features_1, features_2 = self.get_features(content)
+
+                    canvas.new_frame()
+                    canvas.put_panel(0, features_1[step])
+                    canvas.put_panel(1, features_2[step])
+
+                    canvas.put_text(0, 0, time_text)
+                    for line, alive_text in enumerate(alive_texts):
+                        canvas.put_text(1, line, alive_text)
+                    canvas.put_text(1, 3, self.get_summary_text(content, step))
+
+                    writers[content].write(canvas.frame)
+
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+
+class AttentionMovieRenderer:
+    """
+    Renders the movie of MakeAnimation_AttentionMap.generate_movies: attention maps of the
+    relation kernels and the remaining force map in a row, streamed to an encoder.
+    """
+
+    def __init__(self, make_animation_attention_map, scale=32, interval=300,
+                 encoder=ffmpeg_command):
+        self.anim = make_animation_attention_map
+        self.scale = scale
+        self.interval = interval
+        self.encoder = encoder  # For FrameWriter
+
+        self.text = TextRasterizer()
+
+    def render(self, dir_save='./test_engagement'):
+        if not os.path.exists(dir_save):
+            os.mkdir(dir_save)
+
+        num_kernels = len(self.anim.attention_maps)
+        grid_size = self.anim.battlefield.shape[0]
+
+        canvas = PanelCanvas(self.text, num_panels=num_kernels + 1, grid_size=grid_size,
+                             scale=self.scale, num_text_lines=1)
+        canvas.set_titles(
+            ['relation kernel-' + str(relation_kernel) + ':  head_0:red,  head_1:green'
+             for relation_kernel in range(num_kernels)] + ['remaining force'])
+
+        num_frames = min([len(maps) for maps in self.anim.attention_maps] +
+                         [len(self.anim.rgb_channel_forces_obs)])
+
+        writer = FrameWriter(dir_save + '/agent_obs_attention_heads.mp4',
+                             canvas.width, canvas.height, self.interval, encoder=self.encoder)
+
+        try:
+            for step in range(num_frames):
+                canvas.new_frame()
+
+                for relation_kernel in range(num_kernels):
+                    canvas.put_panel(relation_kernel,
+                                     self.anim.attention_maps[relation_kernel][step])
+                canvas.put_panel(num_kernels, self.anim.rgb_channel_forces_obs[step])
+
+                canvas.put_text(0, 0, 'time:' + str(np.round(self.anim.dt * step, 2)) + ' sec')
+
+                writer.write(canvas.frame)
+
+        finally:
+            writer.close()
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class FrameStack:
+    """
+    n_frames stacking of the observations of the alive agents of K envs, held in one preallocated
+    array (K,n,g,g,ch*2*n_frames), n=max_num_agents.
+
+    Rows of k-th env are its alive agents in the order of alive_agents_ids, and the rows of the
+    dead and dummy agents are zeros, as make_padded_obs. A new frame is written to its channel
+    slot and to the mirror slot n_frames later, so that the last n_frames frames (oldest first, as
+    np.concatenate of the deque of frames) are always a contiguous window of the channels.
+    states is a view of the window: the padded states of the envs, (K,n,g,g,ch*n_frames).
+
+    The envs step in lockstep: advance() once per step, then append() of each stepped env.
+    Agents joining during the episode (battlefield_strategy_add_agents) start with n_frames copies
+    of their first observation, as reset().
+    """
+
+    def __init__(self, num_envs, max_num_agents, obs_shape, n_frames):
+        """ obs_shape: (g,g,ch), shape of an observation of an agent """
+        self.channels = obs_shape[-1]
+        self.n_frames = n_frames
+
+        self.buffer = np.zeros((num_envs, max_num_agents) + tuple(obs_shape[:-1]) +
+                               (self.channels * 2 * n_frames,), dtype=np.float32)
+
+        self.head = n_frames - 1  # slot of the newest frame, window: slots head+1,...,head+n_frames
+        self.alive_agents_ids = [[] for _ in range(num_envs)]
+
+    @property
+    def states(self):
+        """ (K,n,g,g,ch*n_frames), view of the buffer, valid until the next advance() """
+        start = (self.head + 1) * self.channels
+        return self.buffer[..., start:start + self.channels * self.n_frames]
+
+    def reset(self, k, alive_agents_ids, observations):
+        """
+        Initial observations of k-th env, stacked n_frames times
+        :param observations: [(g,g,ch),...] or (a,g,g,ch), of alive_agents_ids, a=num_alive_agents
+        """
+        self.alive_agents_ids[k] = list(alive_agents_ids)
+        a = len(self.alive_agents_ids[k])
+
+        self.buffer[k, a:] = 0
+
+        if a > 0:
+            self.fill_rows(k, np.arange(a), np.asarray(observations))
+
+    def fill_rows(self, k, rows, observations):
+        """ All the slots of the rows of k-th env are set to the observations, (len(rows),g,g,ch) """
+        self.buffer[k, rows] = np.tile(observations, 2 * self.n_frames)
+
+    def advance(self):
+        """ Next step of the envs, call once per step before append() """
+        self.head = (self.head + 1) % self.n_frames
+
+    def append(self, k, alive_agents_ids, observations):
+        """
+        Next observations of k-th env, after advance()
+        :param alive_agents_ids: alive agents after the step, the previous alive agents and the
+                                 joined agents
+        :param observations: [(g,g,ch),...] or (a,g,g,ch), of alive_agents_ids
+        """
+        alive_agents_ids = list(alive_agents_ids)
+        joined_rows = []
+
+        # Drop the rows of the dead agents, and add the rows of the joined agents
+        if alive_agents_ids != self.alive_agents_ids[k]:
+            rows = []
+            prev_rows = []
+            for i, a in enumerate(alive_agents_ids):
+                if a in self.alive_agents_ids[k]:
+                    rows.append(i)
+                    prev_rows.append(self.alive_agents_ids[k].index(a))
+                else:
+                    joined_rows.append(i)
+
+            self.buffer[k, rows] = self.buffer[k, prev_rows]
+            self.buffer[k, len(alive_agents_ids):] = 0
+
+            self.alive_agents_ids[k] = alive_agents_ids
+
+        a = len(alive_agents_ids)
+        if a == 0:
+            return
+
+        # The newest frame is the last slot of the window, the mirror slot is in the later windows
+        start = (self.head + self.n_frames) * self.channels
+        self.buffer[k, :a, ..., start:start + self.channels] = observations
+
+        if self.n_frames > 1:
+            mirror = self.head * self.channels
+            self.buffer[k, :a, ..., mirror:mirror + self.channels] = \
+                self.buffer[k, :a, ..., start:start + self.channels]
+
+        if len(joined_rows) > 0:
+            self.fill_rows(k, joined_rows, np.asarray(observations)[joined_rows])
+
+    def gather(self, k, agents_ids):
+        """
+        States of k-th env in the order of agents_ids, zeros for the agents not alive,
+        as make_next_states_for_q and make_padded_obs
+        :return: (n,g,g,ch*n_frames), a copy
+        """
+        states = self.states[k]
+        gathered = np.zeros(states.shape, dtype=np.float32)
+
+        for i, a in enumerate(agents_ids):
+            if a in self.alive_agents_ids[k]:
+                gathered[i] = states[self.alive_agents_ids[k].index(a)]
+
+        return gathered
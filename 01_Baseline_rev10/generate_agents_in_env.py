@@ -1,9 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 from config import Config
 # from generate_env import random_shape_maze
-from agents_in_env import BLUE, RED
+from agents_in_env import BLUE, RED, AgentTeam
 from utils import summary_of_team, simulate_lanchester, \
     plot_force_history, plot_efficiency_history, \
     visualize_blues_num_map, visualize_reds_num_map, visualize_battlefield_agents_num_map
@@ -124,6 +123,9 @@ def generate_blue_team(agent_class, config, battlefield):
     for agent in agents:
         agent.pos = allocate_blue_pos(battlefield, config.offset)
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
@@ -179,11 +181,15 @@ def generate_red_team(agent_class, config, battlefield, blues):
     for agent in agents:
         agent.pos = allocate_red_pos(battlefield, blues, config.offset)
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
 def main():
     """ Define configuration """
+    import matplotlib.pyplot as plt
 
     config = Config()
 
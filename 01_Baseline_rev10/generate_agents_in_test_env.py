@@ -1,9 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 from test_config import Config
 # from generate_env import random_shape_maze
-from agents_in_env import BLUE, RED
+from agents_in_env import BLUE, RED, AgentTeam
 from utils import summary_of_team, simulate_lanchester, \
     plot_force_history, plot_efficiency_history, \
     visualize_blues_num_map, visualize_reds_num_map, visualize_battlefield_agents_num_map
@@ -97,6 +96,11 @@ def generate_blue_team(agent_class, config, battlefield):
     for i, agent in enumerate(agents):
         agent.pos = config.blue_pos[i]
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    # AgentTeam copies the positions, so config.blue_pos is not moved by the episode and every
+    # episode of the scenario starts from the same positions
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
@@ -151,11 +155,18 @@ def generate_red_team(agent_class, config, battlefield, blues):
     for i, agent in enumerate(agents):
         agent.pos = config.red_pos[i]
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    # AgentTeam copies the positions, so config.red_pos is not moved by the episode and every
+    # episode of the scenario starts from the same positions
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
 def main():
     """ Define configuration """
+    import matplotlib.pyplot as plt
+
     config = Config()
     config.reset()
 
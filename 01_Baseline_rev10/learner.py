@@ -1,3 +1,4 @@
+import time
 from pathlib import Path
 
 import numpy as np
@@ -6,15 +7,29 @@ import tensorflow as tf
 
 from battlefield_strategy_rev10 import BattleFieldStrategy
 from models import MarlTransformerModel
+from prefetcher import MinibatchPrefetcher, block_to_tensors
+from replay_server import split_minibatchs
 from utils_transformer import make_mask, make_padded_obs, make_next_states_for_q
 
 
 # @ray.remote
 @ray.remote(num_cpus=1, num_gpus=1)
 class Learner:
-    def __init__(self):
+    def __init__(self, replay_shards=None):
         self.env = BattleFieldStrategy()
 
+        # ReplayServer shards to pull minibatchs from, None if the driver sends the minibatchs
+        self.replay_shards = []  # [(shard, num_minibatchs of the shard),...]
+        self.prefetcher = None  # MinibatchPrefetcher, started at the first update
+
+        if replay_shards is not None:
+            num_minibatchs_per_shard = \
+                split_minibatchs(self.env.config.num_minibatchs, len(replay_shards))
+
+            self.replay_shards = [(shard, num_minibatchs) for shard, num_minibatchs
+                                  in zip(replay_shards, num_minibatchs_per_shard)
+                                  if num_minibatchs > 0]
+
         self.action_space_dim = self.env.action_space.n
         self.gamma = self.env.config.gamma
 
@@ -26,6 +41,25 @@ class Learner:
 
         self.count = self.env.config.n0 + 1
 
+        # Compiled update with fixed input signature, (num_minibatchs,batch,...)
+        n = self.env.config.max_num_red_agents
+        obs_shape = (self.env.config.grid_size,
+                     self.env.config.grid_size,
+                     self.env.config.observation_channels * self.env.config.n_frames)
+
+        self.train_step = tf.function(
+            self.fused_update,
+            input_signature=[
+                tf.TensorSpec(shape=(None, None, n) + obs_shape, dtype=tf.float32),  # states
+                tf.TensorSpec(shape=(None, None, n), dtype=tf.int32),  # actions
+                tf.TensorSpec(shape=(None, None), dtype=tf.float32),  # rewards
+                tf.TensorSpec(shape=(None, None), dtype=tf.float32),  # dones
+                tf.TensorSpec(shape=(None, None, n), dtype=tf.float32),  # masks
+                tf.TensorSpec(shape=(None, None, n) + obs_shape, dtype=tf.float32),  # next_q
+                tf.TensorSpec(shape=(None, None), dtype=tf.float32),  # correction_weights
+                tf.TensorSpec(shape=(), dtype=tf.float32),  # tau of target update
+            ])
+
     def define_network(self):
         """
         Q-network, Target_networkを定義し、current weightsを返す
@@ -66,158 +100,180 @@ class Learner:
         # Q networkの重みをTarget networkにコピー
         self.target_q_network.set_weights(current_weights)
 
+        # Create optimizer variables before the compiled update (not allowed in its loop)
+        self.optimizer.build(self.q_network.trainable_variables)
+
         return current_weights
 
-    def update_network(self, minibatchs):
-        """
-        minicatchsを使ってnetworkを更新
-        minibatchs = [minibatch,...], len=16(default)
-
-        minibatch = [sampled_indices, correction_weights, experiences], batch_size=32(default)
-            - sampled_indices: [int,...], len = batch_size
-            - correction_weights: Importance samplingの補正用重み, (batch_size,), ndarray
-            - experiences: [experience,...], len=batch_size
-                experience =
-                        (
-                            self.padded_states,  # (1,n,g,g,ch*n_frames)
-                            padded_actions,  # (1,n)
-                            (team_)reward,  # float
-                            next_padded_states,  # (1,n,g,g,ch*n_frames)
-                            (team_)done,  # bool
-                            self.mask,  # (1,n), bool
-                            next_mask,  # (1,n), bool
-                            next_padded_states_for_q,  # (1,n,g,g,ch*n_frames)
-                            alive_agents_ids,  # (1,a), a=num_alive_agent, object
-                        )
-
-                ※ experience.states等で読み出し
+    def update_minibatch(self, states, actions, rewards, dones, masks, next_states_for_q,
+                         correction_weights):
+        """
+        One gradient step of a minibatch, in graph
+        :return:
+            masked_priority_td_errors: (32,)
+            loss: ()
+        """
+        # Target valueの計算
+        next_q_logits, _ = \
+            self.target_q_network(next_states_for_q, masks, training=False)  # (32,n,5)
+        next_actions = tf.argmax(next_q_logits, axis=-1)  # (32,n)
+        next_actions = tf.cast(next_actions, dtype=tf.int32)
+        next_actions_one_hot = \
+            tf.one_hot(next_actions, depth=self.action_space_dim)  # (32,n,5)
+
+        next_maxQ = next_q_logits * next_actions_one_hot  # (32,n,5)
+        next_maxQ = tf.reduce_sum(next_maxQ, axis=-1)  # (32,n)
+
+        next_maxQ = next_maxQ * masks  # (32,n)
+        next_maxQ = tf.reduce_sum(next_maxQ, axis=1)  # (32,)
+
+        TQ = rewards + self.gamma * (1 - dones) * next_maxQ  # (32,)
+
+        # ロス計算
+        with tf.GradientTape() as tape:
+            q_logits, _ = self.q_network(states, masks, training=True)  # (32,n,5)
+            actions_one_hot = tf.one_hot(actions, depth=self.action_space_dim)  # (32,n,5)
+
+            Q = q_logits * actions_one_hot  # (32,n,5)
+            Q = tf.reduce_sum(Q, axis=-1)  # (32,n)
+
+            Q = Q * masks  # (32,n)
+            Q = tf.reduce_sum(Q, axis=1)  # (32,)
+
+            masked_td_errors = tf.square(TQ - Q)  # (32,)
+
+            masked_td_errors = \
+                masked_td_errors / tf.reduce_sum(masks, axis=-1)  # (32,)
 
+            loss = tf.reduce_mean(correction_weights * masked_td_errors) * \
+                   self.env.config.loss_coef
+
+        # 勾配計算と更新
+        grads = tape.gradient(loss, self.q_network.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 40)
+
+        self.optimizer.apply_gradients(zip(grads, self.q_network.trainable_variables))
+
+        # Priority update
+        masked_priority_td_errors = tf.abs(TQ - Q) / tf.reduce_sum(masks, axis=-1)  # (32,)
+
+        return masked_priority_td_errors, loss
+
+    def update_target_network(self, tau):
+        """
+        Target networkのweights更新, in graph (no host copy of the weights)
+        tau: config.tau for soft update, 1.0 for hard update, 0.0 for no update
+        """
+        for target_weight, weight in zip(self.target_q_network.weights, self.q_network.weights):
+            target_weight.assign(tau * weight + (1. - tau) * target_weight)
+
+    def fused_update(self, states, actions, rewards, dones, masks, next_states_for_q,
+                     correction_weights, tau):
+        """
+        update_minibatch of all minibatchs in an on-graph loop, and the target network update,
+        compiled by tf.function
+        inputs: (num_minibatchs,batch,...), tau: ()
         :return:
-            current_weights: 最新のnetwork weights
-            indices_all: ミニバッチに含まれるデータのインデクス, [int,...], len=batch*16(default)
-            td_errors_all: ミニバッチに含まれるデータのTD error, [(batch,n),...], len=16(default)
-        """
-        indices_all = []
-        td_errors_all = []
-        losses = []
-
-        for (indices, correction_weights, experiences) in minibatchs:
-            # indices:list, len=32; correction_weights: ndarray, (32,1); experiences: lsit, len=32
-            # experiencesをnetworkに入力するshapeに変換
-
-            # process in minibatch
-            states = []
-            actions = []
-            rewards = []
-            next_states = []
-            dones = []
-            masks = []
-            next_masks = []
-            next_states_for_q = []
-            alive_agents_ids = []
-
-            for i in range(len(experiences)):
-                states.append(experiences[i].states)
-                actions.append(experiences[i].actions)
-                rewards.append(experiences[i].reward)
-                next_states.append(experiences[i].next_states)
-                dones.append(experiences[i].done)
-                masks.append(experiences[i].masks)
-                next_masks.append(experiences[i].next_masks)
-                next_states_for_q.append(experiences[i].next_states_for_q)
-                alive_agents_ids.append(experiences[i].alive_agents_ids)
-
-            # list -> ndarray
-            states = np.vstack(states)  # (batch,n,g,g,ch*n_frames)=(32,n,20,20,16)
-            actions = np.vstack(actions)  # (batch,n)=(32,n)
-            rewards = np.array(rewards)  # (32,)
-            next_states = np.vstack(next_states)  # (32,n,20,20,16)
-            dones = np.array(dones)  # (32,), bool
-            masks = np.vstack(masks)  # (32,n), bool
-            next_masks = np.vstack(next_masks)  # (32,n), bool
-            next_states_for_q = np.vstack(next_states_for_q)  # (32,n,20,20,16)
-
-            # ndarray -> tf.Tensor
-            states = tf.convert_to_tensor(states, dtype=tf.float32)  # (32,n,20,20,16)
-            actions = tf.convert_to_tensor(actions, dtype=tf.int32)  # (32,n)
-            rewards = tf.convert_to_tensor(rewards, dtype=tf.float32)  # (32,)
-            next_states = tf.convert_to_tensor(next_states, dtype=tf.float32)  # (32,n,20,20,16)
-            dones = tf.convert_to_tensor(dones, dtype=tf.float32)  # (32,), bool->float32
-            masks = tf.convert_to_tensor(masks, dtype=tf.float32)  # (32,n), bool->float32
-            next_masks = \
-                tf.convert_to_tensor(next_masks, dtype=tf.float32)  # (32,n), bool->float32
-            next_states_for_q = \
-                tf.convert_to_tensor(next_states_for_q, dtype=tf.float32)  # (32,n,20,20,16)
-
-            # Target valueの計算
-            next_q_logits, _ = \
-                self.target_q_network(next_states_for_q, masks, training=False)  # (32,n,5)
-            next_actions = tf.argmax(next_q_logits, axis=-1)  # (32,n)
-            next_actions = tf.cast(next_actions, dtype=tf.int32)
-            next_actions_one_hot = \
-                tf.one_hot(next_actions, depth=self.action_space_dim)  # (32,n,5)
-
-            next_maxQ = next_q_logits * next_actions_one_hot  # (32,n,5)
-            next_maxQ = tf.reduce_sum(next_maxQ, axis=-1)  # (32,n)
-
-            next_maxQ = next_maxQ * masks  # (32,n)
-            next_maxQ = tf.reduce_sum(next_maxQ, axis=1)  # (32,)
-
-            TQ = rewards + self.gamma * (1 - dones) * next_maxQ  # (32,)
-
-            # ロス計算
-            with tf.GradientTape() as tape:
-                q_logits, _ = self.q_network(states, masks, training=True)  # (32,n,5)
-                actions_one_hot = tf.one_hot(actions, depth=self.action_space_dim)  # (32,n,5)
-
-                Q = q_logits * actions_one_hot  # (32,n,5)
-                Q = tf.reduce_sum(Q, axis=-1)  # (32,n)
-
-                Q = Q * masks  # (32,n)
-                Q = tf.reduce_sum(Q, axis=1)  # (32,)
-
-                masked_td_errors = tf.square(TQ - Q)  # (32,)
-
-                masked_td_errors = \
-                    masked_td_errors / tf.reduce_sum(masks, axis=-1)  # (32,)
-
-                loss = tf.reduce_mean(correction_weights * masked_td_errors) * \
-                       self.env.config.loss_coef
-
-                losses.append(loss.numpy())
-
-            # 勾配計算と更新
-            grads = tape.gradient(loss, self.q_network.trainable_variables)
-            grads, _ = tf.clip_by_global_norm(grads, 40)
-
-            self.optimizer.apply_gradients(zip(grads, self.q_network.trainable_variables))
-
-            # Compute priority update
-            if self.env.config.prioritized_replay:
-                masked_priority_td_errors = np.abs((TQ - Q).numpy())  # (32,)
-                masked_priority_td_errors = \
-                    masked_priority_td_errors / np.sum(masks.numpy(), axis=-1)  # (32,)
-
-            else:
-                masked_priority_td_errors = np.ones((self.env.config.batch_size,),
-                                                    dtype=np.float32)  # (32,)
-
-            # learnerの学習に使用した経験のインデクスとTD-errorのリスト
-            indices_all += indices
-            td_errors_all += masked_priority_td_errors.tolist()  # len=32のリストに変換
-
-        # 最新のネットワークweightsをget
-        current_weights = self.q_network.get_weights()
+            td_errors: (num_minibatchs,batch)
+            losses: (num_minibatchs,)
+        """
+        num_minibatchs = tf.shape(states)[0]
+
+        td_errors = tf.TensorArray(dtype=tf.float32, size=num_minibatchs)
+        losses = tf.TensorArray(dtype=tf.float32, size=num_minibatchs)
+
+        for m in tf.range(num_minibatchs):
+            td_error, loss = self.update_minibatch(
+                states[m], actions[m], rewards[m], dones[m], masks[m], next_states_for_q[m],
+                correction_weights[m])
+
+            td_errors = td_errors.write(m, td_error)
+            losses = losses.write(m, loss)
+
+        self.update_target_network(tau)
+
+        return td_errors.stack(), losses.stack()
 
-        # Target networkのweights更新: Soft update
-        target_weights = self.target_q_network.get_weights()
+    def get_target_update_tau(self):
+        """
+        target_update_interval=0: soft update by tau at every update cycle
+        target_update_interval=K: hard update (tau=1) every K update cycles, otherwise no update
+        """
+        if self.env.config.target_update_interval == 0:
+            return self.env.config.tau
+
+        if self.count % self.env.config.target_update_interval == 0:
+            return 1.0
+
+        return 0.0
+
+    def update_network(self, minibatch_block):
+        """
+        minibatch_blockを使ってnetworkを更新
+        minibatch_block: MinibatchBlock of num_minibatchs(=30) minibatchs of batch_size(=32)
+            indices: (30,32), sampled_indices
+            correction_weights: (30,32), Importance samplingの補正用重み
+            states: (30,32,n,g,g,ch*n_frames), actions: (30,32,n), rewards: (30,32),
+            dones: (30,32), masks: (30,32,n), next_states_for_q: (30,32,n,g,g,ch*n_frames)
+
+        :return:
+            current_weights: 最新のnetwork weights, None if the broadcast to actors is not due
+            indices_all: ミニバッチに含まれるデータのインデクス, [int,...], len=batch*30(default)
+            td_errors_all: ミニバッチに含まれるデータのTD error, [float,...], len=batch*30(default)
+            mean_loss
+            stats: telemetry of the update, {'data_prep_time', 'train_time',
+                   'weights_export_time', 'block_bytes'}
+        """
+        prep_start = time.time()
+
+        indices_all = minibatch_block.indices.reshape(-1).tolist()  # learnerの学習に使用した経験
+        tensors = block_to_tensors(minibatch_block)
+
+        return self.train_on_tensors(indices_all, tensors, data_prep_time=time.time() - prep_start)
+
+    def train_on_tensors(self, indices_all, tensors, data_prep_time):
+        """
+        Compiled update of all minibatchs
+        :param tensors: block_to_tensors of the MinibatchBlock
+        :param data_prep_time: sec to make the tensors ready, for telemetry
+        :return: same as update_network
+        """
+        train_start = time.time()
+
+        td_errors, losses = self.train_step(
+            *tensors,
+            tf.constant(self.get_target_update_tau(), dtype=tf.float32),
+        )  # (30,32), (30,)
+
+        losses = losses.numpy()  # (30,), wait for the forward/backward
+        train_time = time.time() - train_start
 
-        for w in range(len(target_weights)):
-            target_weights[w] = \
-                self.env.config.tau * current_weights[w] + \
-                (1. - self.env.config.tau) * target_weights[w]
+        # Compute priority update
+        if self.env.config.prioritized_replay:
+            masked_priority_td_errors = td_errors.numpy()  # (30,32)
+        else:
+            masked_priority_td_errors = np.ones(td_errors.shape, dtype=np.float32)  # (30,32)
 
-        self.target_q_network.set_weights(target_weights)
+        # learnerの学習に使用した経験のTD-errorのリスト
+        td_errors_all = masked_priority_td_errors.reshape(-1).tolist()  # len=30*32のリスト
+
+        loss = losses[-1]
+
+        # 最新のネットワークweightsをget, only when the broadcast to actors is due
+        export_start = time.time()
+
+        if self.count % self.env.config.weights_broadcast_interval == 0:
+            current_weights = self.q_network.get_weights()
+        else:
+            current_weights = None
+
+        stats = {
+            'data_prep_time': data_prep_time,
+            'train_time': train_time,
+            'weights_export_time': time.time() - export_start,
+            'block_bytes': sum([tensor.shape.num_elements() * tensor.dtype.size
+                                for tensor in tensors]),
+        }
 
         # Save model
         if self.count % 100 == 0:
@@ -228,4 +284,39 @@ class Learner:
 
         self.count += 1
 
-        return current_weights, indices_all, td_errors_all, np.mean(loss)
+        return current_weights, indices_all, td_errors_all, np.mean(loss), stats
+
+    def update_network_from_replay(self):
+        """
+        Update the network by a MinibatchBlock prefetched from the ReplayServer shards, and send
+        the priorities back to each shard without waiting.
+
+        :return:
+            current_weights: 最新のnetwork weights, None if the broadcast to actors is not due
+            None, None: the priorities are already sent to the shards
+            mean_loss
+            stats: same as update_network, data_prep_time is the wait for the prefetcher
+        """
+        if self.prefetcher is None:
+            self.prefetcher = MinibatchPrefetcher(
+                replay_shards=self.replay_shards,
+                batch_size=self.env.config.batch_size,
+                prefetch_depth=self.env.config.prefetch_depth)
+
+        prep_start = time.time()
+
+        indices_all, tensors = self.prefetcher.get()
+
+        current_weights, indices_all, td_errors_all, mean_loss, stats = \
+            self.train_on_tensors(indices_all, tensors, data_prep_time=time.time() - prep_start)
+
+        # 各shardの優先度更新, indices_all is ordered by the shards
+        start = 0
+        for shard, num_minibatchs in self.replay_shards:
+            end = start + num_minibatchs * self.env.config.batch_size
+
+            shard.update_priority.remote(indices_all[start:end], td_errors_all[start:end])
+
+            start = end
+
+        return current_weights, None, None, mean_loss, stats
@@ -13,8 +13,12 @@ from pathlib import Path
 
 from config import Config
 from actor import Actor
+from inference_server import InferenceServer
 from replay import Replay
+from replay_server import ReplayServer
 from learner import Learner
+from rate_limiter import RateLimiter
+from telemetry import Telemetry
 from tester import Tester
 
 
@@ -24,6 +28,8 @@ def write_config(config):
     """
     config_list = {
         'max_episodes_test_play': config.max_episodes_test_play,
+        'num_testers': config.num_testers,
+        'sequential_test': config.sequential_test,
         'grid_size': config.grid_size,
         'offset': config.offset,
 
@@ -32,8 +38,8 @@ def write_config(config):
         'n_frames': config.n_frames,
 
         'capacity': config.capacity,
-        'compress': config.compress,
         'prioritized_replay': config.prioritized_replay,
+        'num_replay_shards': config.num_replay_shards,
 
         'hidden_dim': config.hidden_dim,
         'key_dim': config.key_dim,
@@ -41,12 +47,22 @@ def write_config(config):
         'dropout_rate': config.dropout_rate,
 
         'actor_rollout_steps': config.actor_rollout_steps,
+        'num_envs_per_actor': config.num_envs_per_actor,
+        'use_inference_server': config.use_inference_server,
+        'inference_max_batch_size': config.inference_max_batch_size,
+        'inference_timeout': config.inference_timeout,
         'num_update_cycles': config.num_update_cycles,
         'actor_rollouts_before_train': config.actor_rollouts_before_train,
         'batch_size': config.batch_size,
         'num_minibatchs': config.num_minibatchs,
+        'samples_per_insert': config.samples_per_insert,
+        'samples_per_insert_tolerance': config.samples_per_insert_tolerance,
+        'telemetry_interval': config.telemetry_interval,
+        'prefetch_depth': config.prefetch_depth,
 
         'tau': config.tau,
+        'target_update_interval': config.target_update_interval,
+        'weights_broadcast_interval': config.weights_broadcast_interval,
         'gamma': config.gamma,
 
         'max_steps': config.max_steps,
@@ -107,87 +123,205 @@ def main(num_actors=8):
 
     write_config(config)
 
-    # actorのインスタンスをnum_actors個生成
-    epsilons = np.linspace(0.01, 0.5, num_actors)
-    actors = [Actor.remote(pid=i, epsilon=epsilons[i]) for i in range(num_actors)]
+    # Replay bufferをインスタンス化
+    # num_replay_shards>0: ReplayServerのshards. Actorsが直接追加し、learnerが直接sampleする
+    replay = None
+    replay_shards = None
+
+    if config.num_replay_shards > 0:
+        if num_actors < config.num_replay_shards:
+            raise ValueError()  # Every shard needs an actor to push rollouts
+
+        replay_shards = [
+            ReplayServer.remote(shard_id=j,
+                                buffer_size=config.capacity // config.num_replay_shards)
+            for j in range(config.num_replay_shards)]
+    else:
+        replay = Replay(buffer_size=config.capacity)
 
     # learnerをインスタンス化し、define_network()メソッドにより、current_weightsを取得し、ray.put
-    learner = Learner.remote()
+    learner = Learner.remote(replay_shards=replay_shards)
     current_weights = ray.get(learner.define_network.remote())
+    weights_bytes = sum([w.nbytes for w in current_weights])
     current_weights = ray.put(current_weights)
 
-    # Replay bufferをインスタンス化
-    replay = Replay(buffer_size=config.capacity, compress=config.compress)
+    # InferenceServerを使う場合、weightsはserverのみに渡し、actorには渡さない
+    inference_server = None
+    actor_weights = current_weights
+
+    if config.use_inference_server:
+        inference_server = InferenceServer.remote()
+        ray.get(inference_server.set_weights.remote(current_weights))
+        actor_weights = None
+
+    # actorのインスタンスをnum_actors個生成
+    epsilons = np.linspace(0.01, 0.5, num_actors)
+    actors = [Actor.remote(pid=i, epsilon=epsilons[i], inference_server=inference_server,
+                           replay_shard=None if replay is not None
+                           else replay_shards[i % config.num_replay_shards])
+              for i in range(num_actors)]
 
     # testerをインスタンス化
     tester = Tester.remote()
 
     # actor.rollout() のobject refsのリストを定義
-    wip_actors = [actor.rollout.remote(current_weights) for actor in actors]
+    wip_actors = [actor.rollout.remote(actor_weights) for actor in actors]
 
     # まず、ある程度の経験を収集するために50回のactor.rollout()の結果を1 rollout分づつ取得し、replayに追加
     for _ in range(config.actor_rollouts_before_train):
         finished_actor, wip_actors = ray.wait(wip_actors, num_returns=1)  # 処理が終了したObjctRefを1つ取得
-        td_errors, transitions, pid = ray.get(finished_actor[0])  # ObjectRefから結果を取得
-        replay.add(td_errors, transitions)  # Replayに追加
-        wip_actors.extend([actors[pid].rollout.remote(current_weights)])  # 新しいobject refsを追加
+        td_errors, transitions, pid, _ = ray.get(finished_actor[0])  # ObjectRefから結果を取得
+        if replay is not None:
+            replay.add(td_errors, transitions)  # Replayに追加
+        wip_actors.extend([actors[pid].rollout.remote(actor_weights)])  # 新しいobject refsを追加
 
-    # learner.update_networkでネットワーク更新のObjectRefを定義
-    # batch_size=self.batch_size（=32）の minibatch を self.num_minibatchs個（=5）生成
-    #   minibatch=[sampled_indices, weights, experiences]
-    minibatchs = [replay.sample(batch_size=config.batch_size) for _ in range(config.num_minibatchs)]
+    if replay is None:
+        # 全shardに経験が追加されるまで待つ (actorからのaddは非同期)
+        while min(ray.get([shard.get_num_adds.remote() for shard in replay_shards])) == 0:
+            time.sleep(0.01)
 
-    wip_learner = learner.update_network.remote(minibatchs=minibatchs)  # network更新  ObjectRef
+        # learnerがshardsから直接minibatchsをprefetchしてネットワーク更新
+        minibatch_block = None
 
-    minibatchs = [replay.sample(batch_size=config.batch_size) for _ in
-                  range(config.num_minibatchs)]  # 次のミニバッチを用意
-
-    # test実施
-    wip_tester = tester.test_play.remote(current_weights, epsilon=0.0)
+    else:
+        # learner.update_networkに渡すminibatch_blockを用意
+        # batch_size=self.batch_size（=32）の minibatch を self.num_minibatchs個（=30）生成
+        #   minibatch_block: MinibatchBlock, (num_minibatchs,batch_size,...)
+        minibatch_block = replay.sample_block(batch_size=config.batch_size,
+                                              num_minibatchs=config.num_minibatchs)
 
     # while iteration
     update_cycles = config.n0 + 1
     actor_cycles = config.actor_cycles  # Actorが経験をReplayに渡した回数
     test_cycles = update_cycles
 
+    # test実施
+    wip_tester = tester.test_play.remote(current_weights, epsilon=0.0, test_cycles=test_cycles)
+
+    # 実行中の全roleのObjectRef, {ObjectRef: role}
+    wip_refs = {ref: 'actor' for ref in wip_actors}
+    wip_refs[wip_tester] = 'tester'
+
+    # Replay ratio controller, actor rollouts and learner updates are dispatched when allowed
+    num_envs = config.num_envs_per_actor
+    rate_limiter = RateLimiter(
+        samples_per_insert=config.samples_per_insert,
+        tolerance=config.samples_per_insert_tolerance,
+        samples_per_update=config.batch_size * config.num_minibatchs,
+        inserts_per_rollout=int(np.ceil(config.actor_rollout_steps / num_envs)) * num_envs)
+
+    for _ in wip_actors:
+        rate_limiter.insert()
+
+    # Rate limitingで待機中のrole, 待機開始時刻
+    idle_actors = {}  # {pid: time}
+    learner_idle_since = time.time()  # None if the learner is running
+    actor_throttled_time = 0.  # sum of the actors
+    learner_throttled_time = 0.
+
+    # Throughput telemetry, written to TensorBoard every telemetry_interval learner cycles
+    telemetry = Telemetry(num_actors=num_actors,
+                          samples_per_update=config.batch_size * config.num_minibatchs,
+                          inserts_per_add=rate_limiter.inserts_per_rollout)
+    telemetry.add_in_flight('weights', weights_bytes)
+
+    # Driverのidle time (ray.waitでblock) と busy time (各roleの処理)
+    idle_time = 0.
+    busy_time = 0.
+
     while update_cycles <= config.num_update_cycles:
 
-        # actorのrolloutが終了していれば結果をget
-        finished_actor, wip_actors = ray.wait(wip_actors, num_returns=1, timeout=0)
+        # 待機中のactorとlearnerを、rate_limiterが許す範囲でdispatch
+        dispatch_time = time.time()
 
-        if finished_actor:
-            td_errors, transitions, pid = ray.get(finished_actor[0])
+        for pid in list(idle_actors):
+            if not rate_limiter.can_insert():
+                break
 
-            # 結果をreplayに追加
-            replay.add(td_errors, transitions)
+            actor_throttled_time += dispatch_time - idle_actors.pop(pid)
 
-            # 新しいactor.rollout()のObjectRefを追加
-            wip_actors.extend([actors[pid].rollout.remote(current_weights)])
+            wip_refs[actors[pid].rollout.remote(actor_weights)] = 'actor'
+            rate_limiter.insert()
 
-            actor_cycles += 1
+        if (learner_idle_since is not None) and rate_limiter.can_sample():
+            learner_throttled_time += dispatch_time - learner_idle_since
+            learner_idle_since = None
+
+            if replay is None:
+                wip_learner = learner.update_network_from_replay.remote()
+            else:
+                wip_learner = learner.update_network.remote(minibatch_block=minibatch_block)
+                telemetry.add_in_flight(wip_learner, minibatch_block.nbytes)
+            wip_refs[wip_learner] = 'learner'
+            rate_limiter.sample()
+
+            # 次のminibatch setを用意 (ReplayServerの場合はlearnerが直接実施)
+            if replay is not None:
+                sample_start = time.time()
+                minibatch_block = replay.sample_block(batch_size=config.batch_size,
+                                                      num_minibatchs=config.num_minibatchs)
+                telemetry.record_replay('sample', time.time() - sample_start)
 
-        # Learnerのタスク完了結果を取得。未終了時は、finished_learner=[]が返る
-        finished_learner, _ = ray.wait([wip_learner], timeout=0)
+        busy_time += time.time() - dispatch_time
 
-        if finished_learner:
-            # current weightをlearner.update_network()から取得
-            current_weights, indices, td_errors, mean_loss = \
-                ray.get(finished_learner[0])
+        # いずれかのroleのタスクが終了するまでblock
+        wait_start = time.time()
+        finished, _ = ray.wait(list(wip_refs), num_returns=1)
+
+        handler_start = time.time()
+        idle_time += handler_start - wait_start
+
+        finished_role = wip_refs.pop(finished[0])
+
+        # actorのrolloutが終了
+        if finished_role == 'actor':
+            td_errors, transitions, pid, actor_stats = ray.get(finished[0])
+            telemetry.add_actor(pid, actor_stats)
+
+            # 結果をreplayに追加, already pushed to the ReplayServer shard if replay is None
+            if replay is not None:
+                add_start = time.time()
+                replay.add(td_errors, transitions)
+                telemetry.record_replay('add', time.time() - add_start)
+
+            # 新しいactor.rollout()は、次のloopでrate_limiterが許せばdispatch
+            idle_actors[pid] = time.time()
+
+            actor_cycles += 1
+
+        # Learnerのタスクが終了
+        elif finished_role == 'learner':
+            # current weightをlearner.update_network()から取得, None if not broadcast cycle
+            new_weights, indices, td_errors, mean_loss, learner_stats = \
+                ray.get(finished[0])
+            telemetry.add_learner(learner_stats)
+            telemetry.remove_in_flight(finished[0])
 
             # print(f'mean_loss={mean_loss}')
 
-            # 新しいupdate_networkのObjectRefを追加
-            wip_learner = learner.update_network.remote(minibatchs=minibatchs)
+            # 新しいupdate_networkは、次のloopでrate_limiterが許せばdispatch
+            learner_idle_since = time.time()
 
             # current_weightをray.put
-            current_weights = ray.put(current_weights)
+            if new_weights is not None:
+                weights_bytes = sum([w.nbytes for w in new_weights])
+
+                put_start = time.time()
+                current_weights = ray.put(new_weights)
 
-            # replay bufferの優先度更新；replay.update_priority
-            replay.update_priprity(indices, td_errors)
+                if inference_server is None:
+                    actor_weights = current_weights
+                else:
+                    inference_server.set_weights.remote(current_weights)
 
-            # 次のminibatch setを用意
-            minibatchs = [replay.sample(batch_size=config.batch_size)
-                          for _ in range(config.num_minibatchs)]
+                telemetry.add_broadcast(weights_bytes, time.time() - put_start)
+                telemetry.add_in_flight('weights', weights_bytes)
+
+            # replay bufferの優先度更新 (ReplayServerの場合はlearnerが直接実施)
+            if replay is not None:
+                update_start = time.time()
+                replay.update_priprity(indices, td_errors)
+                telemetry.record_replay('update', time.time() - update_start)
 
             update_cycles += 1
 
@@ -195,11 +329,30 @@ def main(num_actors=8):
                 tf.summary.scalar("mean_loss of training", mean_loss, step=update_cycles)
                 tf.summary.scalar("actor_cycles", actor_cycles, step=update_cycles)
 
-        # Test process
-        finished_tester, _ = ray.wait([wip_tester], timeout=0)
+                tf.summary.scalar("driver_idle_time", idle_time, step=update_cycles)
+                tf.summary.scalar("driver_busy_time", busy_time, step=update_cycles)
+                tf.summary.scalar("driver_idle_ratio",
+                                  idle_time / max(idle_time + busy_time, 1e-8),
+                                  step=update_cycles)
+
+                tf.summary.scalar("samples_per_insert", rate_limiter.ratio(), step=update_cycles)
+                tf.summary.scalar("num_throttled_actors", len(idle_actors), step=update_cycles)
+                tf.summary.scalar("actor_throttled_time", actor_throttled_time,
+                                  step=update_cycles)
+                tf.summary.scalar("learner_throttled_time", learner_throttled_time,
+                                  step=update_cycles)
+
+            if update_cycles % config.telemetry_interval == 0:
+                if replay is None:
+                    for replay_stats in ray.get([shard.get_stats.remote()
+                                                 for shard in replay_shards]):
+                        telemetry.add_replay(replay_stats)
 
-        if finished_tester:
-            result = ray.get(finished_tester[0])
+                telemetry.write(summary_writer, step=update_cycles)
+
+        # Test process
+        elif finished_role == 'tester':
+            result = ray.get(finished[0])
             print(f"test_cycles={test_cycles}, test_score={result['episode_rewards']}, "
                   f"episode_len={result['episode_lens']}")
             history.append((test_cycles, result['episode_rewards']))
@@ -245,14 +398,24 @@ def main(num_actors=8):
                     "num_draw", result['draw'], step=test_cycles)
                 tf.summary.scalar(
                     "num_no_contest", result['no_contest'], step=test_cycles)
+                tf.summary.scalar(
+                    "num_test_episodes", result['num_test_episodes'], step=test_cycles)
 
             # 次のプロセスを準備
             test_cycles = update_cycles
 
-            wip_tester = tester.test_play.remote(current_weights, epsilon=0.0)
+            wip_tester = tester.test_play.remote(current_weights, epsilon=0.0,
+                                                 test_cycles=test_cycles)
+            wip_refs[wip_tester] = 'tester'
+
+        busy_time += time.time() - handler_start
 
     # 表示処理
     wallclocktime = round(time.time() - start, 2)
+    print(f'driver idle time: {round(idle_time, 2)} sec, busy time: {round(busy_time, 2)} sec')
+    print(f'samples per insert: {round(rate_limiter.ratio(), 2)}, '
+          f'actor throttled time: {round(actor_throttled_time, 2)} sec, '
+          f'learner throttled time: {round(learner_throttled_time, 2)} sec')
     cycles, scores = zip(*history)  # historyの中身を取り出す
 
     plt.plot(cycles, scores)
@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 import tensorflow as tf
 import os
@@ -155,5 +157,74 @@ def main():
     )
 
 
+
+def check_ragged_cnn(load_dir=None, batch_size=3, seed=0):
+    """
+    Check of config.ragged_cnn before turning it on: q_logits and scores of the ragged CNN path
+    equal those of the padded path, with the same weights and random inputs.
+    The masks have a partly dead row, an all-dead row and all-alive rows, in bool (actor, tester)
+    and float32 (learner). Both paths also build the graph of build_graph.
+    load_dir: checkpoint, e.g. './models/model_100/', also loaded and checked under both paths
+    :return: max abs diff of q_logits and scores
+    """
+    config = Config()
+    config.ragged_cnn = False
+
+    ragged_config = copy.copy(config)
+    ragged_config.ragged_cnn = True
+
+    n = config.max_num_red_agents
+    obs_shape = (config.grid_size, config.grid_size, config.observation_channels * config.n_frames)
+
+    rng = np.random.default_rng(seed)
+
+    mask = np.zeros((batch_size, n), dtype=bool)  # (b,n)
+    mask[0, rng.permutation(n)[:n // 2]] = True  # Partly dead, mask[1]: all dead
+    mask[2:] = True  # All alive
+
+    # Zeros of the dead and dummy agents, as make_padded_obs
+    padded_obs = rng.random((batch_size, n) + obs_shape).astype(np.float32) * \
+        mask[:, :, np.newaxis, np.newaxis, np.newaxis]  # (b,n,g,g,ch*n_frames)
+
+    padded_model = MarlTransformerModel(config=config)
+    ragged_model = MarlTransformerModel(config=ragged_config)
+
+    padded_model(padded_obs, mask, training=False)  # Build
+    ragged_model(padded_obs, mask, training=False)
+    ragged_model.set_weights(padded_model.get_weights())
+
+    def max_diff():
+        diffs = []
+        for m in [mask, mask.astype(np.float32)]:
+            q_logits, scores = padded_model(padded_obs, m, training=False)
+            ragged_q_logits, ragged_scores = ragged_model(padded_obs, m, training=False)
+
+            for x, y in zip([q_logits] + scores, [ragged_q_logits] + ragged_scores):
+                x = x.numpy()
+                y = y.numpy()
+
+                if not np.allclose(x, y, rtol=1e-5, atol=1e-6, equal_nan=True):
+                    raise ValueError()
+
+                diffs.append(np.nanmax(np.abs(x - y)))
+
+        return max(diffs)
+
+    diff = max_diff()
+
+    if load_dir is not None:
+        padded_model.load_weights(load_dir)
+        ragged_model.load_weights(load_dir)
+
+        diff = max(diff, max_diff())
+
+    padded_model.build_graph(mask[:1])
+    ragged_model.build_graph(mask[:1])
+
+    print(f'ragged_cnn check passed, max abs diff = {diff}')
+
+    return diff
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,55 @@
+class RateLimiter:
+    """
+    Replay ratio controller (Reverb SampleToInsertRatio style).
+    Keeps samples/inserts of the dispatched tasks around samples_per_insert, by allowing the
+    dispatch of actor rollouts (inserts) and learner updates (samples) only within the error
+    buffer:
+        diff = inserts * samples_per_insert - samples
+        insert is allowed if diff + inserts_per_rollout * samples_per_insert <= error_buffer
+        sample is allowed if diff - samples_per_update >= -error_buffer
+
+    error_buffer is tolerance learner cycles of samples, and at least the half of one insert
+    plus one update, so that either of them is always allowed (no deadlock).
+    samples_per_insert=0: no rate limiting, only counting.
+    """
+
+    def __init__(self, samples_per_insert, tolerance, samples_per_update, inserts_per_rollout):
+        self.samples_per_insert = samples_per_insert
+
+        self.samples_per_update = samples_per_update  # batch_size * num_minibatchs
+        self.inserts_per_rollout = inserts_per_rollout  # transitions of an actor rollout
+
+        self.error_buffer = max(
+            tolerance * samples_per_update,
+            (inserts_per_rollout * samples_per_insert + samples_per_update) / 2)
+
+        self.inserts = 0  # transitions of the dispatched rollouts
+        self.samples = 0  # transitions of the dispatched updates
+
+    def diff(self):
+        return self.inserts * self.samples_per_insert - self.samples
+
+    def can_insert(self):
+        if self.samples_per_insert <= 0:
+            return True
+
+        return self.diff() + self.inserts_per_rollout * self.samples_per_insert \
+            <= self.error_buffer
+
+    def can_sample(self):
+        if self.samples_per_insert <= 0:
+            return True
+
+        return self.diff() - self.samples_per_update >= -self.error_buffer
+
+    def insert(self):
+        """ Count an actor rollout dispatch """
+        self.inserts += self.inserts_per_rollout
+
+    def sample(self):
+        """ Count a learner update dispatch """
+        self.samples += self.samples_per_update
+
+    def ratio(self):
+        """ Samples per insert of the dispatched tasks """
+        return self.samples / max(self.inserts, 1)
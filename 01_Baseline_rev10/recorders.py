@@ -0,0 +1,32 @@
+class EnvRecorder:
+    """
+    Observer of the env, attached by BattleFieldStrategy.add_recorder().
+    The env calls on_reset at the end of reset() and on_step at the end of step().
+    No recorder is attached by default, so the hooks cost only a loop over an empty list in the
+    training actors.
+    """
+
+    def on_reset(self, env, observations):
+        pass
+
+    def on_step(self, env, actions, observations, reward, done):
+        pass
+
+
+class AnimationRecorder(EnvRecorder):
+    """
+    Makes env.make_animation and env.make_animation_attention_map of each episode for Tester.
+    The visualization modules (matplotlib) are imported only when this recorder is attached.
+    """
+
+    def __init__(self):
+        from generate_movies import MakeAnimation
+        from generate_movies_atention_map import MakeAnimation_AttentionMap
+
+        self.make_animation_class = MakeAnimation
+        self.make_animation_attention_map_class = MakeAnimation_AttentionMap
+
+    def on_reset(self, env, observations):
+        env.make_animation = self.make_animation_class(env)  # Animation generator
+        env.make_animation_attention_map = \
+            self.make_animation_attention_map_class(env)  # Attention map movie
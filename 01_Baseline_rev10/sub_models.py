@@ -116,6 +116,9 @@ class CNNModel(tf.keras.models.Model):
         # inputs: (b,n,g,g,ch*n_frames)=(1,17,20,20,16)
         # mask: (b,n)=(1,17), bool
 
+        if self.config.ragged_cnn:
+            return self.ragged_call(inputs, mask)
+
         h = self.conv0(inputs)  # (1,17,20,20,64)
         h = self.conv1(h)  # (1,17,9,9,64)
         h = self.conv2(h)  # (1,17,7,7,64)
@@ -135,6 +138,36 @@ class CNNModel(tf.keras.models.Model):
 
         return features
 
+    def ragged_call(self, inputs, mask):
+        """
+        The same CNN on the alive agents only: their observations are packed to a batch of
+        a=num_alive_agents in all the batch, and the features are scattered back to (b,n,hidden_dim)
+        with zeros of the dead and dummy agents. The wrapped layers of TimeDistributed are used, so
+        the weights are shared with the padded path.
+        """
+        alive_indices = tf.where(mask)  # (a,2), int64
+
+        h = tf.gather_nd(inputs, alive_indices)  # (a,20,20,16)
+
+        h = self.conv0.layer(h)  # (a,20,20,64)
+        h = self.conv1.layer(h)  # (a,9,9,64)
+        h = self.conv2.layer(h)  # (a,7,7,64)
+        h = self.conv3.layer(h)  # (a,5,5,64)
+
+        h1 = self.flatten1.layer(h)  # (a,1600)
+
+        features = self.dense1.layer(h1)  # (a,256)
+
+        features_shape = tf.concat(
+            [tf.shape(mask, out_type=tf.int64),
+             tf.constant([self.config.hidden_dim], dtype=tf.int64)],
+            axis=0
+        )  # (b,n,256)
+
+        features = tf.scatter_nd(alive_indices, features, features_shape)  # (1,17,256)
+
+        return features
+
     def build_graph(self, mask):
         """ For summary & plot_model """
         x = tf.keras.layers.Input(
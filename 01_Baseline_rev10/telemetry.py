@@ -0,0 +1,143 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from replay_server import new_replay_stats
+
+
+class Telemetry:
+    """
+    Throughput telemetry of the training loop.
+    Stats of the actor rollouts, the learner updates, the replay and the weights broadcast are
+    accumulated in the driver, and written to TensorBoard as rates and mean latencies of the
+    interval by write().
+
+    object_store_bytes_per_sec is the throughput of the object store, the bytes of the rollouts,
+    the minibatch blocks and the weights broadcasts passed in the interval.
+    object_store_bytes_in_flight is the bytes held in the object store at write() for the pending
+    tasks: the minibatch block passed to the running learner update and the latest broadcast
+    weights, see add_in_flight.
+    """
+
+    def __init__(self, num_actors, samples_per_update, inserts_per_add):
+        self.num_actors = num_actors
+        self.samples_per_update = samples_per_update  # batch_size * num_minibatchs
+        self.inserts_per_add = inserts_per_add  # transitions of an add (an actor rollout)
+
+        self.in_flight_bytes = {}  # {ObjectRef or 'weights': bytes}, not reset by reset()
+
+        # Parameters TBD in reset()
+        self.interval_start = None
+        self.actor_env_steps = None  # (num_actors,)
+        self.actor_stats = None
+        self.learner_stats = None
+        self.replay_stats = None
+        self.broadcast_stats = None
+
+        self.reset()
+
+    def reset(self):
+        self.interval_start = time.time()
+
+        self.actor_env_steps = np.zeros(self.num_actors)
+        self.actor_stats = {'inference_time': 0., 'num_inferences': 0, 'rollout_bytes': 0}
+        self.learner_stats = {'num_updates': 0, 'data_prep_time': 0., 'train_time': 0.,
+                              'weights_export_time': 0., 'block_bytes': 0}
+        self.replay_stats = new_replay_stats()
+        self.broadcast_stats = {'num_broadcasts': 0, 'weights_bytes': 0, 'put_time': 0.}
+
+    def add_actor(self, pid, stats):
+        """ stats: returned by Actor.rollout """
+        self.actor_env_steps[pid] += stats['env_steps']
+
+        for key in self.actor_stats:
+            self.actor_stats[key] += stats[key]
+
+    def add_learner(self, stats):
+        """ stats: returned by Learner.update_network(_from_replay) """
+        self.learner_stats['num_updates'] += 1
+
+        for key in ['data_prep_time', 'train_time', 'weights_export_time', 'block_bytes']:
+            self.learner_stats[key] += stats[key]
+
+    def add_replay(self, stats):
+        """ stats: returned by ReplayServer.get_stats """
+        for key in self.replay_stats:
+            self.replay_stats[key] += stats[key]
+
+    def record_replay(self, op, op_time):
+        """ Latency of an op of the Replay in the driver, op: 'add', 'sample' or 'update' """
+        self.replay_stats[op + '_time'] += op_time
+        self.replay_stats['num_' + op + 's'] += 1
+
+    def add_broadcast(self, weights_bytes, put_time):
+        self.broadcast_stats['num_broadcasts'] += 1
+        self.broadcast_stats['weights_bytes'] += weights_bytes
+        self.broadcast_stats['put_time'] += put_time
+
+    def add_in_flight(self, key, nbytes):
+        """ Object put to the object store for a pending task, key: its ObjectRef or 'weights' """
+        self.in_flight_bytes[key] = nbytes
+
+    def remove_in_flight(self, key):
+        self.in_flight_bytes.pop(key, None)
+
+    def write(self, summary_writer, step):
+        """ Write the metrics of the interval to TensorBoard, and start a new interval """
+        interval = max(time.time() - self.interval_start, 1e-8)
+
+        num_updates = max(self.learner_stats['num_updates'], 1)
+        num_broadcasts = max(self.broadcast_stats['num_broadcasts'], 1)
+
+        object_store_bytes = self.actor_stats['rollout_bytes'] + \
+            self.learner_stats['block_bytes'] + self.broadcast_stats['weights_bytes']
+
+        with summary_writer.as_default():
+            # Throughput
+            tf.summary.scalar(
+                "env_steps_per_sec", np.sum(self.actor_env_steps) / interval, step=step)
+            for pid, env_steps in enumerate(self.actor_env_steps):
+                tf.summary.scalar(f"env_steps_per_sec_actor_{pid}", env_steps / interval, step=step)
+
+            tf.summary.scalar(
+                "updates_per_sec", self.learner_stats['num_updates'] / interval, step=step)
+            tf.summary.scalar(
+                "inserts_per_sec",
+                self.replay_stats['num_adds'] * self.inserts_per_add / interval, step=step)
+            tf.summary.scalar(
+                "samples_per_sec",
+                self.learner_stats['num_updates'] * self.samples_per_update / interval, step=step)
+
+            # Actor inference latency
+            tf.summary.scalar(
+                "actor_inference_latency",
+                self.actor_stats['inference_time'] / max(self.actor_stats['num_inferences'], 1),
+                step=step)
+
+            # Replay latency
+            for op in ['add', 'sample', 'update']:
+                tf.summary.scalar(
+                    f"replay_{op}_latency",
+                    self.replay_stats[op + '_time'] / max(self.replay_stats['num_' + op + 's'], 1),
+                    step=step)
+
+            # Learner step time
+            for key in ['data_prep_time', 'train_time', 'weights_export_time']:
+                tf.summary.scalar(
+                    "learner_" + key, self.learner_stats[key] / num_updates, step=step)
+
+            # Weights broadcast
+            tf.summary.scalar(
+                "weights_broadcast_bytes",
+                self.broadcast_stats['weights_bytes'] / num_broadcasts, step=step)
+            tf.summary.scalar(
+                "weights_broadcast_time",
+                self.broadcast_stats['put_time'] / num_broadcasts, step=step)
+
+            tf.summary.scalar(
+                "object_store_bytes_per_sec", object_store_bytes / interval, step=step)
+            tf.summary.scalar(
+                "object_store_bytes_in_flight", sum(self.in_flight_bytes.values()), step=step)
+
+        self.reset()
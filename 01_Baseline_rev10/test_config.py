@@ -8,6 +8,17 @@ class Config:
         self.show_each_episode_result = False  # mainly for debug
         self.draw_win_distributions = False  # mainly for debug
         self.max_episodes_test_play = 1000  # default=50 for training
+        self.num_testers = 1  # >1: test episodes fan out to num_testers Tester actors
+        self.num_eval_envs = 100  # Test episodes stepped in lockstep by VecEvaluator
+
+        # Sequential early stopping of the test episodes by the red win rate
+        self.sequential_test = None  # None: full max_episodes_test_play, 'wilson' or 'sprt'
+        self.sequential_test_threshold = 0.5  # win rate tested against, before the best model
+        # Error rate of the early stopping. wilson: two-sided, spent over the checks of each wave,
+        # sprt: alpha=beta at threshold -/+ indifference
+        self.sequential_test_alpha = 0.05
+        self.sequential_test_indifference = 0.05  # sprt: half width of the indifference region
+        self.sequential_test_min_episodes = 10
 
         # Animation setting
         self.make_animation = False  # Use self.max_episodes_test_play=1
@@ -15,6 +26,9 @@ class Config:
         # Time plot of a test setting
         self.make_time_plot = False  # Use self.max_episodes_test_play=1
 
+        # Trace of each test episode, rendered by render_traces.py
+        self.trace_episodes = False  # Compact binary trace, cheap for all the test episodes
+
         # Define environment parameters
         self.grid_size = 15  # default=20
         self.offset = 0  # blue-team offset from edges
@@ -39,6 +53,9 @@ class Config:
         self.hidden_dim = 256
         self.key_dim = 128
         self.num_heads = 2
+        # True: CNN of the alive agents only, False: of all the padded agents.
+        # Off until models.check_ragged_cnn() is run with TF and the checkpoints in use
+        self.ragged_cnn = False
 
         self.dropout_rate = 0.2
 
@@ -7,11 +7,14 @@ import ray
 import gym
 import tensorflow as tf
 import numpy as np
-from collections import deque
 
 from battlefield_strategy_rev10 import BattleFieldStrategy
 
 from models import MarlTransformerModel
+from episode_trace import EpisodeTrace
+from frame_stack import FrameStack
+from recorders import AnimationRecorder
+from sequential_test import make_sequential_test
 from utils_gnn import get_alive_agents_ids
 from utils_transformer import make_mask, make_padded_obs
 
@@ -150,12 +153,54 @@ def summarize_results(results):
     return result
 
 
+def merge_results(results_list):
+    """ Merge per-episode results of the testers, for summarize_results """
+    results = {}
+
+    for key in results_list[0]:
+        results[key] = []
+        for worker_results in results_list:
+            results[key] += worker_results[key]
+
+    return results
+
+
+def split_episodes(num_episodes, num_testers):
+    """ Number of test episodes of each tester, as even as possible, [int,...] """
+    return [len(part) for part in np.array_split(np.arange(num_episodes), num_testers)]
+
+
 @ray.remote
 # @ray.remote(num_cpus=2, num_gpus=0)
 class Tester:
-    def __init__(self):
+    def __init__(self, seed=None, num_testers=None, tester_id=0, visual_outputs=True):
+        """
+        num_testers>1: test episodes fan out to num_testers-1 worker Testers, and this tester
+                       merges the results. Default is config.num_testers.
+        seed: seed of the env seed streams of this tester and the workers, None for entropy
+        tester_id: 0 for this tester, 1,... for the workers, used in the trace filenames
+        visual_outputs: False for the workers, make_animation and make_time_plot are turned off,
+                        since they write to the same ./test_engagement files
+        """
         # Make a copy of environment
         self.env = BattleFieldStrategy()
+
+        if not visual_outputs:
+            self.env.config.make_animation = False
+            self.env.config.make_time_plot = False
+
+        if num_testers is None:
+            num_testers = self.env.config.num_testers
+
+        # Independent seed stream of each tester
+        seeds = np.random.SeedSequence(seed).generate_state(num_testers)
+        np.random.seed(seeds[0])
+        random.seed(int(seeds[0]))
+
+        self.workers = [Tester.remote(seed=int(worker_seed), num_testers=1, tester_id=k + 1,
+                                      visual_outputs=False)
+                        for k, worker_seed in enumerate(seeds[1:])]
+        self.tester_id = tester_id
         self.action_space_dim = self.env.action_space.n
         self.n_frames = self.env.config.n_frames
         self.epsilon = 0.0
@@ -166,10 +211,16 @@ class Tester:
         # Make a q_network
         self.policy = MarlTransformerModel(config=self.env.config)
 
+        # n_frames stacking of the observations of the alive agents, reset in 'reset_states'
+        self.frame_stack = FrameStack(num_envs=1,
+                                      max_num_agents=self.env.config.max_num_red_agents,
+                                      obs_shape=(self.env.config.grid_size,
+                                                 self.env.config.grid_size,
+                                                 self.env.config.observation_channels),
+                                      n_frames=self.n_frames)
+
         # Initialize environment
         ### The followings are reset in 'reset_states'
-        self.frames = None  # For each agent in env
-        self.states = None  # Stack frames n_frames times
         self.prev_actions = None
 
         self.alive_agents_ids = None  # For all agents, including dummy ones
@@ -180,6 +231,10 @@ class Tester:
         # self.episode_reward = None
         self.step = None
 
+        # Animation generators of each episode, made at env.reset()
+        if self.env.config.make_animation:
+            self.env.add_recorder(AnimationRecorder())
+
         ### Initialize above Nones
         observations = self.env.reset()
         self.reset_states(observations)
@@ -191,8 +246,15 @@ class Tester:
             if red.alive:
                 self.env.make_animation.add_observations_3(observations[red.id])
 
-        # For saving best model
-        self.num_max_win = -1
+        # For saving best model, red win rate of the best model so far
+        self.max_win_rate = -1
+
+        # Traces of the test episodes of each test_play, see set_trace_dir,
+        # ./test_engagement/traces/test_{test_cycles}/tester_{id}_episode_{n}.npz
+        self.trace_root = './test_engagement/traces'
+        self.trace_dir = None
+        self.num_traced_episodes = 0  # n of the traces in trace_dir
+        self.num_test_plays = 0
 
     def reset_states(self, observations):
         # TODO prev_actions
@@ -203,46 +265,23 @@ class Tester:
              each agent stacks observations n-frames in channel-dims
              -> observations[red.id]: (grid_size,grid_size,channels)
 
-             -> generate deque of length=n_frames
-             self.frames[red.id]: deque[(grid_size,grid_size,channels),...]
-
-             -> transform to states
-             states[red.id]: (grid_size,grid_size,channels*n_frames)
+             -> stacked in self.frame_stack, rows in the order of alive_agents_ids
+             self.frame_stack.states: (1,n,grid_size,grid_size,channels*n_frames)
 
              self.prev_actions[red.id]: int (TODO)
         """
 
-        self.frames = {}
-        self.states = {}
         self.prev_actions = {}
 
-        for red in self.env.reds:
-            # all reds are alive when reset
-
-            self.frames[red.id] = deque([observations[red.id]] * self.n_frames,
-                                        maxlen=self.n_frames)
-            # [(grid_size,grid_size,channels),...,(grid_size,grid_size,channels)]
-
-            self.states[red.id] = np.concatenate(self.frames[red.id], axis=2).astype(np.float32)
-            # (grid_size,grid_size,channels*n_frames)
-
-            # self.prev_actions[red.id] = 0
-
         # alive_agents_ids: list of alive agent id, [int,...], len=num_alive_agents
         self.alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-        # Get raw observation list of alive agents
-        raw_states = []
-
-        for a in self.alive_agents_ids:
-            agent_id = 'red_' + str(a)
-            raw_states.append(self.states[agent_id])  # append (g,g,ch*n_frames)
+        # all reds are alive when reset
+        self.frame_stack.reset(0, self.alive_agents_ids,
+                               [observations['red_' + str(a)] for a in self.alive_agents_ids])
 
-        # Get padded observations ndarray for all agents, including dead and dummy agents
-        self.padded_states = \
-            make_padded_obs(max_num_agents=self.env.config.max_num_red_agents,
-                            obs_shape=self.obs_shape,
-                            raw_obs=raw_states)  # (1,n,g,g,ch*n_frames)
+        # Padded observations ndarray for all agents, including dead and dummy agents
+        self.padded_states = self.frame_stack.states  # (1,n,g,g,ch*n_frames), view
 
         # Get mask for the padding
         self.mask = make_mask(alive_agents_ids=self.alive_agents_ids,
@@ -282,14 +321,127 @@ class Tester:
 
         return results
 
-    def test_play(self, current_weights, epsilon):
+    def test_play(self, current_weights, epsilon, test_cycles=None):
+        """
+        test_cycles: the traces are saved in ./test_engagement/traces/test_{test_cycles}/,
+                     None for the count of the test_play calls
+        """
         # 重みを更新
         self.policy.set_weights(weights=current_weights)
 
         self.save_test_conds()
+
+        if test_cycles is None:
+            test_cycles = self.num_test_plays
+        self.num_test_plays += 1
+
+        self.set_trace_dir(self.trace_root + '/test_' + str(test_cycles))
+
+        sequential_test = self.make_sequential_test()
+
+        weights = None
+        if len(self.workers) > 0:
+            weights = ray.put(current_weights)
+
+        if sequential_test is None:
+            results = self.play_round(self.env.config.max_episodes_test_play, weights, epsilon)
+
+        else:
+            # Rounds of one episode per tester, until the decision or max_episodes_test_play
+            results_list = []
+            num_played = 0
+
+            while (num_played < self.env.config.max_episodes_test_play) and \
+                    (sequential_test.decision is None):
+                num_round_episodes = min(len(self.workers) + 1,
+                                         self.env.config.max_episodes_test_play - num_played)
+
+                round_results = self.play_round(num_round_episodes, weights, epsilon)
+
+                sequential_test.update(round_results['winner'])
+                results_list.append(round_results)
+                num_played += num_round_episodes
+
+            results = merge_results(results_list)
+
+        result = summarize_results(results)
+        result['num_test_episodes'] = len(results['winner'])
+
+        if sequential_test is not None:
+            result['sequential_test'] = sequential_test.summary()
+
+        # Best model by the red win rate, decided by the sequential test against the best model
+        win_rate = result['num_red_win'] / result['num_test_episodes']
+
+        if (sequential_test is None) or (sequential_test.decision is None) or \
+                (self.max_win_rate < 0):
+            is_best = win_rate >= self.max_win_rate
+        else:
+            is_best = sequential_test.decision == 'above'
+
+        if is_best:
+            save_dir = Path(__file__).parent / 'models'
+            save_name = '/best_model/'
+
+            self.policy.save_weights(str(save_dir) + save_name)
+
+            # The win rate of an early stopped 'above' is biased upward, the baseline of the next
+            # test is the beaten threshold or the lower Wilson bound of the win rate
+            if (sequential_test is not None) and (sequential_test.decision == 'above'):
+                self.max_win_rate = max(sequential_test.threshold,
+                                        result['sequential_test']['win_rate_interval'][0])
+            else:
+                self.max_win_rate = win_rate
+
+        return result
+
+    def make_sequential_test(self):
+        """
+        SequentialTest of config.sequential_test, None for the full max_episodes_test_play.
+        The threshold is max_win_rate, the baseline of the best model so far,
+        or config.sequential_test_threshold before the first test.
+        """
+        threshold = None
+        if self.max_win_rate >= 0:
+            threshold = self.max_win_rate
+
+        # Updated after each round of one episode per tester
+        return make_sequential_test(self.env.config, threshold=threshold,
+                                    wave_size=len(self.workers) + 1)
+
+    def play_round(self, num_episodes, weights, epsilon):
+        """
+        Episodes fan out to the workers, and this tester plays the rest in the meantime
+        :param weights: ObjectRef of the current weights, None if no workers
+        :return: merged per-episode results
+        """
+        num_episodes = split_episodes(num_episodes, len(self.workers) + 1)
+
+        wip_workers = [
+            worker.test_play_episodes.remote(weights, epsilon, worker_num_episodes,
+                                             self.trace_dir)
+            for worker, worker_num_episodes in zip(self.workers, num_episodes[1:])
+            if worker_num_episodes > 0]
+
+        results = self.play_episodes(num_episodes[0], epsilon)
+
+        return merge_results([results] + ray.get(wip_workers))
+
+    def test_play_episodes(self, current_weights, epsilon, num_episodes, trace_dir):
+        """
+        Worker of test_play, :return: per-episode results, not summarized
+        trace_dir: trace_dir of the test_play
+        """
+        self.policy.set_weights(weights=current_weights)
+        self.set_trace_dir(trace_dir)
+
+        return self.play_episodes(num_episodes, epsilon)
+
+    def play_episodes(self, num_episodes, epsilon):
+        """ :return: per-episode results by summarize_episode_results """
         results = self.initialize_results()
 
-        for _ in range(self.env.config.max_episodes_test_play):
+        for _ in range(num_episodes):
             dones = {}
             dones['all_dones'] = False
             episode_reward = 0
@@ -300,6 +452,9 @@ class Tester:
                 self.save_initial_conds()
                 self.initialize_time_plot()
 
+            if self.env.config.trace_episodes:
+                trace = EpisodeTrace(self.env)
+
             while not dones['all_dones']:
 
                 q_logits, scores = self.policy(self.padded_states, self.mask, training=False)
@@ -328,34 +483,14 @@ class Tester:
                 # including dummy ones
                 next_alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-                ### For alive agents in env
-                next_states = {}
-
-                for idx in next_alive_agents_ids:
-                    agent_id = 'red_' + str(idx)
-
-                    self.frames[agent_id].append(
-                        next_obserations[agent_id]
-                    )  # append (g,g,ch) to deque
-
-                    next_states[agent_id] = np.concatenate(
-                        self.frames[agent_id], axis=2
-                    ).astype(np.float32)  # (g,g,ch*n_frames)
-
-                # Get next_observation list of alive agents
-                raw_next_states = []
-
-                for a in next_alive_agents_ids:
-                    agent_id = 'red_' + str(a)
-                    raw_next_states.append(next_states[agent_id])  # append (g,g,ch*n_frames)
+                ### For alive agents in env, append (g,g,ch) to the frame stack
+                self.frame_stack.advance()
+                self.frame_stack.append(
+                    0, next_alive_agents_ids,
+                    [next_obserations['red_' + str(a)] for a in next_alive_agents_ids])
 
                 # Get padded next observations ndarray of all agent
-                next_padded_states = \
-                    make_padded_obs(
-                        max_num_agents=self.env.config.max_num_red_agents,
-                        obs_shape=self.obs_shape,
-                        raw_obs=raw_next_states
-                    )  # (1,n,g,g,ch*n_frames)
+                next_padded_states = self.frame_stack.states  # (1,n,g,g,ch*n_frames), view
 
                 # Get next mask for the padding
                 next_mask = \
@@ -396,6 +531,10 @@ class Tester:
                 if self.env.config.make_time_plot:
                     self.store_time_history()
 
+                # Trace of an engagement
+                if self.env.config.trace_episodes:
+                    trace.record(self.env, actions, reward, scores)
+
                 # Make animation
                 if self.env.config.make_animation:
                     self.env.make_animation.add_frame(self.env)  # log-normalized map
@@ -440,6 +579,10 @@ class Tester:
                     if self.env.config.make_time_plot:
                         self.make_time_plot()
 
+                    # Save trace of an engagement
+                    if self.env.config.trace_episodes:
+                        self.save_trace(trace)
+
                     # Generate animation
                     if self.env.config.make_animation:
                         self.env.make_animation.generate_movies(self.env)
@@ -455,26 +598,31 @@ class Tester:
 
                     self.step += 1
 
-        result = summarize_results(results)
+        return results
 
-        if result['num_red_win'] >= self.num_max_win:
-            save_dir = Path(__file__).parent / 'models'
-            save_name = '/best_model/'
+    def set_trace_dir(self, trace_dir):
+        """ Traces of a test_play, the episodes are counted from 0 in each trace_dir """
+        if trace_dir != self.trace_dir:
+            self.trace_dir = trace_dir
+            self.num_traced_episodes = 0
 
-            self.policy.save_weights(str(save_dir) + save_name)
+    def save_trace(self, trace):
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir, exist_ok=True)
 
-            self.num_max_win = result['num_red_win']
+        trace.save(self.trace_dir + '/tester_' + str(self.tester_id) +
+                   '_episode_' + str(self.num_traced_episodes) + '.npz')
 
-        return result
+        self.num_traced_episodes += 1
 
     def save_initial_conds(self):
         red_properties = []
         for red in self.env.reds:
-            red_properties.append({k: v for k, v in red.__dict__.items()})
+            red_properties.append(red.to_dict())
 
         blue_properties = []
         for blue in self.env.blues:
-            blue_properties.append({k: v for k, v in blue.__dict__.items()})
+            blue_properties.append(blue.to_dict())
 
         initial_conds = {
             'summary of reds': {
@@ -782,7 +930,7 @@ def main():
 
     result = ray.get(finished_tester[0])
 
-    print(f'{config.max_episodes_test_play} test trials:')
+    print(f"{result['num_test_episodes']} test trials:")
     print(f" - mean_episode_rewards = {result['episode_rewards']}")
     print(f" - mean_episode_len = {result['episode_lens']}")
 
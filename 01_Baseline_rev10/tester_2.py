@@ -471,11 +471,11 @@ class Tester:
     def save_initial_conds(self):
         red_properties = []
         for red in self.env.reds:
-            red_properties.append({k: v for k, v in red.__dict__.items()})
+            red_properties.append(red.to_dict())
 
         blue_properties = []
         for blue in self.env.blues:
-            blue_properties.append({k: v for k, v in blue.__dict__.items()})
+            blue_properties.append(blue.to_dict())
 
         initial_conds = {
             'summary of reds': {
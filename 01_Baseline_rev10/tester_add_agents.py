@@ -7,11 +7,12 @@ import ray
 import gym
 import tensorflow as tf
 import numpy as np
-from collections import deque
 
 from battlefield_strategy_add_agents import BattleFieldStrategy
+from recorders import AnimationRecorder
 
 from models import MarlTransformerModel
+from frame_stack import FrameStack
 from utils_gnn import get_alive_agents_ids
 from utils_transformer import make_mask, make_padded_obs
 
@@ -164,10 +165,16 @@ class Tester:
         # Make a q_network
         self.policy = MarlTransformerModel(config=self.env.config)
 
+        # n_frames stacking of the observations of the alive agents, reset in 'reset_states'
+        self.frame_stack = FrameStack(num_envs=1,
+                                      max_num_agents=self.env.config.max_num_red_agents,
+                                      obs_shape=(self.env.config.grid_size,
+                                                 self.env.config.grid_size,
+                                                 self.env.config.observation_channels),
+                                      n_frames=self.n_frames)
+
         # Initialize environment
         ### The followings are reset in 'reset_states'
-        self.frames = None  # For each agent in env
-        self.states = None  # Stack frames n_frames times
         self.prev_actions = None
 
         self.alive_agents_ids = None  # For all agents, including dummy ones
@@ -178,6 +185,10 @@ class Tester:
         # self.episode_reward = None
         self.step = None
 
+        # Animation generators of each episode, made at env.reset()
+        if self.env.config.make_animation:
+            self.env.add_recorder(AnimationRecorder())
+
         ### Initialize above Nones
         observations = self.env.reset()
         self.reset_states(observations)
@@ -201,46 +212,23 @@ class Tester:
              each agent stacks observations n-frames in channel-dims
              -> observations[red.id]: (grid_size,grid_size,channels)
 
-             -> generate deque of length=n_frames
-             self.frames[red.id]: deque[(grid_size,grid_size,channels),...]
-
-             -> transform to states
-             states[red.id]: (grid_size,grid_size,channels*n_frames)
+             -> stacked in self.frame_stack, rows in the order of alive_agents_ids
+             self.frame_stack.states: (1,n,grid_size,grid_size,channels*n_frames)
 
              self.prev_actions[red.id]: int (TODO)
         """
 
-        self.frames = {}
-        self.states = {}
         self.prev_actions = {}
 
-        for red in self.env.reds:
-            # all reds are alive when reset
-
-            self.frames[red.id] = deque([observations[red.id]] * self.n_frames,
-                                        maxlen=self.n_frames)
-            # [(grid_size,grid_size,channels),...,(grid_size,grid_size,channels)]
-
-            self.states[red.id] = np.concatenate(self.frames[red.id], axis=2).astype(np.float32)
-            # (grid_size,grid_size,channels*n_frames)
-
-            # self.prev_actions[red.id] = 0
-
         # alive_agents_ids: list of alive agent id, [int,...], len=num_alive_agents
         self.alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-        # Get raw observation list of alive agents
-        raw_states = []
-
-        for a in self.alive_agents_ids:
-            agent_id = 'red_' + str(a)
-            raw_states.append(self.states[agent_id])  # append (g,g,ch*n_frames)
+        # all reds are alive when reset
+        self.frame_stack.reset(0, self.alive_agents_ids,
+                               [observations['red_' + str(a)] for a in self.alive_agents_ids])
 
-        # Get padded observations ndarray for all agents, including dead and dummy agents
-        self.padded_states = \
-            make_padded_obs(max_num_agents=self.env.config.max_num_red_agents,
-                            obs_shape=self.obs_shape,
-                            raw_obs=raw_states)  # (1,n,g,g,ch*n_frames)
+        # Padded observations ndarray for all agents, including dead and dummy agents
+        self.padded_states = self.frame_stack.states  # (1,n,g,g,ch*n_frames), view
 
         # Get mask for the padding
         self.mask = make_mask(alive_agents_ids=self.alive_agents_ids,
@@ -320,45 +308,15 @@ class Tester:
                 # including dummy ones
                 next_alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-                ### For alive agents in env
-                next_states = {}
-
-                for idx in next_alive_agents_ids:
-                    agent_id = 'red_' + str(idx)
-
-                    # process added agents
-                    if len(next_alive_agents_ids) > len(self.alive_agents_ids):
-                        dif_ids = set(next_alive_agents_ids) ^ set(self.alive_agents_ids)
-
-                        red_id = 'red_' + str(idx)
-                        self.frames[red_id] = \
-                            deque([next_obserations[red_id]] * self.n_frames, maxlen=self.n_frames)
-                        #self.states[red_id] = \
-                        #    np.concatenate(self.frames[red_id], axis=2).astype(np.float32)
-
-                    else:
-                        self.frames[agent_id].append(
-                            next_obserations[agent_id]
-                        )  # append (g,g,ch) to deque
-
-                    next_states[agent_id] = np.concatenate(
-                        self.frames[agent_id], axis=2
-                    ).astype(np.float32)  # (g,g,ch*n_frames)
-
-                # Get next_observation list of alive agents
-                raw_next_states = []
-
-                for a in next_alive_agents_ids:
-                    agent_id = 'red_' + str(a)
-                    raw_next_states.append(next_states[agent_id])  # append (g,g,ch*n_frames)
+                ### For alive agents in env, append (g,g,ch) to the frame stack
+                # The added agents start with n_frames copies of their first observation
+                self.frame_stack.advance()
+                self.frame_stack.append(
+                    0, next_alive_agents_ids,
+                    [next_obserations['red_' + str(a)] for a in next_alive_agents_ids])
 
                 # Get padded next observations ndarray of all agent
-                next_padded_states = \
-                    make_padded_obs(
-                        max_num_agents=self.env.config.max_num_red_agents,
-                        obs_shape=self.obs_shape,
-                        raw_obs=raw_next_states
-                    )  # (1,n,g,g,ch*n_frames)
+                next_padded_states = self.frame_stack.states  # (1,n,g,g,ch*n_frames), view
 
                 # Get next mask for the padding
                 next_mask = \
@@ -470,11 +428,11 @@ class Tester:
     def save_initial_conds(self):
         red_properties = []
         for red in self.env.reds:
-            red_properties.append({k: v for k, v in red.__dict__.items()})
+            red_properties.append(red.to_dict())
 
         blue_properties = []
         for blue in self.env.blues:
-            blue_properties.append({k: v for k, v in blue.__dict__.items()})
+            blue_properties.append(blue.to_dict())
 
         initial_conds = {
             'summary of reds': {
@@ -0,0 +1,127 @@
+import numpy as np
+
+from battlefield_strategy_rev10 import BattleFieldStrategy
+
+"""
+VecBattleFieldStrategy
+ K independent battlefields are stepped with one call.
+ Movement, engagement, rewards and observations are the rules of BattleFieldStrategy.
+
+observations: (K,n,g,g,ch), padded in the order of alive_agents_ids, n=max_num_red_agents
+masks: (K,n), bool
+actions: (K,n), int, actions[k,i] is the action of alive_agents_ids[k][i]
+rewards: (K,), team reward
+dones: (K,), team done
+"""
+
+
+class VecBattleFieldStrategy:
+    def __init__(self, num_envs):
+        self.num_envs = num_envs
+
+        self.envs = [BattleFieldStrategy() for _ in range(self.num_envs)]
+
+        self.config = self.envs[0].config
+
+        self.action_space = self.envs[0].action_space
+        self.observation_space = self.envs[0].observation_space
+
+        self.max_num_agents = self.config.max_num_red_agents
+        self.obs_shape = (self.config.grid_size,
+                          self.config.grid_size,
+                          self.config.observation_channels)
+
+        # Parameters TBD in reset()
+        self.alive_agents_ids = None  # [[int,...],...], len=K
+        self.steps = None  # (K,), steps in the episode, same count as Actor.step
+
+    def reset(self):
+        """
+        :return: observations: (K,n,g,g,ch), masks: (K,n)
+        """
+        observations = np.zeros((self.num_envs, self.max_num_agents) + self.obs_shape,
+                                dtype=np.float32)
+        masks = np.zeros((self.num_envs, self.max_num_agents), dtype=bool)
+
+        self.alive_agents_ids = [None] * self.num_envs
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
+
+        for k in range(self.num_envs):
+            self.reset_env(k, observations, masks)
+
+        return observations, masks
+
+    def reset_env(self, k, observations, masks):
+        """ Reset k-th env, and write its initial observations to observations[k], masks[k] """
+        env_observations = self.envs[k].reset()
+        self.steps[k] = 0
+
+        self.pad_observations(k, env_observations, observations, masks)
+
+    def pad_observations(self, k, env_observations, observations, masks):
+        """ observations dict of k-th env -> observations[k]: (n,g,g,ch), masks[k]: (n,) """
+        reds = self.envs[k].reds
+        alive_idx = np.nonzero(reds.alive)[0]
+
+        self.alive_agents_ids[k] = [int(i) for i in alive_idx]
+
+        for i, idx in enumerate(alive_idx):
+            observations[k, i] = env_observations[reds.ids[idx]]
+
+        masks[k, :len(alive_idx)] = True
+
+    def step(self, actions):
+        """
+        :param actions: (K,n), int
+        :return:
+            observations: (K,n,g,g,ch), next observations, or initial observations if reset
+            masks: (K,n), bool
+            rewards: (K,), team reward
+            dones: (K,), team done
+            infos: [infos,...], len=K
+                When k-th episode is done or time up ('time_up'), the env is reset automatically
+                and infos[k] has
+                'final_observations': (n,g,g,ch), 'final_mask': (n,),
+                'final_alive_agents_ids': [int,...]
+        """
+        if actions.shape != (self.num_envs, self.max_num_agents):
+            raise ValueError()
+
+        observations = np.zeros((self.num_envs, self.max_num_agents) + self.obs_shape,
+                                dtype=np.float32)
+        masks = np.zeros((self.num_envs, self.max_num_agents), dtype=bool)
+        rewards = np.zeros(self.num_envs)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        infos = []
+
+        for k, env in enumerate(self.envs):
+            env_actions = {}
+            for i, idx in enumerate(self.alive_agents_ids[k]):
+                env_actions[env.reds.ids[idx]] = int(actions[k, i])
+
+            next_observations, _, agents_dones, env_infos, reward, done = env.step(env_actions)
+
+            rewards[k] = reward
+            dones[k] = done
+
+            self.pad_observations(k, next_observations, observations, masks)
+
+            # Time up is not a team done, same as Actor.rollout
+            env_infos['time_up'] = bool(self.steps[k] > env.config.max_steps)
+
+            if agents_dones['all_dones'] or env_infos['time_up']:
+                env_infos['final_observations'] = observations[k].copy()
+                env_infos['final_mask'] = masks[k].copy()
+                env_infos['final_alive_agents_ids'] = self.alive_agents_ids[k]
+
+                observations[k] = 0
+                masks[k] = False
+
+                self.reset_env(k, observations, masks)
+
+            else:
+                self.steps[k] += 1
+
+            infos.append(env_infos)
+
+        return observations, masks, rewards, dones, infos
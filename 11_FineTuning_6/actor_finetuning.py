@@ -1,30 +1,39 @@
 import random
+import time
 
 import ray
 import gym
 import tensorflow as tf
 import numpy as np
-from collections import deque
 
 from battlefield_strategy_rev10_finetuning import BattleFieldStrategy
+from frame_stack import FrameStack
+from vec_battlefield_strategy_finetuning import VecBattleFieldStrategy
 
 from models import MarlTransformerModel
 from utils_gnn import get_alive_agents_ids
-from utils_transformer import make_mask, make_padded_obs, make_next_states_for_q
+from utils_transformer import make_mask
 
 
 @ray.remote
 # @ray.remote(num_cpus=1, num_gpus=0)
 class Actor:
-    def __init__(self, pid, epsilon):
+    def __init__(self, pid, epsilon, inference_server=None, replay_shard=None):
         self.pid = pid
 
+        # ReplayServer shard to push the rollouts to, None if the rollouts are returned to main
+        self.replay_shard = replay_shard
+
         # Make a copy of environment
         self.env = BattleFieldStrategy()
         self.action_space_dim = self.env.action_space.n
 
-        # Make a q_network
-        self.policy = MarlTransformerModel(config=self.env.config)
+        # Make a q_network, or use the centralized InferenceServer which holds the weights
+        self.inference_server = inference_server
+        self.policy = None
+
+        if self.inference_server is None:
+            self.policy = MarlTransformerModel(config=self.env.config)
 
         self.epsilon = epsilon
         self.gamma = self.env.config.gamma
@@ -36,10 +45,20 @@ class Actor:
         # Define local buffer
         self.buffer = []
 
+        # Telemetry of a rollout, reset in 'rollout'
+        self.inference_time = 0.  # sec, forward passes for action selection
+        self.num_inferences = 0
+
+        # n_frames stacking of the observations of the alive agents, reset in 'reset_states'
+        self.frame_stack = FrameStack(num_envs=1,
+                                      max_num_agents=self.env.config.max_num_red_agents,
+                                      obs_shape=(self.env.config.grid_size,
+                                                 self.env.config.grid_size,
+                                                 self.env.config.observation_channels),
+                                      n_frames=self.n_frames)
+
         # Initialize environment
         ### The followings are reset in 'reset_states'
-        self.frames = None  # For each agent in env
-        self.states = None
         self.prev_actions = None
 
         self.alive_agents_ids = None  # For all agents, including dummy ones
@@ -54,7 +73,35 @@ class Actor:
         observations = self.env.reset()
         self.reset_states(observations)
 
-        self.policy(self.padded_states, self.mask, training=True)  # build
+        if self.policy is not None:
+            self.policy(self.padded_states, self.mask, training=True)  # build
+
+        # Batched rollout of M envs in lockstep, when num_envs_per_actor > 1
+        self.num_envs = self.env.config.num_envs_per_actor
+        self.vec_env = None
+
+        ### The followings are reset in 'reset_vec_states', list or array of len=M
+        self.vec_frame_stack = None  # FrameStack of M envs
+        self.vec_alive_agents_ids = None
+        self.vec_padded_states = None  # [(1,n,g,g,ch*n_frames),...]
+        self.vec_mask = None  # (M,n)
+
+        if self.num_envs > 1:
+            self.vec_env = VecBattleFieldStrategy(num_envs=self.num_envs)
+
+            observations, _ = self.vec_env.reset()  # (M,n,g,g,ch), (M,n)
+
+            self.vec_frame_stack = FrameStack(num_envs=self.num_envs,
+                                              max_num_agents=self.env.config.max_num_red_agents,
+                                              obs_shape=observations.shape[2:],
+                                              n_frames=self.n_frames)
+            self.vec_alive_agents_ids = [None] * self.num_envs
+            self.vec_padded_states = [None] * self.num_envs
+            self.vec_mask = np.zeros((self.num_envs, self.env.config.max_num_red_agents),
+                                     dtype=bool)
+
+            for k in range(self.num_envs):
+                self.reset_vec_states(k, observations[k])
 
     def reset_states(self, observations):
         # TODO prev_actions
@@ -65,46 +112,23 @@ class Actor:
              each agent stacks observations n-frames in channel-dims
              -> observations[red.id]: (grid_size,grid_size,channels)
 
-             -> generate deque of length=n_frames
-             self.frames[red.id]: deque[(grid_size,grid_size,channels),...]
-
-             -> transform to states
-             states[red.id]: (grid_size,grid_size,channels*n_frames)
+             -> stacked in self.frame_stack, rows in the order of alive_agents_ids
+             self.frame_stack.states: (1,n,grid_size,grid_size,channels*n_frames)
 
              self.prev_actions[red.id]: int (TODO)
         """
 
-        self.frames = {}
-        self.states = {}
         self.prev_actions = {}
 
-        for red in self.env.reds:
-            # all reds are alive when reset
-
-            self.frames[red.id] = deque([observations[red.id]] * self.n_frames,
-                                        maxlen=self.n_frames)
-            # [(grid_size,grid_size,channels),...,(grid_size,grid_size,channels)]
-
-            self.states[red.id] = np.concatenate(self.frames[red.id], axis=2).astype(np.float32)
-            # (grid_size,grid_size,channels*n_frames)
-
-            # self.prev_actions[red.id] = 0
-
         # alive_agents_ids: list of alive agent id, [int,...], len=num_alive_agents
         self.alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-        # Get raw observation list of alive agents
-        raw_states = []
+        # all reds are alive when reset
+        self.frame_stack.reset(0, self.alive_agents_ids,
+                               [observations['red_' + str(a)] for a in self.alive_agents_ids])
 
-        for a in self.alive_agents_ids:
-            agent_id = 'red_' + str(a)
-            raw_states.append(self.states[agent_id])  # append (g,g,ch*n_frames)
-
-        # Get padded observations ndarray for all agents, including dead and dummy agents
-        self.padded_states = \
-            make_padded_obs(max_num_agents=self.env.config.max_num_red_agents,
-                            obs_shape=self.obs_shape,
-                            raw_obs=raw_states)  # (1,n,g,g,ch*n_frames)
+        # Padded observations ndarray for all agents, including dead and dummy agents
+        self.padded_states = self.frame_stack.states.copy()  # (1,n,g,g,ch*n_frames)
 
         # Get mask for the padding
         self.mask = make_mask(alive_agents_ids=self.alive_agents_ids,
@@ -114,12 +138,33 @@ class Actor:
         self.episode_reward = 0
         self.step = 0
 
+    def reset_vec_states(self, k, observations):
+        """
+        reset_states of k-th env of self.vec_env
+        :param observations: (n,g,g,ch), padded in the order of vec_env.alive_agents_ids[k]
+        """
+        self.vec_alive_agents_ids[k] = self.vec_env.alive_agents_ids[k]
+
+        num_alive_agents = len(self.vec_alive_agents_ids[k])
+        self.vec_frame_stack.reset(k, self.vec_alive_agents_ids[k],
+                                   observations[:num_alive_agents])
+
+        self.vec_padded_states[k] = \
+            self.vec_frame_stack.states[k:k + 1].copy()  # (1,n,g,g,ch*n_frames)
+
+        self.vec_mask[k] = \
+            make_mask(alive_agents_ids=self.vec_alive_agents_ids[k],
+                      max_num_agents=self.env.config.max_num_red_agents)[0]  # (n,)
+
     def rollout(self, current_weights):
         """
         rolloutを,self.env.config.actor_rollout_steps回（=10回）実施し、
         各経験の優先度（TD error）と経験（transitions）を格納
 
-        :return td_errors, transitions, self.pid (process id)
+        :return td_errors, transitions, self.pid (process id), stats
+                td_errors, transitions = None, None when pushed to the replay_shard
+                stats: telemetry of the rollout, {'env_steps', 'rollout_time', 'inference_time',
+                       'num_inferences', 'rollout_bytes'}
                 td_errors: (self.env.config.actor_rollout_steps,)=(10,)
                 transitions=[transition,...], len=self.env.config.actor_rollout_steps=10
                     transition =
@@ -133,16 +178,65 @@ class Actor:
                             next_mask,  # (1,n), bool
                             next_padded_states_for_q,  # (1,n,g,g,ch*n_frames)
                             alive_agents_ids,  # (1,a), a=num_alive_agent, object
+                            next_alive_agents_ids,  # (1,a'), object
                         )
         """
-        # 重みを更新
-        self.policy.set_weights(weights=current_weights)
+        rollout_start = time.time()
+        self.inference_time = 0.
+        self.num_inferences = 0
+
+        # 重みを更新, current_weights=None when the InferenceServer is used
+        if self.policy is not None:
+            self.policy.set_weights(weights=current_weights)
 
         # Rolloutをenv.config.actor_rollout_steps回実施し、local bufferにtransitionを一時保存
+        if self.vec_env is None:
+            self.env_rollout()
+        else:
+            self.vec_env_rollout()
+
+        # 各transitionの初期優先度（td_error）の計算
+        masked_td_errors = self.compute_td_errors()
+
+        transitions = self.buffer
+        self.buffer = []
+
+        stats = {
+            'env_steps': len(transitions),
+            'rollout_time': time.time() - rollout_start,
+            'inference_time': self.inference_time,
+            'num_inferences': self.num_inferences,
+            'rollout_bytes': np.asarray(masked_td_errors).nbytes + sum(
+                [x.nbytes for transition in transitions for x in transition
+                 if isinstance(x, np.ndarray)]),
+        }
+
+        # ReplayServerに直接追加し、mainには返さない
+        if self.replay_shard is not None:
+            self.replay_shard.add.remote(masked_td_errors, transitions)
+
+            return None, None, self.pid, stats
+
+        return masked_td_errors, transitions, self.pid, stats
+
+    def get_q_logits(self, padded_states, mask):
+        """ q_logits: (b,n,action_dim), by own policy or by the InferenceServer """
+        if self.inference_server is None:
+            q_logits, _ = self.policy(padded_states, mask, training=False)
+        else:
+            _, q_logits = ray.get(self.inference_server.infer.remote(padded_states, mask))
+
+        return q_logits
+
+    def env_rollout(self):
+        """ actor_rollout_steps of self.env, transitions are appended to self.buffer """
 
         for _ in range(self.env.config.actor_rollout_steps):
 
-            q_logits, _ = self.policy(self.padded_states, self.mask, training=False)
+            inference_start = time.time()
+            q_logits = self.get_q_logits(self.padded_states, self.mask)
+            self.inference_time += time.time() - inference_start
+            self.num_inferences += 1
 
             # get alive_agents & all agents actions. action=0 <- do nothing
             actions = {}  # For alive agents
@@ -168,34 +262,14 @@ class Actor:
             # including dummy ones
             next_alive_agents_ids = get_alive_agents_ids(env=self.env)
 
-            ### For alive agents in env
-            next_states = {}
-
-            for idx in next_alive_agents_ids:
-                agent_id = 'red_' + str(idx)
-
-                self.frames[agent_id].append(
-                    next_obserations[agent_id]
-                )  # append (g,g,ch) to deque
-
-                next_states[agent_id] = np.concatenate(
-                    self.frames[agent_id], axis=2
-                ).astype(np.float32)  # (g,g,ch*n_frames)
-
-            # Get next_observation list of alive agents
-            raw_next_states = []
-
-            for a in next_alive_agents_ids:
-                agent_id = 'red_' + str(a)
-                raw_next_states.append(next_states[agent_id])  # append (g,g,ch*n_frames)
+            ### For alive agents in env, append (g,g,ch) to the frame stack
+            self.frame_stack.advance()
+            self.frame_stack.append(
+                0, next_alive_agents_ids,
+                [next_obserations['red_' + str(a)] for a in next_alive_agents_ids])
 
             # Get padded next observations ndarray of all agent
-            next_padded_states = \
-                make_padded_obs(
-                    max_num_agents=self.env.config.max_num_red_agents,
-                    obs_shape=self.obs_shape,
-                    raw_obs=raw_next_states
-                )  # (1,n,g,g,ch*n_frames)
+            next_padded_states = self.frame_stack.states.copy()  # (1,n,g,g,ch*n_frames)
 
             # Get next mask for the padding
             next_mask = \
@@ -245,20 +319,15 @@ class Actor:
             alive_agents_ids = np.array(self.alive_agents_ids, dtype=object)  # (a,), object
             alive_agents_ids = np.expand_dims(alive_agents_ids, axis=0)  # (1,a)
 
+            padded_next_alive_agents_ids = \
+                np.array(next_alive_agents_ids, dtype=object)[np.newaxis]  # (1,a'), object
+
             # next_states to compute Q(s', a'), corresponding to alive_agents_ids
-            next_states_for_q = \
-                make_next_states_for_q(
-                    alive_agents_ids=self.alive_agents_ids,
-                    next_alive_agents_ids=next_alive_agents_ids,
-                    raw_next_states=raw_next_states,
-                    obs_shape=self.obs_shape,
-                )  # [(g,g,ch*n_frames),...], len=a', a'=num_next_alive_agents
-
-            next_padded_states_for_q = \
-                make_padded_obs(
-                    max_num_agents=self.env.config.max_num_red_agents,
-                    obs_shape=self.obs_shape,
-                    raw_obs=next_states_for_q,
+            if next_alive_agents_ids == self.alive_agents_ids:
+                next_padded_states_for_q = next_padded_states  # (1,n,g,g,ch*n_frames)
+            else:
+                next_padded_states_for_q = np.expand_dims(
+                    self.frame_stack.gather(0, self.alive_agents_ids), axis=0
                 )  # (1,n,g,g,ch*n_frames)
 
             # Append to buffer
@@ -272,6 +341,7 @@ class Actor:
                 next_mask,  # (1,n), bool
                 next_padded_states_for_q,  # (1,n,g,g,ch*n_frames)
                 alive_agents_ids,  # (1,a), a=num_alive_agent, object
+                padded_next_alive_agents_ids,  # (1,a'), a'=num_next_alive_agent, object
             )
 
             self.buffer.append(transition)
@@ -287,7 +357,103 @@ class Actor:
 
                 self.step += 1
 
-        # 各transitionの初期優先度（td_error）の計算
+    def vec_env_rollout(self):
+        """
+        M envs of self.vec_env in lockstep, actor_rollout_steps transitions in total.
+        One forward pass and vectorized epsilon-greedy for all envs and agents.
+        Transitions are the same tuples as env_rollout, appended to self.buffer.
+        """
+        num_steps = int(np.ceil(self.env.config.actor_rollout_steps / self.num_envs))
+
+        # Transitions of each env, appended to self.buffer in order of env and step, so that the
+        # next_states of a transition is the states of the next one (deduplicated in replay)
+        env_buffers = [[] for _ in range(self.num_envs)]
+
+        for _ in range(num_steps):
+
+            inference_start = time.time()
+            q_logits = self.get_q_logits(self.vec_frame_stack.states, self.vec_mask)
+            self.inference_time += time.time() - inference_start
+            self.num_inferences += 1
+
+            acts = np.argmax(q_logits, axis=-1)  # (M,n)
+
+            # epsilon-greedy for alive agents, action of dead and dummy agents is argmax
+            explore = (np.random.rand(*acts.shape) < self.epsilon) & self.vec_mask  # (M,n)
+            random_acts = np.random.randint(low=0, high=self.action_space_dim, size=acts.shape)
+
+            padded_actions = np.where(explore, random_acts, acts)  # (M,n)
+
+            # One step of Lanchester simulation of all envs
+            next_observations, next_masks, rewards, dones, infos = \
+                self.vec_env.step(padded_actions)
+
+            self.vec_frame_stack.advance()
+
+            for k in range(self.num_envs):
+                is_reset = 'final_observations' in infos[k]
+
+                if is_reset:
+                    next_obs_k = infos[k]['final_observations']  # (n,g,g,ch)
+                    next_alive_agents_ids = infos[k]['final_alive_agents_ids']
+                else:
+                    next_obs_k = next_observations[k]
+                    next_alive_agents_ids = self.vec_env.alive_agents_ids[k]
+
+                # Append (g,g,ch) of alive agents to the frame stack
+                self.vec_frame_stack.append(k, next_alive_agents_ids,
+                                            next_obs_k[:len(next_alive_agents_ids)])
+
+                next_padded_states = \
+                    self.vec_frame_stack.states[k:k + 1].copy()  # (1,n,g,g,ch*n_frames)
+
+                next_mask = \
+                    make_mask(
+                        alive_agents_ids=next_alive_agents_ids,
+                        max_num_agents=self.env.config.max_num_red_agents
+                    )  # (1,n)
+
+                alive_agents_ids = np.array(self.vec_alive_agents_ids[k], dtype=object)  # (a,)
+                alive_agents_ids = np.expand_dims(alive_agents_ids, axis=0)  # (1,a)
+
+                padded_next_alive_agents_ids = \
+                    np.array(next_alive_agents_ids, dtype=object)[np.newaxis]  # (1,a'), object
+
+                if next_alive_agents_ids == self.vec_alive_agents_ids[k]:
+                    next_padded_states_for_q = next_padded_states  # (1,n,g,g,ch*n_frames)
+                else:
+                    next_padded_states_for_q = np.expand_dims(
+                        self.vec_frame_stack.gather(k, self.vec_alive_agents_ids[k]), axis=0
+                    )  # (1,n,g,g,ch*n_frames)
+
+                # Append to buffer
+                transition = (
+                    self.vec_padded_states[k],  # (1,n,g,g,ch*n_frames)
+                    padded_actions[k:k + 1],  # (1,n)
+                    rewards[k],  # team_reward, float
+                    next_padded_states,  # (1,n,g,g,ch*n_frames)
+                    bool(dones[k]),  # team_done, bool
+                    self.vec_mask[k:k + 1].copy(),  # (1,n), bool
+                    next_mask,  # (1,n), bool
+                    next_padded_states_for_q,  # (1,n,g,g,ch*n_frames)
+                    alive_agents_ids,  # (1,a), a=num_alive_agent, object
+                    padded_next_alive_agents_ids,  # (1,a'), a'=num_next_alive_agent, object
+                )
+
+                env_buffers[k].append(transition)
+
+                if is_reset:
+                    self.reset_vec_states(k, next_observations[k])
+                else:
+                    self.vec_alive_agents_ids[k] = next_alive_agents_ids
+                    self.vec_padded_states[k] = next_padded_states
+                    self.vec_mask[k] = next_mask[0]
+
+        for env_buffer in env_buffers:
+            self.buffer.extend(env_buffer)
+
+    def compute_td_errors(self):
+        """ 各transitionの初期優先度（td_error）, (b,), b=len(self.buffer) """
         if self.env.config.prioritized_replay:
 
             states = \
@@ -301,8 +467,7 @@ class Actor:
             next_states_for_q = \
                 np.vstack([transition[7] for transition in self.buffer])  # (b,n,g,g,h*n_frames)
 
-            next_q_values, _ = \
-                self.policy(next_states_for_q, mask, training=False)  # (b,n,action_dim)
+            next_q_values = self.get_q_logits(next_states_for_q, mask)  # (b,n,action_dim)
             next_actions = tf.argmax(next_q_values, axis=-1)  # (b,n)
             next_actions = tf.cast(next_actions, dtype=tf.int32)
             next_actions_one_hot = \
@@ -315,7 +480,7 @@ class Actor:
 
             TQ = rewards + self.gamma * (1 - dones) * next_maxQ  # (b,)
 
-            q_values, _ = self.policy(states, mask, training=False)  # (b,n,action_dim)
+            q_values = self.get_q_logits(states, mask)  # (b,n,action_dim)
             actions_one_hot = tf.one_hot(actions, depth=self.action_space_dim)  # (b,n,action_dim)
             Q = tf.reduce_sum(q_values * actions_one_hot, axis=-1)  # (b,n)
 
@@ -328,10 +493,6 @@ class Actor:
                 masked_td_errors / np.sum(mask.astype(np.float32), axis=-1)  # (b,)
 
         else:
-            masked_td_errors = np.ones((self.env.config.actor_rollout_steps,),
-                                       dtype=np.float32)  # (b,)
-
-        transitions = self.buffer
-        self.buffer = []
+            masked_td_errors = np.ones((len(self.buffer),), dtype=np.float32)  # (b,)
 
-        return masked_td_errors, transitions, self.pid
+        return masked_td_errors
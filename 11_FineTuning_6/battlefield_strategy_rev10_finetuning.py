@@ -1,6 +1,5 @@
 import gym
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 import time
 import pprint
@@ -14,10 +13,10 @@ from rewards import get_consolidation_of_force_rewards, get_economy_of_force_rew
 from observations import get_observations
 from engage import engage_and_get_rewards, compute_engage_mask, get_dones
 
-from generate_movies import MakeAnimation
 from utils import compute_current_total_ef_and_force, count_alive_agents
 
-from generate_movies_atention_map import MakeAnimation_AttentionMap
+# (dx,dy) of action 0: NOT MOVE, 1: UP, 2: DOWN, 3: LEFT, 4: RIGHT
+MOVES = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1]], dtype=np.int64)
 
 
 class BattleFieldStrategy(gym.Env):
@@ -49,10 +48,12 @@ class BattleFieldStrategy(gym.Env):
         self.initial_effective_reds_force = None
 
         self.step_count = None
-        self.make_animation = None
+        self.make_animation = None  # Made by AnimationRecorder
 
         self.make_animation_attention_map = None
 
+        self.recorders = []  # EnvRecorder, see add_recorder()
+
     def reset(self):
         self.config.reset()  # Revise config for new episode
 
@@ -72,12 +73,15 @@ class BattleFieldStrategy(gym.Env):
 
         observations = get_observations(self)  # Get initial observations of agents (reds)
 
-        self.make_animation = MakeAnimation(self)  # Animation generator
-
-        self.make_animation_attention_map = MakeAnimation_AttentionMap(self)  # Attention map movie
+        for recorder in self.recorders:
+            recorder.on_reset(self, observations)
 
         return observations
 
+    def add_recorder(self, recorder):
+        """ Attach EnvRecorder, e.g., AnimationRecorder """
+        self.recorders.append(recorder)
+
     def can_move(self, x, y):
         """
         no block: True
@@ -92,31 +96,33 @@ class BattleFieldStrategy(gym.Env):
             return False
 
     def move_reds(self, actions):
-        """ action 0: NOT MOVE, 1: UP, 2: DOWN, 3: LEFT, 4: RIGHT """
-        for red in self.reds:
-            if red.alive:
-                action = actions[red.id]
+        """
+        action 0: NOT MOVE, 1: UP, 2: DOWN, 3: LEFT, 4: RIGHT
+        All alive reds move at once on the arrays of env.reds
+        """
+        alive_idx = np.nonzero(self.reds.alive)[0]  # (a,)
 
-                if action == 1 and self.can_move(red.pos[0] - 1, red.pos[1]):
-                    red.pos[0] -= 1  # UP
+        if len(alive_idx) == 0:
+            return
 
-                elif action == 2 and self.can_move(red.pos[0] + 1, red.pos[1]):
-                    red.pos[0] += 1  # DOWN
+        acts = np.array([actions[self.reds.ids[i]] for i in alive_idx], dtype=np.int64)  # (a,)
 
-                elif action == 3 and self.can_move(red.pos[0], red.pos[1] - 1):
-                    red.pos[1] -= 1  # LEFT
+        # (a,2), no move for undefined actions
+        moves = np.where(((acts >= 0) & (acts < len(MOVES)))[:, np.newaxis],
+                         MOVES[np.clip(acts, 0, len(MOVES) - 1)], 0)
 
-                elif action == 4 and self.can_move(red.pos[0], red.pos[1] + 1):
-                    red.pos[1] += 1  # ROIGHT
+        next_pos = self.reds.pos[alive_idx] + moves  # (a,2)
 
-                else:
-                    pass  # Not move
+        # can_move: inside the boundary and no block
+        inside = np.all((next_pos >= 0) & (next_pos < self.battlefield.shape), axis=1)  # (a,)
+        clipped_pos = np.clip(next_pos, 0, np.array(self.battlefield.shape) - 1)
+        no_block = self.battlefield[clipped_pos[:, 0], clipped_pos[:, 1]] == 0  # (a,)
 
-                if (red.pos[0] < 0) or (red.pos[0] >= self.battlefield.shape[0]):
-                    raise ValueError()
+        movable = inside & no_block
+        self.reds.pos[alive_idx[movable]] = next_pos[movable]
 
-                if (red.pos[1] < 0) or (red.pos[1] >= self.battlefield.shape[1]):
-                    raise ValueError()
+        if np.any(self.reds.pos < 0) or np.any(self.reds.pos >= self.battlefield.shape):
+            raise ValueError()
 
     def move_blues(self):
         """ TBD """
@@ -124,10 +130,9 @@ class BattleFieldStrategy(gym.Env):
 
     def initialize_step_rewards_and_dones(self, rewards, dones):
         """ for all alive agents, initialize by reward=-0.1, done=False """
-        for red in self.reds:
-            if red.alive:
-                rewards[red.id] = -0.1  # Small negative reward in every time step
-                dones[red.id] = False
+        for i in np.nonzero(self.reds.alive)[0]:
+            rewards[self.reds.ids[i]] = -0.1  # Small negative reward in every time step
+            dones[self.reds.ids[i]] = False
 
         return rewards, dones
 
@@ -147,16 +152,8 @@ class BattleFieldStrategy(gym.Env):
         """
         End of episode ?
         """
-        reds_alive_list = []
-        for red in self.reds:
-            reds_alive_list.append(red.alive)
-
-        blues_alive_list = []
-        for blue in self.blues:
-            blues_alive_list.append(blue.alive)
-
-        reds_survive = any(reds_alive_list)
-        blues_survive = any(blues_alive_list)
+        reds_survive = bool(np.any(self.reds.alive))
+        blues_survive = bool(np.any(self.blues.alive))
 
         if reds_survive and blues_survive:
             dones['all_dones'] = False
@@ -198,8 +195,8 @@ class BattleFieldStrategy(gym.Env):
                 infos['remaining_effective_ef_blues'] = remaining_effective_ef_blues
                 infos['remaining_effective_force_blues'] = remaining_effective_force_blues
 
-            for red in self.reds:
-                dones[red.id] = True
+            for red_id in self.reds.ids:
+                dones[red_id] = True
 
         return dones, infos
 
@@ -301,27 +298,22 @@ class BattleFieldStrategy(gym.Env):
         # 5. Get (next) observations after engagement
         observations = get_observations(self)
 
+        for recorder in self.recorders:
+            recorder.on_step(self, actions, observations, reward, done)
+
         return observations, rewards, dones, infos, reward, done
 
     def render(self, mode=None):
         pass
 
     def get_team_params(self):
+        """ number and total effective force of alive agents of each team """
 
-        blues_num = 0
-        blues_force = 0
-        reds_num = 0
-        reds_force = 0
-
-        for blue in self.blues:
-            if blue.alive:
-                blues_num += 1
-                blues_force += blue.effective_force
+        blues_num = int(np.sum(self.blues.alive))
+        blues_force = float(np.sum(self.blues.effective_force[self.blues.alive]))
 
-        for red in self.reds:
-            if red.alive:
-                reds_num += 1
-                reds_force += red.effective_force
+        reds_num = int(np.sum(self.reds.alive))
+        reds_force = float(np.sum(self.reds.effective_force[self.reds.alive]))
 
         return reds_num, reds_force, blues_num, blues_force
 
@@ -378,33 +370,20 @@ class BattleFieldStrategy(gym.Env):
 
     def count_move_reds(self, actions):
         num_move_reds = 0
-        for red in self.reds:
-            if red.alive:
-                if actions[red.id] != 0:
-                    num_move_reds += 1
+        for i in np.nonzero(self.reds.alive)[0]:
+            if actions[self.reds.ids[i]] != 0:
+                num_move_reds += 1
 
         return num_move_reds
 
     def count_group(self):
         """ reds の alive数とcluster数をカウント"""
-        alive_count = 0
-        x = []
-        y = []
-        for red in self.reds:
-            if red.alive:
-                alive_count += 1
-                x.append(red.pos[0])
-                y.append(red.pos[1])
-
-        x = np.array(x)
-        y = np.array(y)
+        alive_pos = self.reds.pos[self.reds.alive]  # (a,2)
+        alive_count = len(alive_pos)
 
-        group_count = 0
-        for i in range(self.config.grid_size):
-            for j in range(self.config.grid_size):
-                num = np.sum(np.where(x == i, 1, 0) * np.where(y == j, 1, 0))
-                if num > 0:
-                    group_count += 1
+        # number of occupied cells
+        cells = alive_pos[:, 0] * self.config.grid_size + alive_pos[:, 1]
+        group_count = len(np.unique(cells))
 
         return alive_count, group_count
 
@@ -416,19 +395,12 @@ class BattleFieldStrategy(gym.Env):
         return self.symlog(c2 * reward)
 
     def compute_force_to_engage(self, x1, y1, agents):
-        counter = 0
-        engaging_force = 0
-        total_force = 0
+        alive = agents.alive
 
-        for agent in agents:
-            if agent.alive:
-                x = agent.pos[0]
-                y = agent.pos[1]
-                total_force += agent.effective_force
+        engaging = alive & np.isin(agents.pos[:, 0], x1) & np.isin(agents.pos[:, 1], y1)
 
-                if (x in x1) and (y in y1):
-                    counter += 1
-                    engaging_force += agent.effective_force
+        counter = int(np.sum(engaging))
+        engaging_force = float(np.sum(agents.effective_force[engaging]))
 
         return counter, engaging_force
 
@@ -555,6 +527,8 @@ def summary_of_whole_episodes(max_episodes, returns_reds_win,
 
 
 def draw_distributions(agent_color, return_agents_win, num_agents_win, filedir, time_stamp):
+    import matplotlib.pyplot as plt
+
     if agent_color == 'reds':
         hist_color = 'red'
     elif agent_color == 'blues':
@@ -609,17 +583,12 @@ def check_code_agent_alive(agents):
     """
     agents = env.reds or env.blues
     """
-    for agent in agents:
-        if agent.alive:
-            criteria_1 = (agent.force > agent.threshold)
-            criteria_2 = (agent.effective_force > 0)
+    criteria_1 = (agents.force > agents.threshold)
+    criteria_2 = (agents.effective_force > 0)
 
-            if not (criteria_1 and criteria_2):
-                raise ValueError()
+    # alive agents must satisfy both, dead agents must satisfy neither
+    if np.any(agents.alive & ~(criteria_1 & criteria_2)):
+        raise ValueError()
 
-        else:
-            criteria_1 = (agent.force <= agent.threshold)
-            criteria_2 = (agent.effective_force <= 0)
-
-            if not (criteria_1 and criteria_2):
-                raise ValueError()
+    if np.any(~agents.alive & (criteria_1 | criteria_2)):
+        raise ValueError()
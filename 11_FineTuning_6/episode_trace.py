@@ -0,0 +1,95 @@
+import re
+
+import numpy as np
+
+static_fields = ('threshold', 'efficiency',
+                 'initial_force', 'initial_ef',
+                 'initial_effective_force', 'initial_effective_ef')  # AgentTeam fields per episode
+
+step_fields = ('force', 'ef', 'effective_force', 'effective_ef')  # AgentTeam fields per step
+
+
+class EpisodeTrace:
+    """
+    Compact binary trace of a test episode, rendered later by render_traces.py.
+    Per step: positions, forces, ef, alive flags of the reds and blues, the actions of the reds,
+    the team reward, and the attention rows of the tracked agent (env.reds[-1]).
+    The arrays of the env teams (AgentTeam) are copied as they are, so tracing costs a few small
+    copies per step.
+
+    Saved by np.savez_compressed:
+        battlefield: (g,g), dt: float, tracked_agent: int
+        red_type, blue_type: (n,) str, red_<static_fields>, blue_<static_fields>: (n,) float32
+        red_pos, blue_pos: (T+1,n,2) int16, red_alive, blue_alive: (T+1,n) bool
+        red_<step_fields>, blue_<step_fields>: (T+1,n) float32, [0] is the state at reset
+        actions: (T,n_reds) int8, -1 for no action (dead), team_reward: (T,) float32
+        attention_rows: (T,num_relation_kernels,num_heads,max_num_red_agents) float32
+    """
+
+    def __init__(self, env):
+        """ Start the trace by the state after env.reset() """
+        self.static = {'battlefield': np.array(env.battlefield, dtype=np.float32),
+                       'dt': env.config.dt,
+                       'tracked_agent': len(env.reds) - 1}
+
+        for color, team in [('red', env.reds), ('blue', env.blues)]:
+            self.static[color + '_type'] = team.type.copy()
+            for name in static_fields:
+                self.static[color + '_' + name] = getattr(team, name).astype(np.float32)
+
+        self.states = {}
+        for color in ['red', 'blue']:
+            for name in ('pos', 'alive') + step_fields:
+                self.states[color + '_' + name] = []
+
+        self.actions = []
+        self.team_reward = []
+        self.attention_rows = []
+
+        # Index of the tracked agent in the attention scores
+        self.tracked_index = int(re.sub(r"\D", "", env.reds[-1].id))
+
+        self.add_state(env)
+
+    def add_state(self, env):
+        for color, team in [('red', env.reds), ('blue', env.blues)]:
+            self.states[color + '_pos'].append(team.pos.astype(np.int16))
+            self.states[color + '_alive'].append(team.alive.copy())
+
+            for name in step_fields:
+                self.states[color + '_' + name].append(getattr(team, name).astype(np.float32))
+
+    def record(self, env, actions, reward, scores):
+        """
+        Call this method every time_step, after env.step(actions)
+        actions: {agent_id: action}, reward: team reward
+        scores: attention scores of the step, [(1,num_heads,n,n),...], len=num_relation_kernels
+        """
+        self.add_state(env)
+
+        self.actions.append(
+            np.array([actions.get(red.id, -1) for red in env.reds], dtype=np.int8))
+        self.team_reward.append(reward)
+
+        self.attention_rows.append(
+            np.stack([np.asarray(score)[0, :, self.tracked_index, :] for score in scores]
+                     ).astype(np.float32))  # (num_relation_kernels,num_heads,n)
+
+    def save(self, filename):
+        trace = dict(self.static)
+
+        for key, values in self.states.items():
+            trace[key] = np.stack(values)
+
+        num_reds = len(self.static['red_type'])
+        trace['actions'] = np.array(self.actions, dtype=np.int8).reshape(-1, num_reds)
+        trace['team_reward'] = np.array(self.team_reward, dtype=np.float32)
+        trace['attention_rows'] = np.array(self.attention_rows, dtype=np.float32)
+
+        np.savez_compressed(filename, **trace)
+
+
+def load_trace(filename):
+    """ :return: {key: ndarray}, see EpisodeTrace """
+    with np.load(filename) as f:
+        return {key: f[key] for key in f.files}
@@ -1,9 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 from finetuning_config import Config
 # from generate_env import random_shape_maze
-from agents_in_env import BLUE, RED
+from agents_in_env import BLUE, RED, AgentTeam
 from utils import summary_of_team, simulate_lanchester, \
     plot_force_history, plot_efficiency_history, \
     visualize_blues_num_map, visualize_reds_num_map, visualize_battlefield_agents_num_map
@@ -97,6 +96,9 @@ def generate_blue_team(agent_class, config, battlefield):
         agent.pos = (config.blue_pos[i] +
                      np.random.choice([-1, 0, 1], size=2, p=[0.2, 0.6, 0.2])).tolist()
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
@@ -152,11 +154,16 @@ def generate_red_team(agent_class, config, battlefield, blues):
         agent.pos = (config.red_pos[i] +
                      np.random.choice([-1, 0, 1], size=2, p=[0.2, 0.6, 0.2])).tolist()
 
+    """ struct-of-arrays store of the team, used as env.blues / env.reds """
+    agents = AgentTeam(agents)
+
     return agents, initial_ef, initial_force, initial_effective_ef, initial_effective_force
 
 
 def main():
     """ Define configuration """
+    import matplotlib.pyplot as plt
+
     config = Config()
     config.reset()
 
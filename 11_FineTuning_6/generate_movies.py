@@ -1,8 +1,9 @@
 import numpy as np
-import os
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
+from fast_movies import EngagementMovieRenderer
+
 from utils import compute_current_total_ef_and_force, add_channel_dim, \
     count_alive_agents, count_alive_platoons_and_companies
 
@@ -158,132 +159,13 @@ class MakeAnimation:
         self.total_force_reds.append(total_effective_force_reds)
         self.total_force_blues.append(total_effective_force_blues)
 
-    def movie_generator(self, fig, ax, content, features_1, features_2, env):
-        dir_save = './test_engagement'
-        if not os.path.exists(dir_save):
-            os.mkdir(dir_save)
-
-        fontsize = 12
-        ims = []
-
-        fig.tight_layout()
-
-        ax[0].tick_params(labelbottom=False, bottom=False, labelleft=False, left=False)
-        ax[1].tick_params(labelbottom=False, bottom=False, labelleft=False, left=False)
-
-        if content == 'efficiency':
-            ax[0].set_title('efficiency', size=fontsize)
-
-        elif content == 'force':
-            ax[0].set_title('norm(force)', size=fontsize)
-
-        elif content == 'efficiency_obs':
-            ax[0].set_title('efficiency', size=fontsize)
-
-        elif content == 'force_obs':
-            ax[0].set_title('norm_obs(force)', size=fontsize)
-
-        else:
-            raise NotImplementedError()
-
-        ax[1].set_title('engagement', size=fontsize)
-
-        step = 0
-        for feature1, feature2 in zip(features_1, features_2):
-            txt1 = ax[0].text(0.0, -5.0,
-                              ('time:' + str(np.round(step * env.config.dt, 2)) + ' sec'),
-                              fontsize=fontsize)
-
-            txt3 = ax[1].text(0.0, -5.0, 'num_alive:: reds:' + str(self.num_alive_reds[step]) +
-                              ',  blues:' + str(self.num_alive_blues[step]),
-                              fontsize=fontsize)
-
-            txt4 = ax[1].text(0.0, -4.0, '   num_alive_reds:: platoons:' +
-                              str(self.num_alive_reds_platoons[step]) +
-                              ',  companies:' + str(self.num_alive_reds_companies[step]),
-                              fontsize=fontsize)
-
-            txt5 = ax[1].text(0.0, -3.0, '   num_alive_blues:: platoons:' +
-                              str(self.num_alive_blues_platoons[step]) +
-                              ',  companies:' + str(self.num_alive_blues_companies[step]),
-                              fontsize=fontsize)
-
-            if (content == 'efficiency') or (content == 'efficiency_obs'):
-                efficiency_reds = np.round(self.total_efficiency_reds[step], 2)
-                efficiency_blues = np.round(self.total_efficiency_blues[step], 2)
-                txt2 = ax[1].text(
-                    0.0, -2.0, 'efficiency_reds:' + str(efficiency_reds) +
-                               ',  efficiency_blues:' + str(efficiency_blues), fontsize=fontsize)
-
-            elif (content == 'force') or (content == 'force_obs'):
-                force_reds = np.round(self.total_force_reds[step], 2)
-                force_blues = np.round(self.total_force_blues[step], 2)
-                txt2 = ax[1].text(
-                    0.0, -2.0,
-                    'remaining: effective_force_reds:' + str(force_reds) +
-                    ',  effective_force_blues:' + str(force_blues), fontsize=fontsize)
-
-            else:
-                raise NotImplementedError()
-
-            im1 = ax[0].imshow(feature1, vmin=0, vmax=1, animated=True)
-            im2 = ax[1].imshow(feature2, vmin=0, vmax=1, animated=True)
-
-            ims.append([im1] + [txt1] + [txt3] + [txt4] + [txt5] + [txt2] + [im2])
-
-            step += 1
-
-        anim = animation.ArtistAnimation(fig, ims, interval=300, blit=True,
-                                         repeat_delay=3000, repeat=True)
-
-        if content == 'efficiency':
-            filename = './test_engagement/efficiency'
-
-        elif content == 'force':
-            filename = './test_engagement/effective_force'
-
-        elif content == 'efficiency_obs':
-            filename = './test_engagement/agent_obs_effective_ef'
-
-        elif content == 'force_obs':
-            filename = './test_engagement/agent_obs_effective_force'
-
-        else:
-            raise NotImplementedError()
-
-        # anim.save(filename + '.gif', writer='imagemagick')
-
-        anim.save(filename + '.mp4', writer='ffmpeg')
-        # For mp4, need 'sudo apt install ffmpeg' @ terminal
-
-    def generate_movies(self, env):
+    def generate_movies(self, env, dir_save='./test_engagement'):
         """
         Call this method
+        The four movies are rendered in one pass over the frames by EngagementMovieRenderer
         """
-
-        features_1 = self.rgb_channel_efficiencies
-        features_2 = self.rgb_channel_engage_forces
-        fig_1, ax_1 = plt.subplots(1, 2, figsize=(12.8, 9.6), tight_layout=True)
-
-        self.movie_generator(fig_1, ax_1, 'efficiency', features_1, features_2, env)
-
-        features_1 = self.rgb_channel_forces
-        features_2 = self.rgb_channel_engage_forces
-        fig_2, ax_2 = plt.subplots(1, 2, figsize=(12.8, 9.6), tight_layout=True)
-
-        self.movie_generator(fig_2, ax_2, 'force', features_1, features_2, env)
-
-        features_1 = self.rgb_channel_efficiencies_obs
-        features_2 = self.rgb_channel_engage_forces_obs
-        fig_3, ax_3 = plt.subplots(1, 2, figsize=(12.8, 9.6), tight_layout=True)
-
-        self.movie_generator(fig_3, ax_3, 'efficiency_obs', features_1, features_2, env)
-
-        features_1 = self.rgb_channel_forces_obs
-        features_2 = self.rgb_channel_engage_forces_obs
-        fig_4, ax_4 = plt.subplots(1, 2, figsize=(12.8, 9.6), tight_layout=True)
-
-        self.movie_generator(fig_4, ax_4, 'force_obs', features_1, features_2, env)
+        renderer = EngagementMovieRenderer(self, dt=env.config.dt)
+        renderer.render(dir_save=dir_save)
 
     def add_observations(self, observations):
         """
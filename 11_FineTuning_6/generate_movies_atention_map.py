@@ -1,10 +1,7 @@
 import numpy as np
 import re
-import os
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib.gridspec as gridspec
 
+from fast_movies import AttentionMovieRenderer
 from utils import add_channel_dim
 
 
@@ -123,64 +120,12 @@ class MakeAnimation_AttentionMap:
         self.rgb_channel_forces_obs.append(rgb_channel_force)
         self.rgb_channel_efficiencies_obs.append(rgb_channel_efficiency)
 
-    def generate_movies(self):
+    def generate_movies(self, dir_save='./test_engagement'):
         """
-        heads_type: 'val_heads' or 'policy_heads'
+        Rendered by AttentionMovieRenderer
         """
-        dir_save = './test_engagement'
-        if not os.path.exists(dir_save):
-            os.mkdir(dir_save)
-
-        fontsize = 12
-        ims = []
-
-        num_subplots = self.num_heads
-
-        num_colms = int(np.ceil(np.sqrt(num_subplots)))  # 2
-        num_rows = int(np.ceil(num_subplots / num_colms))  # 2
-
-        fig = plt.figure(figsize=(19.2, 9.6), tight_layout=True)
-        gs = gridspec.GridSpec(num_rows, num_colms + 1)
-
-        for step in range(len(self.attention_maps[0])):
-            im = []
-
-            # Draw attention score of each heads
-            for row in range(num_rows):
-                for colm in range(num_colms):
-                    relation_kernel = row * num_colms + colm
-
-                    plt.subplot(gs[row, colm])
-                    plt.title(str('relation kernel-' + str(relation_kernel) +
-                                  ':     head_0:red,   head_1:green'))
-                    plt.tick_params(labelbottom=False, bottom=False,
-                                    labelleft=False, left=False)
-                    img = plt.imshow(self.attention_maps[relation_kernel][step],
-                                     vmin=0, vmax=1, animated=True)
-
-                    im += [img]
-
-            txt1 = plt.text(0.0, -3.0, ('time:' + str(np.round(self.dt * step, 2)) + ' sec'),
-                            fontsize=fontsize)
-
-            # Draw force map
-            plt.subplot(gs[:, num_colms])
-            plt.title('remaining force')
-            plt.tick_params(labelbottom=False, bottom=False, labelleft=False, left=False)
-
-            img = plt.imshow(self.rgb_channel_forces_obs[step], vmin=0, vmax=1, animated=True)
-
-            im += [img]
-
-            ims.append(im + [txt1])
-
-        anim = animation.ArtistAnimation(fig, ims, interval=300, blit=True,
-                                         repeat_delay=3000, repeat=True)
-
-        filename = './test_engagement/agent_obs_attention_heads'
-        anim.save(filename + '.mp4', writer='ffmpeg')
-        # For mp4, need 'sudo apt install ffmpeg' @ terminal
-
+        renderer = AttentionMovieRenderer(self)
+        renderer.render(dir_save=dir_save)
 
     def add_observations_3(self, observations):
         """
@@ -0,0 +1,105 @@
+import asyncio
+
+import numpy as np
+import ray
+
+from battlefield_strategy_rev10_finetuning import BattleFieldStrategy
+from models import MarlTransformerModel
+from utils_transformer import make_mask, make_padded_obs
+
+
+@ray.remote
+class InferenceServer:
+    """
+    Centralized batched inference of the actors (SEED-RL style).
+    Actors send padded states and masks, requests are batched up to inference_max_batch_size or
+    inference_timeout, and one forward pass returns greedy actions and Q values of all requests.
+    Only the server holds the policy weights, which are set by main after each learner update.
+    """
+
+    def __init__(self):
+        self.env = BattleFieldStrategy()
+
+        self.policy = MarlTransformerModel(config=self.env.config)
+
+        self.max_batch_size = self.env.config.inference_max_batch_size
+        self.timeout = self.env.config.inference_timeout
+
+        self.requests = []  # [(padded_states, mask, future),...]
+        self.batch_id = 0  # id of the batch being collected
+        self.batch_size = 0  # sum of batch dims of the requests
+
+        self.build_policy()
+
+    def build_policy(self):
+        """ Build graph with dummy inputs """
+        grid_size = self.env.config.grid_size
+        ch = self.env.config.observation_channels
+        n_frames = self.env.config.n_frames
+
+        obs_shape = (grid_size, grid_size, ch * n_frames)
+
+        max_num_agents = self.env.config.max_num_red_agents
+
+        alive_agents_ids = [0, 2]
+        raw_obs = [np.random.rand(*obs_shape) for _ in alive_agents_ids]
+
+        padded_obs = make_padded_obs(max_num_agents, obs_shape, raw_obs)  # (1,n,g,g,ch*n_frames)
+        mask = make_mask(alive_agents_ids, max_num_agents)  # (1,n)
+
+        self.policy(padded_obs, mask, training=False)
+
+    async def set_weights(self, weights):
+        self.policy.set_weights(weights=weights)
+
+    async def infer(self, padded_states, mask):
+        """
+        :param padded_states: (b,n,g,g,ch*n_frames)
+        :param mask: (b,n), bool
+        :return:
+            actions: (b,n), greedy actions
+            q_logits: (b,n,action_dim)
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        self.requests.append((padded_states, mask, future))
+        self.batch_size += padded_states.shape[0]
+
+        if self.batch_size >= self.max_batch_size:
+            self.run_batch()
+
+        elif len(self.requests) == 1:
+            # First request of the batch, run the batch at timeout if not full by then
+            asyncio.get_running_loop().call_later(self.timeout, self.run_batch, self.batch_id)
+
+        return await future
+
+    def run_batch(self, batch_id=None):
+        if (batch_id is not None) and (batch_id != self.batch_id):
+            return  # The batch was already run by max_batch_size
+
+        requests = self.requests
+
+        self.requests = []
+        self.batch_size = 0
+        self.batch_id += 1
+
+        if len(requests) == 0:
+            return
+
+        states = np.concatenate([request[0] for request in requests], axis=0)  # (B,n,g,g,ch*nf)
+        masks = np.concatenate([request[1] for request in requests], axis=0)  # (B,n)
+
+        q_logits, _ = self.policy(states, masks, training=False)
+        q_logits = np.array(q_logits)  # (B,n,action_dim)
+
+        actions = np.argmax(q_logits, axis=-1)  # (B,n)
+
+        start = 0
+        for padded_states, _, future in requests:
+            end = start + padded_states.shape[0]
+
+            if not future.done():
+                future.set_result((actions[start:end], q_logits[start:end]))
+
+            start = end
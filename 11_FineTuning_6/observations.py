@@ -10,6 +10,9 @@ from utils import compute_blue_observation_maps_2, compute_ally_observation_maps
 from utils import compute_blue_observation_maps_3, compute_engage_observation_maps_3, \
     compute_ally_observation_maps_3, compute_my_observation_maps_3
 
+from utils import compute_normalized_force_3, compute_efficiency_3, compute_red_team_maps_3, \
+    compute_ally_cell_ef_and_force_3
+
 """
 observations = {agent_id: obs}
 
@@ -42,12 +45,16 @@ def get_observations_0(env):
     """
     observations: {agent-id: (grid_size, grid_size, env.config.observation_channels)}
      normalized by arc-tan().  6CH
+
+    The red team maps are computed once. The ally map of each red is the team map except at my
+    cell, where only the allies sharing the cell are summed. All observations are written into a
+    single (num_alive_reds, grid_size, grid_size, 6) tensor, and observations[red.id] is its view.
     """
 
     if env.config.observation_channels != 6:
         raise ValueError()
 
-    observations = {}
+    grid_size = env.config.grid_size
 
     """ blue channels, all red agents share the same map """
     blue_normalized_force, blue_efficiency = compute_blue_observation_maps_3(env)
@@ -55,41 +62,36 @@ def get_observations_0(env):
     """ engagement channels, all red agents share the same map """
     # engage_normalized_force = compute_engage_observation_maps_3(env)
 
-    # transform to float32 & add channel dim
-    # battlefield = add_channel_dim(env.battlefield)
+    """ red team channels, all red agents share the same map except at my cell """
+    red_ef, red_force, red_x, red_y = compute_red_team_maps_3(env)
+    ally_cell_ef, ally_cell_force = compute_ally_cell_ef_and_force_3(env, red_x, red_y)
 
-    blue_normalized_force = add_channel_dim(blue_normalized_force)
-    blue_efficiency = add_channel_dim(blue_efficiency)
+    alive_reds = np.nonzero(env.reds.alive)[0]
+    k = np.arange(len(alive_reds))
 
-    # engage_normalized_force = add_channel_dim(engage_normalized_force)
+    obs = np.zeros((len(alive_reds), grid_size, grid_size, 6), dtype=np.float32)
 
-    """ red ally and myself, each red agent has the different map """
+    """ ally """
+    obs[:, :, :, 0] = compute_normalized_force_3(red_force)
+    obs[:, :, :, 1] = compute_efficiency_3(red_force, red_ef)
 
-    for red in env.reds:
-        if red.alive:
-            """ ally """
-            ally_normalized_force, ally_efficiency = compute_ally_observation_maps_3(red, env)
+    obs[k, red_x, red_y, 0] = compute_normalized_force_3(ally_cell_force)
+    obs[k, red_x, red_y, 1] = compute_efficiency_3(ally_cell_force, ally_cell_ef)
 
-            """ myself """
-            my_normalized_force, my_efficiency = compute_my_observation_maps_3(red, env)
+    """ myself """
+    my_ef = env.reds.ef[alive_reds].astype(np.float32)
+    my_force = env.reds.force[alive_reds].astype(np.float32)
 
-            # transform to float32 & add channel dim
-            ally_normalized_force = add_channel_dim(ally_normalized_force)
-            ally_efficiency = add_channel_dim(ally_efficiency)
+    obs[k, red_x, red_y, 2] = compute_normalized_force_3(my_force)
+    obs[k, red_x, red_y, 3] = compute_efficiency_3(my_force, my_ef)
 
-            my_normalized_force = add_channel_dim(my_normalized_force)
-            my_efficiency = add_channel_dim(my_efficiency)
+    """ blue """
+    obs[:, :, :, 4] = blue_normalized_force
+    obs[:, :, :, 5] = blue_efficiency
 
-            observations[red.id] = np.concatenate(
-                [
-                 ally_normalized_force,
-                 ally_efficiency,
-                 my_normalized_force,
-                 my_efficiency,
-                 blue_normalized_force,
-                 blue_efficiency,
-                 # engage_normalized_force,
-                 ], axis=2)
+    observations = {}
+    for m, i in enumerate(alive_reds):
+        observations[env.reds.ids[i]] = obs[m]
 
     return observations
 
@@ -0,0 +1,78 @@
+import queue
+import threading
+
+import ray
+import tensorflow as tf
+
+from replay import concatenate_blocks
+
+
+def block_to_tensors(block):
+    """
+    MinibatchBlock -> inputs of Learner.train_step, transferred to the device at once
+    :return: (states, actions, rewards, dones, masks, next_states_for_q, correction_weights)
+    """
+    return (
+        tf.convert_to_tensor(block.states, dtype=tf.float32),
+        tf.convert_to_tensor(block.actions, dtype=tf.int32),
+        tf.convert_to_tensor(block.rewards, dtype=tf.float32),
+        tf.convert_to_tensor(block.dones, dtype=tf.float32),  # bool->float32
+        tf.convert_to_tensor(block.masks, dtype=tf.float32),  # bool->float32
+        tf.convert_to_tensor(block.next_states_for_q, dtype=tf.float32),
+        tf.convert_to_tensor(block.correction_weights, dtype=tf.float32),
+    )
+
+
+class MinibatchPrefetcher:
+    """
+    Background thread of the learner, which pulls the MinibatchBlocks of the next update cycles
+    from the ReplayServer shards, and keeps them tensor-ready in a bounded queue.
+    The learner takes a ready block by get(), and does not wait on sampling or stacking.
+
+    The queue holds up to prefetch_depth blocks, and one more block is being prepared, so the
+    priorities used for sampling a block are up to prefetch_depth+1 learner cycles stale.
+    """
+
+    def __init__(self, replay_shards, batch_size, prefetch_depth):
+        """
+        :param replay_shards: [(shard, num_minibatchs of the shard),...]
+        """
+        if prefetch_depth < 1:
+            raise ValueError()
+
+        self.replay_shards = replay_shards
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue(maxsize=prefetch_depth)  # [(indices, tensors),...]
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                blocks = ray.get([
+                    shard.sample_block.remote(batch_size=self.batch_size,
+                                              num_minibatchs=num_minibatchs)
+                    for shard, num_minibatchs in self.replay_shards])
+
+                block = concatenate_blocks(blocks)  # ordered by the shards
+
+                # queueが満杯の間はblockし、次のsampleを遅らせる (staleness bound)
+                self.queue.put((block.indices.reshape(-1).tolist(), block_to_tensors(block)))
+
+        except Exception as e:
+            self.queue.put(e)  # Raised in the learner by get()
+
+    def get(self):
+        """
+        :return:
+            indices: [int,...], len=num_minibatchs*batch_size, slots of the shards
+            tensors: block_to_tensors of the block
+        """
+        item = self.queue.get()
+
+        if isinstance(item, Exception):
+            raise item
+
+        return item
@@ -0,0 +1,242 @@
+import os
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+import ray
+
+from agents_in_env import RED, BLUE, AgentTeam
+from finetuning_config import Config
+from episode_trace import load_trace, static_fields, step_fields
+from generate_movies import MakeAnimation
+from generate_movies_atention_map import MakeAnimation_AttentionMap
+from observations import get_observations
+
+
+class TraceEnv:
+    """
+    Env-like view of a traced episode for MakeAnimation, MakeAnimation_AttentionMap and
+    get_observations: battlefield, config, and the teams (AgentTeam) set to the state of a step.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+
+        self.config = Config()
+        self.config.dt = float(trace['dt'])
+
+        self.battlefield = trace['battlefield']
+        self.config.grid_size = self.battlefield.shape[0]
+
+        self.reds = self.make_team(RED, 'red')
+        self.blues = self.make_team(BLUE, 'blue')
+
+        self.config.num_red_agents = len(self.reds)
+        self.config.num_blue_agents = len(self.blues)
+
+        self.num_steps = len(trace['team_reward'])
+
+    def make_team(self, agent_class, color):
+        agents = []
+
+        for idx, agent_type in enumerate(self.trace[color + '_type']):
+            agent = agent_class(str(agent_type), self.config)
+            agent.id = color + '_' + str(idx)
+
+            for name in static_fields:
+                setattr(agent, name, float(self.trace[color + '_' + name][idx]))
+
+            agent.pos = self.trace[color + '_pos'][0, idx].tolist()
+            agent.alive = bool(self.trace[color + '_alive'][0, idx])
+
+            for name in step_fields:
+                setattr(agent, name, float(self.trace[color + '_' + name][0, idx]))
+
+            agents.append(agent)
+
+        return AgentTeam(agents)
+
+    def set_step(self, step):
+        """ State of the step, 0 is the state at reset """
+        for color, team in [('red', self.reds), ('blue', self.blues)]:
+            team.pos[...] = self.trace[color + '_pos'][step]
+            team.alive[...] = self.trace[color + '_alive'][step]
+
+            for name in step_fields:
+                getattr(team, name)[...] = self.trace[color + '_' + name][step]
+
+
+def make_movies(env, dir_save):
+    """ Movies of MakeAnimation and MakeAnimation_AttentionMap, as made by Tester.test_play """
+    make_animation = MakeAnimation(env)
+    make_animation_attention_map = MakeAnimation_AttentionMap(env)
+
+    tracked = env.reds[int(env.trace['tracked_agent'])]
+    i = int(tracked.id.split('_')[-1])
+
+    attention_rows = env.trace['attention_rows']  # (T,num_relation_kernels,num_heads,n)
+
+    for step in range(env.num_steps + 1):
+        env.set_step(step)
+
+        make_animation.add_frame(env)
+
+        if not tracked.alive:
+            continue
+
+        observations = get_observations(env)[tracked.id]
+        make_animation.add_observations_3(observations)
+
+        if step == 0:
+            continue
+
+        # Attention scores of the step, by the alive agents before the step
+        alive_agents_ids = np.nonzero(env.trace['red_alive'][step - 1])[0].tolist()
+
+        n = attention_rows.shape[-1]
+        atts = []
+        for rows in attention_rows[step - 1]:
+            att_scores = np.zeros((1, rows.shape[0], n, n), dtype=np.float32)
+            att_scores[0, :, i, :] = rows
+            atts.append(att_scores)
+
+        for relation_kernel in range(len(atts)):
+            make_animation_attention_map.add_att_map(
+                relation_kernel=relation_kernel,
+                agent_id=tracked.id,
+                alive_agents_ids=alive_agents_ids,
+                atts=atts,
+            )
+
+        make_animation_attention_map.add_observations_3(observations)
+
+    make_animation.generate_movies(env, dir_save=dir_save)
+    make_animation_attention_map.generate_movies(dir_save=dir_save)
+
+
+def count_groups(pos, alive):
+    """
+    Num of red clusters after each step, as Tester.count_group: num of cells of the alive reds
+    :param pos: (T,n,2), alive: (T,n)
+    """
+    return np.array([len(set(map(tuple, step_pos[step_alive].tolist())))
+                     for step_pos, step_alive in zip(pos, alive)])
+
+
+def make_time_plot(trace, dir_save):
+    """
+    Time plots of Tester.make_time_plot: platoons.png, companies.png, teams.png.
+    The lower panels of teams.png are the red clusters, as Tester.count_group.
+    """
+    steps = np.arange(len(trace['team_reward']))
+    eps = 1e-3
+
+    # history[(color, agent_type)]: num, force, efficiency, ef of the alive agents after each step
+    history = {}
+    for color in ['red', 'blue']:
+        alive = trace[color + '_alive'][1:]
+        efficiency = trace[color + '_efficiency'].astype(np.float64)
+
+        for agent_type in ['platoon', 'company']:
+            mask = alive & (trace[color + '_type'] == agent_type)
+
+            history[(color, agent_type)] = {
+                'num': np.sum(mask, axis=1),
+                'force': np.sum(trace[color + '_effective_force'][1:] * mask, axis=1),
+                'efficiency': np.sum(efficiency * mask, axis=1),
+                'ef': np.sum(trace[color + '_force'][1:] * efficiency * mask, axis=1),
+            }
+
+        history[(color, 'team')] = {
+            key: history[(color, 'platoon')][key] + history[(color, 'company')][key]
+            for key in ['num', 'force', 'efficiency', 'ef']}
+
+    num_red_groups = count_groups(trace['red_pos'][1:], trace['red_alive'][1:])
+
+    for agent_type, label, filename in [('platoon', 'platoons', 'platoons'),
+                                        ('company', 'companies', 'companies'),
+                                        ('team', 'platoons + companies', 'teams')]:
+        red = history[('red', agent_type)]
+        blue = history[('blue', agent_type)]
+
+        fig, axe = plt.subplots(nrows=2, ncols=2, squeeze=False, figsize=(14, 8))
+
+        axe[0, 0].plot(steps, red['num'], 'r')
+        axe[0, 0].plot(steps, blue['num'], 'b')
+        axe[0, 0].set_title('Num of alive ' + label)
+        axe[0, 0].grid()
+
+        axe[0, 1].plot(steps, red['force'], 'r')
+        axe[0, 1].plot(steps, blue['force'], 'b')
+        axe[0, 1].set_title('Remaining effective force of ' + label)
+        axe[0, 1].grid()
+
+        if agent_type == 'team':
+            axe[1, 0].plot(steps, num_red_groups, 'r')
+            axe[1, 0].set_title('Num of red cluster')
+            axe[1, 0].grid()
+
+            axe[1, 1].plot(steps, red['num'] / num_red_groups, 'r')
+            axe[1, 1].set_title('(alive red_agents)/(Num of red cluster)')
+            axe[1, 1].grid()
+
+        else:
+            axe[1, 0].plot(steps, red['efficiency'] / (red['num'] + eps), 'r')
+            axe[1, 0].plot(steps, blue['efficiency'] / (blue['num'] + eps), 'b')
+            axe[1, 0].set_title('Average remaining efficiency of ' + label)
+            axe[1, 0].grid()
+
+            axe[1, 1].plot(steps, red['ef'], 'r')
+            axe[1, 1].plot(steps, blue['ef'], 'b')
+            axe[1, 1].set_title('Remaining efficiency * force of ' + label)
+            axe[1, 1].grid()
+
+        fig.savefig(dir_save + '/' + filename, dpi=300)
+        plt.close(fig)
+
+
+def render_trace(filename, dir_save, movies=True, time_plot=True):
+    if not os.path.exists(dir_save):
+        os.makedirs(dir_save)
+
+    trace = load_trace(filename)
+
+    if movies:
+        make_movies(TraceEnv(trace), dir_save)
+
+    if time_plot:
+        make_time_plot(trace, dir_save)
+
+
+@ray.remote(num_cpus=1)
+def render_trace_remote(filename, dir_save, movies, time_plot):
+    render_trace(filename, dir_save, movies=movies, time_plot=time_plot)
+
+
+def main():
+    """
+    Render the traced test episodes (config.trace_episodes) to the movies and the time plots,
+    in parallel across the episodes. The traces of each test_play are in its subdirectory, and
+    the outputs of ./test_engagement/traces/<test>/<name>.npz are saved in
+    ./test_engagement/traces/<test>/<name>/.
+    """
+    movies = True
+    time_plot = True
+
+    trace_dir = Path('./test_engagement/traces')
+    filenames = sorted(trace_dir.glob('*/*.npz'))
+
+    ray.init(ignore_reinit_error=True)
+
+    wip_renders = [
+        render_trace_remote.remote(str(filename), str(filename.parent / filename.stem), movies,
+                                   time_plot)
+        for filename in filenames]
+
+    ray.get(wip_renders)
+
+    ray.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,80 @@
-import zlib
 from dataclasses import dataclass
 import numpy as np
-import random
-import pickle
 
 
 @dataclass
 class Experience:
+    """ Sampled batch of transitions, stacked along the batch dim """
     states: np.ndarray
     actions: np.ndarray
-    reward: float
+    reward: np.ndarray
     next_states: np.ndarray
-    done: bool
+    done: np.ndarray
     masks: np.ndarray
     next_masks: np.ndarray
     next_states_for_q: np.ndarray
     alive_agents_ids: np.ndarray
 
 
+@dataclass
+class MinibatchBlock:
+    """
+    num_minibatchs minibatchs of batch_size, pre-stacked to (M,B,...) for the learner update.
+    Only the fields used by the learner update are kept.
+    """
+    indices: np.ndarray  # (M,B), sampled slots
+    correction_weights: np.ndarray  # (M,B), Importance samplingの補正用重み
+    states: np.ndarray  # (M,B,n,g,g,ch*n_frames), float32
+    actions: np.ndarray  # (M,B,n), int32
+    rewards: np.ndarray  # (M,B), float32
+    dones: np.ndarray  # (M,B), bool
+    masks: np.ndarray  # (M,B,n), bool
+    next_states_for_q: np.ndarray  # (M,B,n,g,g,ch*n_frames), float32
+
+    @property
+    def nbytes(self):
+        return sum([getattr(self, field).nbytes for field in self.__dataclass_fields__])
+
+
+def concatenate_blocks(blocks):
+    """ Concatenate MinibatchBlocks along the minibatch dim, (sum of M,B,...) """
+    if len(blocks) == 1:
+        return blocks[0]
+
+    return MinibatchBlock(
+        **{field: np.concatenate([getattr(block, field) for block in blocks], axis=0)
+           for field in MinibatchBlock.__dataclass_fields__})
+
+
 class Replay:
-    def __init__(self, buffer_size, compress=True):
+    """
+    Array-backed replay: each field of the transitions is stored in a preallocated ring buffer,
+    indexed by slot. The ring buffers are allocated at the first add, by the shapes of the
+    transitions. sample() gathers a batch by fancy-indexing, and returns stacked arrays.
+
+    Each observation is stored once:
+     - next_states of slot s is states of slot s+1, when they are the same (linked), i.e., the
+       next transition of the same episode. Otherwise (end of episode or end of rollout),
+       next_states is kept in self.unlinked_next_states[s].
+     - next_states_for_q is the re-indexing of next_states by alive_agents_ids, kept as the
+       index to the agent dim of next_states (-1 for the agents not alive in next_states).
+    """
+
+    def __init__(self, buffer_size):
         self.buffer_size = buffer_size
         self.priorities = SumTree(capacity=self.buffer_size)  # Priority(|TD_error|)の入れ物
-        self.buffer = [None] * self.buffer_size
+
+        # Ring buffers, allocated in 'allocate_buffers'
+        self.states = None  # (N,n,g,g,ch*n_frames), float32
+        self.actions = None  # (N,n), int32
+        self.rewards = None  # (N,), float32
+        self.next_linked = None  # (N,), bool, next_states[s] = states[s+1]
+        self.unlinked_next_states = {}  # {slot: (n,g,g,ch*n_frames)}, not linked next_states
+        self.dones = None  # (N,), bool
+        self.masks = None  # (N,n), bool
+        self.next_masks = None  # (N,n), bool
+        self.next_states_for_q_index = None  # (N,n), int32, -1 for zero padding
+        self.alive_agents_ids = None  # (N,n), int32, padded by -1
 
         # 優先度計算に使うパラメータ
         self.alpha = 0.6
@@ -31,7 +83,21 @@ class Replay:
         self.count = 0  # 現在のbuffer index
         self.is_full = False  # Bufferが満杯か否か
 
-        self.compress = compress  # 圧縮するか否か
+    def allocate_buffers(self, transition):
+        """ Allocate the ring buffers by the shapes of the transition """
+        states_shape = transition[0].shape[1:]  # (n,g,g,ch*n_frames)
+        max_num_agents = transition[1].shape[1]  # n
+
+        self.states = np.zeros((self.buffer_size,) + states_shape, dtype=np.float32)
+        self.actions = np.zeros((self.buffer_size, max_num_agents), dtype=np.int32)
+        self.rewards = np.zeros((self.buffer_size,), dtype=np.float32)
+        self.next_linked = np.zeros((self.buffer_size,), dtype=bool)
+        self.dones = np.zeros((self.buffer_size,), dtype=bool)
+        self.masks = np.zeros((self.buffer_size, max_num_agents), dtype=bool)
+        self.next_masks = np.zeros((self.buffer_size, max_num_agents), dtype=bool)
+        self.next_states_for_q_index = \
+            np.full((self.buffer_size, max_num_agents), -1, dtype=np.int32)
+        self.alive_agents_ids = np.full((self.buffer_size, max_num_agents), -1, dtype=np.int32)
 
     def add(self, td_errors, transitions):
         """
@@ -51,26 +117,91 @@ class Replay:
                             next_mask,  # (1,n), bool
                             next_padded_states_for_q,  # (1,n,g,g,ch*n_frames)
                             alive_agents_ids,  # (1,a), a=num_alive_agent, object
+                            next_alive_agents_ids,  # (1,a'), object
                         )
         """
         assert len(td_errors) == len(transitions)
 
+        if self.states is None:
+            self.allocate_buffers(transitions[0])
+
         priorities = (np.abs(td_errors) + 1e-5) ** self.alpha  # (10,)
 
-        for priority, transition in zip(priorities, transitions):
-            self.priorities[self.count] = priority  # int
+        # slots of the ring buffers
+        slots = (self.count + np.arange(len(transitions))) % self.buffer_size  # (10,)
+
+        states = np.vstack([transition[0] for transition in transitions]).astype(np.float32)
+
+        # Link the last transition of the previous add, when states[0] is its next_states
+        last_slot = (self.count - 1) % self.buffer_size
+
+        if (last_slot in self.unlinked_next_states) and \
+                np.array_equal(self.unlinked_next_states[last_slot], states[0]):
+            del self.unlinked_next_states[last_slot]
+            self.next_linked[last_slot] = True
 
-            exp = Experience(*transition)
+        for slot in slots:
+            self.unlinked_next_states.pop(slot, None)  # overwritten transitions
 
-            if self.compress:
-                exp = zlib.compress(pickle.dumps(exp))
+        self.states[slots] = states
+        self.actions[slots] = np.vstack([transition[1] for transition in transitions])
+        self.rewards[slots] = [transition[2] for transition in transitions]
+        self.dones[slots] = [transition[4] for transition in transitions]
+        self.masks[slots] = np.vstack([transition[5] for transition in transitions])
+        self.next_masks[slots] = np.vstack([transition[6] for transition in transitions])
 
-            self.buffer[self.count] = exp
-            self.count += 1
+        self.alive_agents_ids[slots] = -1
+        for t, (slot, transition) in enumerate(zip(slots, transitions)):
+            alive_agents_ids = transition[8][0]  # (a,)
+            self.alive_agents_ids[slot, :len(alive_agents_ids)] = alive_agents_ids
 
-            if self.count == self.buffer_size:
-                self.count = 0
-                self.is_full = True
+            # next_states of slot
+            next_states = transition[3][0].astype(np.float32)  # (n,g,g,ch*n_frames)
+
+            if (t + 1 < len(transitions)) and np.array_equal(next_states, states[t + 1]):
+                self.next_linked[slot] = True
+            else:
+                self.next_linked[slot] = False
+                self.unlinked_next_states[slot] = next_states
+
+            self.next_states_for_q_index[slot] = \
+                self.get_next_states_for_q_index(alive_agents_ids, transition[9][0],
+                                                 len(self.next_states_for_q_index[slot]))
+
+        self.priorities.update(slots, priorities)
+
+        if self.count + len(transitions) >= self.buffer_size:
+            self.is_full = True
+
+        self.count = (self.count + len(transitions)) % self.buffer_size
+
+    @staticmethod
+    def get_next_states_for_q_index(alive_agents_ids, next_alive_agents_ids, max_num_agents):
+        """
+        next_states_for_q[i] = next_states[index[i]], or zero padding if index[i] = -1,
+        as make_next_states_for_q
+        :param alive_agents_ids: (a,), next_alive_agents_ids: (a',)
+        :return: index: (n,)
+        """
+        next_alive_agents_ids = list(next_alive_agents_ids)
+
+        index = np.full(max_num_agents, -1, dtype=np.int32)  # (n,)
+
+        for i, a in enumerate(alive_agents_ids):
+            if a in next_alive_agents_ids:
+                index[i] = next_alive_agents_ids.index(a)
+
+        return index
+
+    def get_next_states(self, slots):
+        """ next_states of slots, (b,n,g,g,ch*n_frames) """
+        next_states = self.states[(slots + 1) % self.buffer_size]
+
+        for i, slot in enumerate(slots):
+            if not self.next_linked[slot]:
+                next_states[i] = self.unlinked_next_states[slot]
+
+        return next_states
 
     def update_priprity(self, indices, td_errors):
         """
@@ -78,9 +209,8 @@ class Replay:
             indices=[int,...], len=batch*num_minibatchs=32*10=320, (indices_all in 'learner')
             td_errors=[float,...], len=batch*num_minibatchs=32*10=320, (td_errors_all in 'learner')
         """
-        for idx, td_error in zip(indices, td_errors):
-            priority = (abs(td_error) + 1e-5) ** self.alpha  # (n,)
-            self.priorities[idx] = priority
+        priorities = (np.abs(np.asarray(td_errors)) + 1e-5) ** self.alpha  # (320,)
+        self.priorities.update(indices, priorities)
 
     def sample(self, batch_size):
         """
@@ -89,37 +219,96 @@ class Replay:
             sampled_indices: サンプルした経験のインデクスのリスト, [int,...], len=batch_size
             weights: サンプルした経験の重み(Importance samplingの補正用の重み)のリスト,
                      ndarray, (batch_size,)
-            experience: サンプルした経験、transitionのリスト, [transition,...], len=batch_size
-        """
-        sampled_indices = [self.priorities.sample() for _ in range(batch_size)]
-
-        # compute prioritized experience replay weights (Importance samplingの補正重み）
-        weights = []
-        current_replay_size = len(self.buffer) if self.is_full else self.count
-        for idx in sampled_indices:
-            probability = self.priorities[idx] / self.priorities.sum()
-            weight = (current_replay_size * probability) ** (-self.beta)
-            weights.append(weight)
-        weights = np.array(weights) / max(weights)  # 安定性の理由から正規化, np.array, (32,)
-
-        if self.compress:
-            experiences = [pickle.loads(zlib.decompress(self.buffer[idx]))
-                           for idx in sampled_indices]
-        else:
-            experiences = [self.buffer[idx] for idx in sampled_indices]
+            experiences: サンプルした経験, Experience of stacked arrays
+                states: (batch_size,n,g,g,ch*n_frames), actions: (batch_size,n),
+                reward: (batch_size,), ..., alive_agents_ids: (batch_size,n), padded by -1
+        """
+        # stratified sampling
+        slots = self.priorities.sample(batch_size=batch_size)  # (batch_size,)
+        sampled_indices = slots.tolist()
+
+        weights = self.get_correction_weights(slots)  # 補正用重み, (batch_size,)
+
+        next_states = self.get_next_states(slots)  # (b,n,g,g,ch*n_frames)
+
+        experiences = Experience(
+            states=self.states[slots],
+            actions=self.actions[slots],
+            reward=self.rewards[slots],
+            next_states=next_states,
+            done=self.dones[slots],
+            masks=self.masks[slots],
+            next_masks=self.next_masks[slots],
+            next_states_for_q=self.get_next_states_for_q(slots, next_states),
+            alive_agents_ids=self.alive_agents_ids[slots],
+        )
 
         return sampled_indices, weights, experiences  # weights: 補正用重み
 
+    def sample_block(self, batch_size, num_minibatchs):
+        """
+        num_minibatchs minibatchs of batch_size, same as num_minibatchs calls of sample(),
+        gathered at once into the stacked (M,B,...) arrays of the learner update
+        :return: MinibatchBlock
+        """
+        # stratified sampling of each minibatch
+        slots = np.concatenate([self.priorities.sample(batch_size=batch_size)
+                                for _ in range(num_minibatchs)])  # (M*B,)
+
+        next_states = self.get_next_states(slots)  # (M*B,n,g,g,ch*n_frames)
+        next_states_for_q = self.get_next_states_for_q(slots, next_states)
+
+        block_shape = (num_minibatchs, batch_size)
+
+        return MinibatchBlock(
+            indices=slots.reshape(block_shape),
+            correction_weights=self.get_correction_weights(slots).reshape(block_shape),
+            states=self.states[slots].reshape(block_shape + self.states.shape[1:]),
+            actions=self.actions[slots].reshape(block_shape + self.actions.shape[1:]),
+            rewards=self.rewards[slots].reshape(block_shape),
+            dones=self.dones[slots].reshape(block_shape),
+            masks=self.masks[slots].reshape(block_shape + self.masks.shape[1:]),
+            next_states_for_q=next_states_for_q.reshape(block_shape + next_states.shape[1:]),
+        )
+
+    def get_correction_weights(self, slots):
+        """
+        compute prioritized experience replay weights (Importance samplingの補正重み）
+        normalized by the max weight, given by the cached min priority
+        """
+        current_replay_size = self.buffer_size if self.is_full else self.count
+        probabilities = self.priorities[slots] / self.priorities.sum()  # (32,)
+        min_probability = self.priorities.min() / self.priorities.sum()
+
+        weights = (current_replay_size * probabilities) ** (-self.beta)
+        max_weight = (current_replay_size * min_probability) ** (-self.beta)
+
+        return weights / max_weight  # 安定性の理由から正規化, np.array, (32,)
+
+    def get_next_states_for_q(self, slots, next_states):
+        """ next_states_for_q by gathering next_states, (b,n,g,g,ch*n_frames) """
+        index = self.next_states_for_q_index[slots]  # (b,n)
+        next_states_for_q = np.take_along_axis(
+            next_states, np.maximum(index, 0)[:, :, np.newaxis, np.newaxis, np.newaxis], axis=1)
+        next_states_for_q[index < 0] = 0
+
+        return next_states_for_q
+
 
 class SumTree:
     """
     Sum-tree implementation
     https://colab.research.google.com/drive/1yYXAg5M9BoDPzEh6iS6LUB4P4S-2n3e9?usp=sharing
+
+    Array-backed: values[1] is the root, values[capacity:] are the leaves (priorities).
+    update() and sample() process a batch of indices level by level.
+    min_values is the min-tree of the leaves, for the cached min priority.
     """
 
     def __init__(self, capacity: int):
         self.capacity = capacity  # capacity=N, データ数の最大値
-        self.values = [0 for _ in range(2 * capacity)]  # 2N-1個の入れ物を用意
+        self.values = np.zeros(2 * capacity, dtype=np.float64)  # 2N-1個の入れ物を用意
+        self.min_values = np.full(2 * capacity, np.inf, dtype=np.float64)  # 空の葉はinf
 
     def __str__(self):
         # print(sumtree)で、データの重みを表示
@@ -127,26 +316,38 @@ class SumTree:
 
     def __setitem__(self, idx, val):
         """
-        1. sumtree[idx]=valにより、データの重みを葉に格納
-        2. 葉から遡って親ノードの値をroot nodeまで計算
+        sumtree[idx]=valにより、データの重みを葉に格納
+        """
+        self.update([idx], [val])
+
+    def __getitem__(self, idx):
+        """
+        sumtree[idx]でvalを返す, idx can be an array of indices
+        """
+        return self.values[np.asarray(idx) + self.capacity]
+
+    def update(self, indices, priorities):
+        """
+        1. データの重みを葉に格納 (the last one is used for duplicated indices)
+        2. 葉から遡って親ノードの値をroot nodeまで, level by level に計算
+        :param indices: [int,...] or (b,)
+        :param priorities: [float,...] or (b,)
         """
-        idx = idx + self.capacity  # データ部分のインデクス
-        self.values[idx] = val  # データの重みを格納
+        idx = np.asarray(indices, dtype=np.int64) + self.capacity  # データ部分のインデクス
+        self.values[idx] = priorities  # データの重みを格納
+        self.min_values[idx] = priorities
 
         # root nodeまで遡って親に子の合計値を計算していく
-        current_idx = idx // 2  # 親のインデクス
-        while current_idx >= 1:  # root nodeまで遡って計算
+        current_idx = np.unique(idx // 2)  # 親のインデクス
+        while len(current_idx) > 0:
             idx_lchild = current_idx * 2  # 左の子のインデクス
             idx_rchild = current_idx * 2 + 1  # 右の子のインデクス
+
             self.values[current_idx] = self.values[idx_lchild] + self.values[idx_rchild]
-            current_idx = current_idx // 2  # 1つノードをさかのぼる
+            self.min_values[current_idx] = \
+                np.minimum(self.min_values[idx_lchild], self.min_values[idx_rchild])
 
-    def __getitem__(self, idx):
-        """
-        sumtree[idx]でvalを返す
-        """
-        idx = idx + self.capacity  # データ部分のインデクス
-        return self.values[idx]
+            current_idx = np.unique(current_idx[current_idx > 1] // 2)  # 1つノードをさかのぼる
 
     def sum(self):
         """
@@ -154,23 +355,47 @@ class SumTree:
         """
         return self.values[1]
 
-    def sample(self, z=None):
+    def min(self):
+        """
+        葉の最小値 (min priority of the stored data), cached in the root of the min-tree
+        """
+        return self.min_values[1]
+
+    def sample(self, batch_size=None, z=None):
         """
         データの重みに比例した割合で、データのインデクスをサンプリングする
+        batch_size is given: stratified sampling, one index from each of the batch_size segments
+        of [0, sum), (batch_size,)
+        else: one index, int
         """
-        z = random.uniform(0, self.sum()) if z is None else z
+        if z is None:
+            if batch_size is None:
+                z = np.random.uniform(0, self.sum(), size=1)
+            else:
+                segment = self.sum() / batch_size
+                z = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        else:
+            z = np.atleast_1d(np.asarray(z, dtype=np.float64)).copy()
 
-        current_idx = 1  # root node
-        while current_idx < self.capacity:
-            idx_lchild = 2 * current_idx  # 左の子のインデクス
-            idx_rchild = 2 * current_idx + 1  # 右の子のインデクス
+        current_idx = np.ones(len(z), dtype=np.int64)  # root node
+        descending = current_idx < self.capacity
+        while np.any(descending):
+            node = current_idx[descending]
+            idx_lchild = 2 * node  # 左の子のインデクス
+            lvalue = self.values[idx_lchild]
 
             # 左の子の値よりもzが大きい時は右の子ノードへ移り、zを更新
-            if self.values[idx_lchild] < z:
-                current_idx = idx_rchild
-                z = z - self.values[idx_lchild]
-            else:
-                current_idx = idx_lchild
+            to_right = lvalue < z[descending]
+
+            z[descending] = np.where(to_right, z[descending] - lvalue, z[descending])
+            current_idx[descending] = np.where(to_right, idx_lchild + 1, idx_lchild)
+
+            descending = current_idx < self.capacity
 
         # 見かけ上のインデクス（データのインデクス）に戻して返す
-        return current_idx - self.capacity
+        indices = current_idx - self.capacity
+
+        if batch_size is None:
+            return int(indices[0])
+
+        return indices
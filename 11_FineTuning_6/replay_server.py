@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+import ray
+
+from replay import Replay
+
+
+@ray.remote
+class ReplayServer:
+    """
+    A shard of the replay buffer (Ape-X style).
+    Actors push their rollouts to the shard by add(), the learner pulls pre-stacked minibatchs by
+    sample_block() and sends the updated priorities back by update_priority(), without going
+    through the driver.
+    Each shard has its own Replay (capacity/num_replay_shards) and its own priorities, so the
+    indices of the sampled minibatchs are the slots of the shard.
+    """
+
+    def __init__(self, shard_id, buffer_size):
+        self.shard_id = shard_id
+
+        self.replay = Replay(buffer_size=buffer_size)
+
+        self.num_adds = 0  # 追加されたrollout数
+
+        self.stats = new_replay_stats()  # telemetry since the last get_stats
+
+    def add(self, td_errors, transitions):
+        start = time.time()
+
+        self.replay.add(td_errors, transitions)
+        self.num_adds += 1
+
+        self.stats['add_time'] += time.time() - start
+        self.stats['num_adds'] += 1
+
+    def get_num_adds(self):
+        return self.num_adds
+
+    def sample_block(self, batch_size, num_minibatchs):
+        """
+        :return: MinibatchBlock, num_minibatchs minibatchs pre-stacked to (M,B,...)
+        """
+        start = time.time()
+
+        block = self.replay.sample_block(batch_size=batch_size, num_minibatchs=num_minibatchs)
+
+        self.stats['sample_time'] += time.time() - start
+        self.stats['num_samples'] += 1
+
+        return block
+
+    def update_priority(self, indices, td_errors):
+        start = time.time()
+
+        self.replay.update_priprity(indices, td_errors)
+
+        self.stats['update_time'] += time.time() - start
+        self.stats['num_updates'] += 1
+
+    def get_stats(self):
+        """ Telemetry since the last call, see new_replay_stats """
+        stats = self.stats
+        self.stats = new_replay_stats()
+
+        return stats
+
+
+def new_replay_stats():
+    """ Replay latency telemetry, sec and counts of add, sample(_block) and update_priority """
+    return {'add_time': 0., 'num_adds': 0,
+            'sample_time': 0., 'num_samples': 0,
+            'update_time': 0., 'num_updates': 0}
+
+
+def split_minibatchs(num_minibatchs, num_shards):
+    """
+    Number of minibatchs sampled from each shard per learner update cycle, as even as possible
+    :return: [int,...], len=num_shards, sum=num_minibatchs
+    """
+    if num_shards < 1:
+        raise ValueError()
+
+    return [len(part) for part in np.array_split(np.arange(num_minibatchs), num_shards)]
@@ -28,6 +28,25 @@ def get_rewards_before_engagement(reds_in_cell, blues_in_cell,
     return rewards, infos
 
 
+def get_cells_rewards_before_engagement(reds_cells_ef, reds_cells_force,
+                                        blues_cells_ef, blues_cells_force):
+    """
+    call from engage
+    get_rewards_before_engagement for all engagement cells at once
+    :return: reward of each red in the cell, (num_cells,)
+    """
+    win = (reds_cells_force > blues_cells_force) & (reds_cells_ef > blues_cells_ef)
+
+    # rewards = np.full(len(win), -0.5)  # For trial-0
+    rewards = np.full(len(win), 0.1)  # For trial-1
+
+    rewards[win] = 2.0 / np.pi * \
+                   np.arctan(reds_cells_force[win] / blues_cells_force[win]) * \
+                   np.arctan(reds_cells_ef[win] / blues_cells_ef[win])  # [0.5,1)
+
+    return rewards
+
+
 def get_consolidation_of_force_rewards(env, rewards):
     """
     Called from step() in battlefield_strategy.py (not used)
@@ -0,0 +1,197 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+def wilson_interval(num_wins, num_episodes, alpha):
+    """
+    Wilson score interval of the win rate, two-sided with confidence 1-alpha
+    :return: (low, high)
+    """
+    if num_episodes == 0:
+        return 0.0, 1.0
+
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+
+    p = num_wins / num_episodes
+    denominator = 1 + z ** 2 / num_episodes
+
+    center = (p + z ** 2 / (2 * num_episodes)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / num_episodes + z ** 2 / (4 * num_episodes ** 2)) / \
+        denominator
+
+    # Exact bounds of no wins and all wins, center - half_width is not exactly 0 by rounding
+    low = 0.0 if num_wins == 0 else max(center - half_width, 0.0)
+    high = 1.0 if num_wins == num_episodes else min(center + half_width, 1.0)
+
+    return low, high
+
+
+def num_checks(max_episodes, wave_size, min_episodes):
+    """
+    Num of the decision checks of SequentialTest, updated after each wave of wave_size episodes
+    up to max_episodes, from min_episodes on
+    """
+    num_waves = int(np.ceil(max_episodes / wave_size))
+    num_waves_before_min = int(np.ceil(min_episodes / wave_size)) - 1
+
+    return max(num_waves - num_waves_before_min, 1)
+
+
+class SequentialTest:
+    """
+    Sequential test of the red win rate against a threshold, for early stopping of test episodes.
+    Win is 'red_win', and 'blue_win', 'draw' and 'no_contest' are not.
+        method='wilson': decided when the Wilson score interval is above or below the threshold.
+                         The interval is checked after each update, so alpha is spent evenly
+                         over the max_checks checks (Bonferroni), the interval of a check is of
+                         alpha / max_checks.
+        method='sprt': Wald's SPRT of H0: p = threshold - indifference
+                                  vs H1: p = threshold + indifference, alpha = beta
+    decision: None (continue), 'above' or 'below' the threshold
+    """
+
+    def __init__(self, method, threshold, alpha, indifference, min_episodes, max_checks=1):
+        if method not in ['wilson', 'sprt']:
+            raise ValueError()
+
+        self.method = method
+        self.threshold = threshold
+        self.alpha = alpha
+        self.min_episodes = min_episodes
+
+        # Wilson parameter, alpha of the interval of each check
+        self.check_alpha = alpha / max_checks
+
+        # SPRT parameters
+        eps = 1e-6
+        self.p0 = min(max(threshold - indifference, eps), 1 - eps)
+        self.p1 = min(max(threshold + indifference, eps), 1 - eps)
+
+        self.upper_llr = np.log((1 - alpha) / alpha)  # accept H1
+        self.lower_llr = np.log(alpha / (1 - alpha))  # accept H0
+
+        self.counts = {'red_win': 0, 'blue_win': 0, 'draw': 0, 'no_contest': 0}
+        self.num_episodes = 0
+        self.decision = None
+
+    def update(self, winners):
+        """
+        :param winners: ['red_win',...], winner of each new episode
+        :return: decision
+        """
+        for winner in winners:
+            self.counts[winner] += 1
+
+        self.num_episodes += len(winners)
+
+        if self.num_episodes < self.min_episodes:
+            return self.decision
+
+        num_wins = self.counts['red_win']
+
+        if self.method == 'wilson':
+            low, high = wilson_interval(num_wins, self.num_episodes, self.check_alpha)
+
+            if low > self.threshold:
+                self.decision = 'above'
+            elif high < self.threshold:
+                self.decision = 'below'
+
+        else:
+            llr = num_wins * np.log(self.p1 / self.p0) + \
+                (self.num_episodes - num_wins) * np.log((1 - self.p1) / (1 - self.p0))
+
+            if llr >= self.upper_llr:
+                self.decision = 'above'
+            elif llr <= self.lower_llr:
+                self.decision = 'below'
+
+        return self.decision
+
+    def summary(self):
+        """ JSON serializable summary of the test, win_rate_interval is of alpha (one check) """
+        low, high = wilson_interval(self.counts['red_win'], self.num_episodes, self.alpha)
+
+        return {'method': self.method,
+                'threshold': float(self.threshold),
+                'decision': self.decision,
+                'num_episodes': self.num_episodes,
+                'counts': dict(self.counts),
+                'win_rate_interval': [float(low), float(high)]}
+
+
+def make_sequential_test(config, threshold=None, wave_size=1):
+    """
+    SequentialTest of config.sequential_test, None if not configured
+    threshold: None for config.sequential_test_threshold
+    wave_size: episodes between the updates, up to config.max_episodes_test_play
+    """
+    if config.sequential_test is None:
+        return None
+
+    if threshold is None:
+        threshold = config.sequential_test_threshold
+
+    return SequentialTest(method=config.sequential_test,
+                          threshold=threshold,
+                          alpha=config.sequential_test_alpha,
+                          indifference=config.sequential_test_indifference,
+                          min_episodes=config.sequential_test_min_episodes,
+                          max_checks=num_checks(config.max_episodes_test_play, wave_size,
+                                                config.sequential_test_min_episodes))
+
+
+def simulate_decision_rates(method, win_rate, threshold=0.5, alpha=0.05, indifference=0.05,
+                            min_episodes=10, max_episodes=100, wave_size=1, num_runs=2000, seed=0):
+    """
+    Rates of the decisions of the test by simulated episodes of the true win_rate
+    :return: {'above': rate, 'below': rate}
+    """
+    rng = np.random.default_rng(seed)
+    max_checks = num_checks(max_episodes, wave_size, min_episodes)
+
+    decisions = {'above': 0, 'below': 0}
+    for _ in range(num_runs):
+        test = SequentialTest(method, threshold, alpha, indifference, min_episodes, max_checks)
+
+        num_played = 0
+        while (num_played < max_episodes) and (test.decision is None):
+            num_wave_episodes = min(wave_size, max_episodes - num_played)
+            wins = rng.random(num_wave_episodes) < win_rate
+
+            test.update(['red_win' if win else 'blue_win' for win in wins])
+            num_played += num_wave_episodes
+
+        if test.decision is not None:
+            decisions[test.decision] += 1
+
+    return {decision: count / num_runs for decision, count in decisions.items()}
+
+
+def main():
+    """
+    Error rates of the early stopping, within alpha:
+        wilson: any decision at the true win rate = threshold
+        sprt: 'above' at threshold - indifference, 'below' at threshold + indifference
+    """
+    threshold = 0.5
+    alpha = 0.05
+    indifference = 0.05
+
+    for wave_size in [1, 4]:
+        rates = simulate_decision_rates('wilson', threshold, threshold=threshold, alpha=alpha,
+                                        wave_size=wave_size)
+        print(f"wilson, wave_size={wave_size}, win_rate={threshold}: {rates}")
+        assert rates['above'] + rates['below'] <= alpha
+
+        for win_rate, error in [(threshold - indifference, 'above'),
+                                (threshold + indifference, 'below')]:
+            rates = simulate_decision_rates('sprt', win_rate, threshold=threshold, alpha=alpha,
+                                            indifference=indifference, wave_size=wave_size)
+            print(f"sprt, wave_size={wave_size}, win_rate={win_rate}: {rates}")
+            assert rates[error] <= alpha
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@ import numpy as np
 import os
 import re
 import pickle
-import matplotlib.pyplot as plt
 from collections import deque
 import json
 from pathlib import Path
@@ -22,6 +21,8 @@ compute_sum_of_rewards
 count_alive_agents
 count_alive_platoons_and_companies
 compute_current_total_ef_and_force
+alive_positions
+scatter_to_map
 
 compute_log_normalized_force
 
@@ -47,6 +48,11 @@ compute_log_normalized_force
  - compute_ally_observation_maps_3
  - compute_my_observation_maps_3
  - compute_red_observation_maps_3 (For movie)
+
+ - compute_normalized_force_3
+ - compute_efficiency_3
+ - compute_red_team_maps_3
+ - compute_ally_cell_ef_and_force_3
  
 # For making result graph
  - make_test_results_graph_of_increase_number
@@ -168,6 +174,8 @@ def plot_force_history(history, r, b, config, dir_save):
     """
     This code is for 'simulate_lanchester'
     """
+    import matplotlib.pyplot as plt
+
     plt.plot(history['time'], history['log_normalize_red_force'], marker="o", color='red')
     plt.plot(history['time'], history['log_normalize_blue_force'], marker="s", color='blue')
     plt.title(
@@ -207,6 +215,8 @@ def plot_efficiency_history(history, r, b, config, dir_save):
     """
     This code is for 'simulate_lanchester'
     """
+    import matplotlib.pyplot as plt
+
     plt.plot(history['time'], history['red_efficiency'], marker="o", color='red')
     plt.plot(history['time'], history['blue_efficiency'], marker="s", color='blue')
     plt.title(
@@ -233,6 +243,7 @@ def visualize_blues_num_map(blues, battlefield, config):
     This code is for debug.
         map of number of blue agents in the battlefield (monochrome)
     """
+    import matplotlib.pyplot as plt
 
     blues_map = np.zeros(shape=(config.grid_size, config.grid_size))
 
@@ -251,6 +262,7 @@ def visualize_reds_num_map(reds, battlefield, config):
     This code is for debug.
         map of number of red agents in the battlefield (monochrome)
     """
+    import matplotlib.pyplot as plt
 
     reds_map = np.zeros(shape=(config.grid_size, config.grid_size))
 
@@ -270,6 +282,7 @@ def visualize_battlefield_agents_num_map(battlefield, reds_map, blues_map, reds,
     This code is for debug.
         map of number of red & blue agents in the battlefield (RGB)
     """
+    import matplotlib.pyplot as plt
 
     print(f'reds_num_max/grid:{reds_map.max()}, blues_num_max/grid:{blues_map.max()}')
 
@@ -363,6 +376,20 @@ def compute_log_normalized_force(force, log_threshold, denominator):
     return log_normalized_force
 
 
+def alive_positions(agents):
+    """
+    :param agents: env.reds / env.blues (AgentTeam)
+    :return: x, y of alive agents
+    """
+    pos = agents.pos[agents.alive]
+    return pos[:, 0], pos[:, 1]
+
+
+def scatter_to_map(map_2D, x, y, values):
+    """ map_2D[x,y] += values, accumulated in the agent order (same as the loop over agents) """
+    np.add.at(map_2D, (x, y), np.asarray(values).astype(map_2D.dtype))
+
+
 def compute_engage_mask(env):
     """
     mask=1, if some reds & blues exist in the same cell
@@ -378,17 +405,15 @@ def compute_engage_mask(env):
     red_force = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
     blue_force = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
 
-    for red in env.reds:
-        if red.alive:
-            red_alive[red.pos[0], red.pos[1]] = 1
-            red_ef[red.pos[0], red.pos[1]] += red.ef
-            red_force[red.pos[0], red.pos[1]] += red.force
+    red_x, red_y = alive_positions(env.reds)
+    red_alive[red_x, red_y] = 1
+    scatter_to_map(red_ef, red_x, red_y, env.reds.ef[env.reds.alive])
+    scatter_to_map(red_force, red_x, red_y, env.reds.force[env.reds.alive])
 
-    for blue in env.blues:
-        if blue.alive:
-            blue_alive[blue.pos[0], blue.pos[1]] = 1
-            blue_ef[blue.pos[0], blue.pos[1]] += blue.ef
-            blue_force[blue.pos[0], blue.pos[1]] += blue.force
+    blue_x, blue_y = alive_positions(env.blues)
+    blue_alive[blue_x, blue_y] = 1
+    scatter_to_map(blue_ef, blue_x, blue_y, env.blues.ef[env.blues.alive])
+    scatter_to_map(blue_force, blue_x, blue_y, env.blues.force[env.blues.alive])
 
     mask = red_alive * blue_alive  # masking engage cell
 
@@ -713,17 +738,15 @@ def compute_engage_mask_3(env):
     red_force = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
     blue_force = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
 
-    for red in env.reds:
-        if red.alive:
-            red_alive[red.pos[0], red.pos[1]] = 1
-            red_ef[red.pos[0], red.pos[1]] += red.ef
-            red_force[red.pos[0], red.pos[1]] += red.effective_force
+    red_x, red_y = alive_positions(env.reds)
+    red_alive[red_x, red_y] = 1
+    scatter_to_map(red_ef, red_x, red_y, env.reds.ef[env.reds.alive])
+    scatter_to_map(red_force, red_x, red_y, env.reds.effective_force[env.reds.alive])
 
-    for blue in env.blues:
-        if blue.alive:
-            blue_alive[blue.pos[0], blue.pos[1]] = 1
-            blue_ef[blue.pos[0], blue.pos[1]] += blue.ef
-            blue_force[blue.pos[0], blue.pos[1]] += blue.effective_force
+    blue_x, blue_y = alive_positions(env.blues)
+    blue_alive[blue_x, blue_y] = 1
+    scatter_to_map(blue_ef, blue_x, blue_y, env.blues.ef[env.blues.alive])
+    scatter_to_map(blue_force, blue_x, blue_y, env.blues.effective_force[env.blues.alive])
 
     mask = red_alive * blue_alive  # masking engage cell
 
@@ -869,7 +892,72 @@ def compute_red_observation_maps_3(env):
     return red_normalized_force, red_efficiency
 
 
+def compute_normalized_force_3(force):
+    """ arc-tan normalized force of the _3 observation maps """
+    alpha = 50.0
+    return 2.0 / np.pi * np.arctan(force / alpha)
+
+
+def compute_efficiency_3(force, ef):
+    """ ef / force where force != 0, same as compute_cell_efficiency over the nonzero cells """
+    efficiency = np.zeros_like(force, dtype=np.float32)
+    np.divide(ef, force, out=efficiency, where=(force != 0))
+
+    return efficiency
+
+
+def compute_red_team_maps_3(env):
+    """
+    Red team ef and force 2d maps, computed once per step and shared by all red agents.
+    :return:
+        red_ef, red_force: (grid_size,grid_size)
+        red_x, red_y: position of alive reds, (num_alive_reds,)
+    """
+    red_ef = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
+    red_force = np.zeros((env.config.grid_size, env.config.grid_size), dtype=np.float32)
+
+    red_x, red_y = alive_positions(env.reds)
+    scatter_to_map(red_ef, red_x, red_y, env.reds.ef[env.reds.alive])
+    scatter_to_map(red_force, red_x, red_y, env.reds.force[env.reds.alive])
+
+    return red_ef, red_force, red_x, red_y
+
+
+def compute_ally_cell_ef_and_force_3(env, red_x, red_y):
+    """
+    ef and force of the allies in my cell, except myself, for each alive red.
+    Only the cells shared by several reds need the sum, other cells are 0.
+    :return: ally_cell_ef, ally_cell_force: (num_alive_reds,), float32
+    """
+    alive = env.reds.alive
+    ef = env.reds.ef[alive].astype(np.float32)
+    force = env.reds.force[alive].astype(np.float32)
+
+    ally_cell_ef = np.zeros(len(red_x), dtype=np.float32)
+    ally_cell_force = np.zeros(len(red_x), dtype=np.float32)
+
+    cells = red_x * env.config.grid_size + red_y
+    _, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+
+    for k in np.nonzero(counts > 1)[0]:
+        members = order[bounds[k]:bounds[k + 1]]
+
+        for m in members:
+            allies = members[members != m]
+
+            # Accumulate in the agent order, same as compute_ally_observation_maps_3
+            np.add.at(ally_cell_ef, np.full(len(allies), m), ef[allies])
+            np.add.at(ally_cell_force, np.full(len(allies), m), force[allies])
+
+    return ally_cell_ef, ally_cell_force
+
+
 def make_test_results_graph_of_increase_number(agent_type, parent_dir):
+    import matplotlib.pyplot as plt
+
     num_red_win_list = []
     num_blue_win_list = []
     num_no_contest_list = []
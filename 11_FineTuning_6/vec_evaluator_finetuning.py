@@ -0,0 +1,284 @@
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from battlefield_strategy_rev10_finetuning import BattleFieldStrategy
+from frame_stack import FrameStack
+from models import MarlTransformerModel
+from sequential_test import make_sequential_test
+from tester_finetuning import summarize_agent_result, summarize_episode_results, \
+    summarize_results, who_wins
+from utils_gnn import get_alive_agents_ids
+from utils_transformer import make_mask, make_padded_obs
+
+
+class VecEvaluator:
+    """
+    Batched evaluation of the test episodes of a scenario (finetuning_config.read_test_scenario).
+    Up to num_envs episodes are stepped in lockstep, with one forward pass of the policy per step
+    for all the live episodes. A finished episode is dropped from the batch, and its env starts
+    a new episode while less than num_episodes are started.
+
+    The rules of each episode are those of Tester.test_play. The result has the fields of
+    summarize_results, and R0_list, B0_list and winner of each episode for
+    robustness_of_strategy.
+    """
+
+    def __init__(self, policy, num_envs):
+        self.policy = policy
+        self.num_envs = num_envs
+
+        self.envs = [BattleFieldStrategy() for _ in range(self.num_envs)]
+
+        self.action_space_dim = self.envs[0].action_space.n
+        self.n_frames = self.envs[0].config.n_frames
+        self.obs_shape = (self.envs[0].config.grid_size,
+                          self.envs[0].config.grid_size,
+                          self.envs[0].config.observation_channels * self.n_frames)
+
+        # Parameters TBD in set_scenario()
+        self.max_num_agents = None
+        self.frame_stack = None  # states: (K,n,g,g,ch*n_frames)
+        self.masks = None  # (K,n), bool
+
+        # Episode variables of each env, reset in start_episode()
+        self.alive_agents_ids = [None] * self.num_envs
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.episode_rewards = np.zeros(self.num_envs)
+        self.episode_team_rewards = np.zeros(self.num_envs)
+
+    def set_scenario(self, scenario_id):
+        for env in self.envs:
+            env.config.read_test_scenario(scenario_id=scenario_id)
+            env.config.max_num_red_agents = \
+                env.config.red_platoons[1] + env.config.red_companies[1]
+
+        self.max_num_agents = self.envs[0].config.max_num_red_agents
+
+        self.frame_stack = FrameStack(num_envs=self.num_envs,
+                                      max_num_agents=self.max_num_agents,
+                                      obs_shape=(self.envs[0].config.grid_size,
+                                                 self.envs[0].config.grid_size,
+                                                 self.envs[0].config.observation_channels),
+                                      n_frames=self.n_frames)
+        self.masks = np.zeros((self.num_envs, self.max_num_agents), dtype=bool)
+
+    def start_episode(self, k):
+        """ Reset k-th env, n_frames stacking of the initial observations """
+        env = self.envs[k]
+        observations = env.reset()
+
+        self.alive_agents_ids[k] = get_alive_agents_ids(env=env)
+
+        self.frame_stack.reset(k, self.alive_agents_ids[k],
+                               [observations['red_' + str(a)] for a in self.alive_agents_ids[k]])
+        self.set_mask(k)
+
+        self.steps[k] = 0
+        self.episode_rewards[k] = 0
+        self.episode_team_rewards[k] = 0
+
+    def set_mask(self, k):
+        self.masks[k] = make_mask(alive_agents_ids=self.alive_agents_ids[k],
+                                  max_num_agents=self.max_num_agents)[0]  # (n,)
+
+    def step_env(self, k, acts, epsilon):
+        """
+        One step of k-th env by the greedy actions acts (n,), with epsilon-greedy,
+        after self.frame_stack.advance()
+        :return: True if the episode is done
+        """
+        env = self.envs[k]
+
+        actions = {}
+        for i, a in enumerate(self.alive_agents_ids[k]):
+            agent_id = 'red_' + str(a)
+
+            if np.random.rand() >= epsilon:  # epsilon-greedy
+                actions[agent_id] = acts[i]
+            else:
+                actions[agent_id] = np.random.randint(low=0, high=self.action_space_dim)
+
+        # reward:team reward, done: team done
+        next_observations, rewards, dones, infos, reward, done = env.step(actions)
+
+        next_alive_agents_ids = get_alive_agents_ids(env=env)
+
+        self.frame_stack.append(
+            k, next_alive_agents_ids,
+            [next_observations['red_' + str(a)] for a in next_alive_agents_ids])
+
+        # 終了判定
+        if self.steps[k] > env.config.max_steps:
+            dones['all_dones'] = True
+
+        # Rewards of alive agents, in the order of Tester.test_play
+        agents_rewards = []
+        for idx in range(self.max_num_agents):
+            if idx in self.alive_agents_ids[k]:
+                agents_rewards.append(float(rewards['red_' + str(idx)]))
+            else:
+                agents_rewards.append(0.0)
+
+        self.episode_rewards[k] += np.sum(agents_rewards)
+        self.episode_team_rewards[k] += reward
+
+        if dones['all_dones']:
+            return True
+
+        self.alive_agents_ids[k] = next_alive_agents_ids
+        self.set_mask(k)
+        self.steps[k] += 1
+
+        return False
+
+    def record_episode(self, k, results):
+        env = self.envs[k]
+
+        results['episode_lens'].append(int(self.steps[k]))
+        results['episode_rewards'].append(float(self.episode_rewards[k]))
+        results['episode_team_reward'].append(float(self.episode_team_rewards[k]))
+
+        # Summarize each agent result
+        result_red = summarize_agent_result(env.reds)
+        result_blue = summarize_agent_result(env.blues)
+
+        # Decide winner
+        winner = who_wins(result_red, result_blue)
+
+        # Summarize episode result
+        summarize_episode_results(results, result_red, result_blue, winner)
+
+        results['R0_list'].append(float(env.config.R0))
+        results['B0_list'].append(float(env.config.B0))
+
+    def evaluate(self, scenario_id, num_episodes, epsilon=0.0, sequential_test=None):
+        """
+        sequential_test: SequentialTest for early stopping, None for all num_episodes.
+                         Episodes are played in waves of num_envs and the test is updated after
+                         each wave, so that the stop drops no unfinished (longer) episodes.
+        :return: result, summarize_results of the episodes, num_test_episodes, and
+                 'R0_list', 'B0_list', 'winner': [float/str,...], len=num_test_episodes
+        """
+        self.set_scenario(scenario_id)
+
+        results = defaultdict(list)
+
+        if sequential_test is None:
+            self.run_episodes(num_episodes, epsilon, results)
+
+        else:
+            num_played = 0
+
+            while (num_played < num_episodes) and (sequential_test.decision is None):
+                num_wave_episodes = min(self.num_envs, num_episodes - num_played)
+                num_recorded = len(results['winner'])
+
+                self.run_episodes(num_wave_episodes, epsilon, results)
+
+                sequential_test.update(results['winner'][num_recorded:])
+                num_played += num_wave_episodes
+
+        result = summarize_results(results)
+        result['num_test_episodes'] = len(results['winner'])
+
+        if sequential_test is not None:
+            result['sequential_test'] = sequential_test.summary()
+
+        result['R0_list'] = results['R0_list']
+        result['B0_list'] = results['B0_list']
+        result['winner'] = results['winner']
+
+        return result
+
+    def run_episodes(self, num_episodes, epsilon, results):
+        """ Play num_episodes in lockstep, and record them to results """
+        live = []  # envs of the live episodes
+        num_started = 0
+
+        for k in range(min(self.num_envs, num_episodes)):
+            self.start_episode(k)
+            live.append(k)
+            num_started += 1
+
+        while len(live) > 0:
+            q_logits, _ = self.policy(self.frame_stack.states[live], self.masks[live],
+                                      training=False)
+            acts = np.argmax(np.array(q_logits), axis=-1)  # (L,n)
+
+            self.frame_stack.advance()
+
+            next_live = []
+            for i, k in enumerate(live):
+                if not self.step_env(k, acts[i], epsilon):
+                    next_live.append(k)
+                    continue
+
+                self.record_episode(k, results)
+
+                if num_started < num_episodes:
+                    self.start_episode(k)
+                    next_live.append(k)
+                    num_started += 1
+
+            live = next_live
+
+
+def main():
+    """
+    Batched evaluation of the test scenarios. result.json of each scenario is saved in
+    ./test_engagement/scenario_{id}/. Specify the model and the scenarios.
+    """
+    from finetuning_config import Config
+
+    config = Config()
+    epsilon = 0.
+
+    scenario_ids = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+    # Make policy and load learned weights
+    policy = MarlTransformerModel(config=config)
+
+    # Build model
+    alive_agents_ids = [0, 2]
+    obs_shape = (config.grid_size, config.grid_size, config.observation_channels * config.n_frames)
+    raw_obs = [np.random.rand(*obs_shape) for _ in alive_agents_ids]
+
+    padded_obs = make_padded_obs(config.max_num_red_agents, obs_shape, raw_obs)
+    mask = make_mask(alive_agents_ids, config.max_num_red_agents)
+
+    policy(padded_obs, mask)
+
+    # Load model
+    load_dir = Path(__file__).parent / 'best_model'
+    load_name = '/best_model'
+
+    policy.load_weights(str(load_dir) + load_name)
+
+    evaluator = VecEvaluator(policy=policy, num_envs=config.num_eval_envs)
+
+    for scenario_id in scenario_ids:
+        sequential_test = make_sequential_test(config, wave_size=evaluator.num_envs)
+
+        result = evaluator.evaluate(scenario_id=scenario_id,
+                                    num_episodes=config.max_episodes_test_play,
+                                    epsilon=epsilon,
+                                    sequential_test=sequential_test)
+
+        print(f"scenario {scenario_id}, {result['num_test_episodes']} test trials: "
+              f"num_red_win = {result['num_red_win']}, num_blue_win = {result['num_blue_win']}, "
+              f"num_draw = {result['draw']}, num_no_contest = {result['no_contest']}")
+
+        dir_save = './test_engagement/scenario_' + str(scenario_id)
+        if not os.path.exists(dir_save):
+            os.makedirs(dir_save)
+
+        with open(dir_save + '/result.json', 'w') as f:
+            json.dump(result, f, indent=5)
+
+
+if __name__ == '__main__':
+    main()